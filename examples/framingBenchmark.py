@@ -0,0 +1,28 @@
+# Measure how quickly packets can be framed for sending to a Modulo Controller.
+# This doesn't require any hardware. It compares the original per-byte list
+# based encoder with the bytes based encoder used by SerialConnection.
+
+from __future__ import print_function
+import random, timeit
+from modulo.connection import _encodeFrame
+
+def listEncodeFrame(data) :
+    packet = []
+    for x in data :
+        if x == 0x7E or x == 0x7D :
+            packet.append(0x7D)
+            packet.append(x ^ (1 << 5))
+        else :
+            packet.append(x)
+    return [0x7E] + packet + [0x7E]
+
+random.seed(0)
+for size in (8, 32, 256) :
+    data = [random.randint(0, 255) for i in range(size)]
+    assert bytearray(listEncodeFrame(data)) == bytearray(_encodeFrame(data))
+
+    for name, encode in (('list', listEncodeFrame), ('bytes', _encodeFrame)) :
+        count = 20000
+        seconds = timeit.timeit(lambda : encode(data), number=count)
+        print('%5s encoder, %3d byte packets: %8.2f MB/s' %
+            (name, size, size*count/seconds/1e6))
@@ -0,0 +1,34 @@
+# Measure transfer and display throughput against a simulated Modulo Controller
+# with several bus latencies. This doesn't require any hardware.
+
+from __future__ import print_function
+import time
+import modulo
+from modulo.simulator import SimulatedController, SimulatedBlankSlate, SimulatedDisplay
+
+for latency in (0, .0005, .002) :
+    controller = SimulatedController(latency=latency)
+    controller.addDevice(SimulatedBlankSlate(1))
+    simulatedDisplay = controller.addDevice(SimulatedDisplay(2))
+
+    port = controller.openPort()
+    blankSlate = modulo.BlankSlate(port)
+    display = modulo.Display(port)
+
+    count = 200
+    start = time.time()
+    for i in range(count) :
+        blankSlate.getDigitalInputs()
+    transferRate = count/(time.time()-start)
+
+    count = 20
+    start = time.time()
+    for i in range(count) :
+        display.clear()
+        display.drawSplashScreen()
+        display.refresh()
+    display.flush()
+    frameRate = count/(time.time()-start)
+
+    print('%.1fms latency: %6.0f transfers/s, %5.1f frames/s, %d op bytes/frame' %
+        (latency*1000, transferRate, frameRate, simulatedDisplay.opBytes/simulatedDisplay.frameCount))
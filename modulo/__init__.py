@@ -5,5 +5,6 @@ Modulo Docstring
 """
 
 from modulo.connection import Port
+from modulo.group import PortGroup
 from modulo.modulos import *
 
@@ -0,0 +1,479 @@
+"""
+asyncio support for Modulo. Requires Python 3.7 or later.
+
+An AsyncPort lets a single event loop drive one or more Modulo Controllers
+alongside other asynchronous I/O::
+
+    import asyncio, modulo.aio
+
+    async def main() :
+        async with modulo.aio.AsyncPort() as port :
+            display = modulo.aio.AsyncDisplay(port)
+            await port.attach(display)
+
+            display.clear()
+            display.write("Hello Modulo")
+            await display.refresh()
+
+            async for deviceID, eventCode, eventData in port.events() :
+                ...
+
+    asyncio.run(main())
+"""
+
+import asyncio, collections, os, threading
+import serial
+
+from modulo.connection import Port, _encodeFrame, _FrameDecoder, _findControllerPath
+from modulo.modulos import Display, _clip
+
+
+class AsyncSerialConnection(object) :
+    """
+    A non-blocking connection to a Modulo Controller. Reading and writing is
+    done by the running asyncio event loop, so any path that can be opened by
+    pyserial and has a file descriptor (including a pty) can be used.
+    """
+
+    _CodeEcho = ord('X')
+    _CodeTransfer = ord('T')
+    _CodeReceive = ord('R')
+    _CodeEvent = ord('V')
+    _CodeQuit = ord('Q')
+
+    def __init__(self, path=None, controller=0, timeout=.1) :
+        if path is None :
+            path = _findControllerPath(controller)
+
+        self._serial = serial.Serial(path, timeout=0)
+        self._fd = self._serial.fileno()
+        self._timeout = timeout
+        self._decoder = _FrameDecoder()
+        self._writeBuffer = bytearray()
+        self._queuedTransfers = collections.deque()
+        self._pendingTransfers = collections.deque()
+        self._maxInFlight = 1
+        self._timeoutHandle = None
+        self._loop = None
+        self._events = None
+        self._echo = None
+
+    async def connect(self) :
+        """Start reading from the connection and wait for the controller
+           to respond."""
+        self._loop = asyncio.get_running_loop()
+        self._events = asyncio.Queue()
+        self._loop.add_reader(self._fd, self._onReadable)
+
+        # Send pings until we get a response. See Connection.__init__
+        while True :
+            self._echo = self._loop.create_future()
+            self.sendPacket([self._CodeEcho])
+            try :
+                await asyncio.wait_for(self._echo, self._timeout)
+                return
+            except asyncio.TimeoutError :
+                pass
+
+    def setMaxInFlight(self, count) :
+        """Set the maximum number of transfers that may be sent before their
+           responses have been received. Additional transfers are queued and
+           sent as responses arrive."""
+        self._maxInFlight = max(1, int(count))
+        self._sendQueuedTransfers()
+
+    def sendPacket(self, data) :
+        self._write(_encodeFrame(data))
+
+    def transfer(self, address, command, sendData, receiveLen) :
+        """Send a transfer and return an asyncio Future for the received data.
+           The future can be awaited, or ignored if the result isn't needed.
+           The result is None if the transfer failed."""
+        future = self._loop.create_future()
+        if address is None :
+            future.set_result(None)
+            return future
+
+        sendBuffer = bytearray([self._CodeTransfer, address, command, len(sendData),
+            receiveLen])
+        sendBuffer += bytearray(sendData)
+
+        self._queuedTransfers.append((_encodeFrame(sendBuffer), future))
+        self._sendQueuedTransfers()
+        return future
+
+    # Transfers never block, so queueing a transfer is the same as sending it.
+    queueTransfer = transfer
+
+    async def nextEvent(self) :
+        """Wait for and return the next event packet"""
+        return await self._events.get()
+
+    def close(self) :
+        if self._timeoutHandle is not None :
+            self._timeoutHandle.cancel()
+        if self._loop is not None :
+            self._loop.remove_reader(self._fd)
+            if self._writeBuffer :
+                self._loop.remove_writer(self._fd)
+
+        self._serial.write(bytes(self._writeBuffer) + bytes(_encodeFrame([self._CodeQuit])))
+        self._serial.flush()
+        self._serial.close()
+
+    def _sendQueuedTransfers(self) :
+        while self._queuedTransfers and len(self._pendingTransfers) < self._maxInFlight :
+            frame, future = self._queuedTransfers.popleft()
+            self._write(frame)
+
+            self._pendingTransfers.append(future)
+            if len(self._pendingTransfers) == 1 :
+                self._startTimeout()
+
+    def _startTimeout(self) :
+        """Time the oldest pending transfer. The controller handles transfers
+           one at a time, so the ones behind it aren't timed until it has
+           completed."""
+        self._timeoutHandle = self._loop.call_later(self._timeout, self._onTimeout)
+
+    def _completeTransfer(self, receiveData) :
+        if self._pendingTransfers :
+            future = self._pendingTransfers.popleft()
+            self._timeoutHandle.cancel()
+            if not future.done() :
+                future.set_result(receiveData)
+            if self._pendingTransfers :
+                self._startTimeout()
+        self._sendQueuedTransfers()
+
+    def _onTimeout(self) :
+        # The oldest transfer's response was lost
+        self._completeTransfer(None)
+
+    def _write(self, data) :
+        if not self._writeBuffer :
+            try :
+                written = os.write(self._fd, data)
+            except BlockingIOError :
+                written = 0
+
+            if written == len(data) :
+                return
+            data = data[written:]
+            self._loop.add_writer(self._fd, self._onWritable)
+
+        self._writeBuffer += data
+
+    def _onWritable(self) :
+        try :
+            written = os.write(self._fd, self._writeBuffer)
+        except BlockingIOError :
+            return
+
+        del self._writeBuffer[:written]
+        if not self._writeBuffer :
+            self._loop.remove_writer(self._fd)
+
+    def _onReadable(self) :
+        try :
+            data = os.read(self._fd, 4096)
+        except BlockingIOError :
+            return
+
+        self._decoder.feed(data)
+        frame = self._decoder.nextFrame()
+        while frame is not None :
+            self._processFrame(list(frame))
+            frame = self._decoder.nextFrame()
+
+    def _processFrame(self, packet) :
+        if packet[0] == self._CodeReceive :
+            self._completeTransfer(packet[2:])
+        elif packet[0] == self._CodeEvent :
+            self._events.put_nowait(packet)
+        elif packet[0] == self._CodeEcho :
+            if self._echo is not None and not self._echo.done() :
+                self._echo.set_result(True)
+        else :
+            print('Invalid out of band packet: ', packet)
+
+
+class AsyncPort(object) :
+    """
+    An asyncio version of Port. Create the port and then connect to it with
+    ``await port.connect()`` (or use it with ``async with``). Modules are
+    created as usual, but must be attached with ``await port.attach(module)``
+    before use, since they can't search for their device without blocking.
+
+    The bus methods (getNextDeviceID, getDeviceType, ...) are coroutines.
+    """
+
+    _BroadcastAddress = Port._BroadcastAddress
+
+    _BroadcastCommandGetNextDeviceID = Port._BroadcastCommandGetNextDeviceID
+    _BroadcastCommandSetAddress = Port._BroadcastCommandSetAddress
+    _BroadcastCommandGetAddress = Port._BroadcastCommandGetAddress
+    _BroadcastCommandGetDeviceType = Port._BroadcastCommandGetDeviceType
+    _BroadcastCommandGetVersion = Port._BroadcastCommandGetVersion
+    _BroadcastCommandSetStatusLED = Port._BroadcastCommandSetStatusLED
+
+    _StatusOff = Port._StatusOff
+    _StatusOn = Port._StatusOn
+    _StatusBlinking = Port._StatusBlinking
+
+    def __init__(self, serialPortPath=None, controller=0) :
+        self._lastAssignedAddress = 9
+        self._connection = AsyncSerialConnection(serialPortPath, controller)
+        self._modulos = []
+        self._modulosByID = {}
+        self._modulosByAddress = {}
+        self._inventory = None
+        self._bindingLock = threading.RLock()
+
+    async def connect(self) :
+        """Wait until the controller is ready"""
+        await self._connection.connect()
+        return self
+
+    def close(self) :
+        self._connection.close()
+
+    async def __aenter__(self) :
+        return await self.connect()
+
+    async def __aexit__(self, excType, excValue, traceback) :
+        self.close()
+
+    def setMaxInFlight(self, count) :
+        """Set the maximum number of transfers that can be sent to the controller
+           before waiting for their responses. See Port.setMaxInFlight"""
+        self._connection.setMaxInFlight(count)
+
+    def transfer(self, address, command, sendData, receiveLen) :
+        """Send a transfer and return a Future for the received data"""
+        return self._connection.transfer(address, command, sendData, receiveLen)
+
+    # Transfers never block, so queueing a transfer is the same as sending it.
+    queueTransfer = transfer
+
+    _isPipelined = Port._isPipelined
+    _findModuloByID = Port._findModuloByID
+    _findModuloByAddress = Port._findModuloByAddress
+    _addModulo = Port._addModulo
+    _removeModulo = Port._removeModulo
+    _indexModulo = Port._indexModulo
+    _unindexModulo = Port._unindexModulo
+    _pickAddress = Port._pickAddress
+
+    def _findUnusedDevice(self, deviceType) :
+        # Called by ModuloBase when a module that hasn't been attached is used.
+        self._notAttached()
+
+    def _getInventoryAddress(self, deviceID) :
+        # Called by ModuloBase when a module that hasn't been attached is used.
+        self._notAttached()
+
+    def _notAttached(self) :
+        raise RuntimeError("Modules must be attached to an AsyncPort with "
+            "'await port.attach(module)' before they are used")
+
+    async def attach(self, module) :
+        """Find the device for *module* and assign it an address. Returns
+           whether a device was found."""
+        if module._address is not None :
+            return True
+
+        if module._deviceID is None :
+            deviceID = await self.getNextDeviceID(0)
+            while (deviceID is not None) :
+                if self._findModuloByID(deviceID) is None :
+                    if (await self.getDeviceType(deviceID)) == module._deviceType :
+                        module._setBinding(deviceID, None)
+                        break
+
+                deviceID = await self.getNextDeviceID(deviceID)
+
+        if module._deviceID is None :
+            return False
+
+        address = await self.getAddress(module._deviceID)
+        if (address == 0 or address == 127) :
+            address = self._pickAddress(await self._getUsedAddresses())
+            await self.setAddress(module._deviceID, address)
+
+        module._setBinding(module._deviceID, address)
+        return address is not None
+
+    async def _getUsedAddresses(self) :
+        """Return the addresses of every device on the bus, including ones
+           assigned by other ports"""
+        used = set()
+        deviceID = await self.getNextDeviceID(0)
+        while deviceID is not None and deviceID != 0xFFFF :
+            used.add(await self.getAddress(deviceID))
+            deviceID = await self.getNextDeviceID(deviceID)
+        return used
+
+    async def events(self) :
+        """An asynchronous iterator of (deviceID, eventCode, eventData) tuples.
+           Each event is also dispatched to its module, so callbacks will be
+           called as events are received."""
+        while True :
+            event = (await self._connection.nextEvent())[1:]
+
+            eventCode = event[0]
+            deviceID = event[1] | (event[2] << 8)
+            eventData = event[3] | (event[4] << 8)
+
+            m = self._findModuloByID(deviceID)
+            if m :
+                m._processEvent(eventCode, eventData)
+
+            yield deviceID, eventCode, eventData
+
+    async def runForever(self) :
+        """Continue to process events forever"""
+        async for event in self.events() :
+            pass
+
+    async def getNextDeviceID(self, lastDeviceID) :
+        """Find the smallest deviceID that's greater than the one provided."""
+        if lastDeviceID == 0xFFFF :
+            return 0xFFFF
+
+        nextDeviceID = lastDeviceID+1
+
+        sendData = [nextDeviceID & 0xFF, nextDeviceID >> 8]
+        resultData = await self.transfer(
+            self._BroadcastAddress, self._BroadcastCommandGetNextDeviceID, sendData, 2)
+        if resultData :
+            return resultData[1] | (resultData[0] << 8)
+
+    async def setAddress(self, deviceID, address) :
+        """Set the I2C address of the modulo with the specified ID"""
+        sendData = [deviceID & 0xFF, deviceID >> 8, address]
+        await self.transfer(self._BroadcastAddress, self._BroadcastCommandSetAddress,
+            sendData, 0)
+
+    async def getAddress(self, deviceID) :
+        """Get the I2C address of the modulo with the specified ID"""
+        sendData = [deviceID & 0xFF, deviceID >> 8]
+        retval = await self.transfer(self._BroadcastAddress,
+            self._BroadcastCommandGetAddress, sendData, 1)
+        if retval :
+            return retval[0]
+
+    async def setStatus(self, deviceID, status) :
+        """Set the status LED of the modulo with the specified ID"""
+        sendData = [deviceID & 0xFF, deviceID >> 8, status]
+        await self.transfer(self._BroadcastAddress, self._BroadcastCommandSetStatusLED,
+            sendData, 0)
+
+    async def getVersion(self, deviceID) :
+        """Get the firmware version of the modulo with the specified ID"""
+        sendData = [deviceID & 0xFF, deviceID >> 8]
+        retval = await self.transfer(self._BroadcastAddress,
+            self._BroadcastCommandGetVersion, sendData, 2)
+        if not retval :
+            return None
+        return retval[0] | (retval[1] << 8)
+
+    async def getDeviceType(self, deviceID) :
+        """Get the device type string of the modulo with the specified ID"""
+        sendData = [deviceID & 0xFF, deviceID >> 8]
+        resultData = await self.transfer(self._BroadcastAddress,
+            self._BroadcastCommandGetDeviceType, sendData, 31)
+        if resultData is None :
+            return None
+        return Port._bytesToString(self, resultData)
+
+
+class AsyncDisplay(Display) :
+    """
+    A Display for use with an AsyncPort. Drawing methods never block. Instead
+    the operations are kept on the host until ``await display.refresh()``
+    (or ``await display.flush()``), which sends them as soon as the display has
+    room for them.
+
+    Methods that read from the display (isComplete, isEmpty, getButtons,
+    getButton) and setCurrent and setContrast are coroutines.
+    """
+
+    def _sendOp(self, data) :
+        if not isinstance(data, bytearray) :
+            data = bytearray(int(x) for x in data)
+        self._queuedOps.append(data)
+
+    def _waitOnRefresh(self) :
+        # Waiting happens in flush() instead
+        pass
+
+    async def flush(self) :
+        """Send all drawing operations that haven't been sent yet"""
+        self._endOp()
+
+        if self._isRefreshing :
+            self._isRefreshing = False
+            while not await self.isEmpty() :
+                await asyncio.sleep(.005)
+
+        ops, self._queuedOps = self._queuedOps, []
+        for data in self._packOps(ops) :
+            while (self._availableSpace < len(data)) :
+                receiveData = await self.transfer(self._FUNCTION_GET_AVAILABLE_SPACE, [], 2)
+                if receiveData :
+                    self._availableSpace = receiveData[0] | (receiveData[1] << 8)
+
+                if self._availableSpace < len(data) :
+                    await asyncio.sleep(.005)
+
+            self._availableSpace -= len(data)
+            self.transfer(self._FUNCTION_APPEND_OP, data, 0)
+
+    async def refresh(self, flip=False) :
+        """Send all drawing operations followed by a refresh. Returns once
+           the frame has been sent. Drawing the next frame can begin
+           immediately; it will be sent after this one has been displayed."""
+        self._endOp()
+        self._sendOp([self._OpRefresh, flip])
+        await self.flush()
+        self._isRefreshing = True
+
+    async def isComplete(self) :
+        """ Return whether all previous drawing operations have been completed."""
+        retval = await self.transfer(self._FUNCTION_IS_COMPLETE, [], 1)
+        return retval and retval[0]
+
+    async def isEmpty(self) :
+        """Return whether the queue of drawing operations is empty."""
+        retval = await self.transfer(self._FUNCTION_IS_EMPTY, [], 1)
+        return retval and bool(retval[0])
+
+    async def getButton(self, button) :
+        """Return whether the specified button is currently pressed"""
+        return bool((await self.getButtons()) & (1 << button))
+
+    async def getButtons(self) :
+        """Return the state of all three buttons, one in each bit."""
+        receivedData = await self.transfer(self._FUNCTION_GET_BUTTONS, [], 1)
+        if (receivedData is None) :
+            return False
+
+        return receivedData[0]
+
+    async def _waitOnComplete(self) :
+        await self.flush()
+        while not await self.isComplete() :
+            await asyncio.sleep(.005)
+
+    async def setCurrent(self, current) :
+        """Set the display's master current. See Display.setCurrent"""
+        current = int(15*_clip(current, 0, 1))
+        await self._waitOnComplete()
+        await self.transfer(self._FUNCTION_SET_CURRENT, [current], 0)
+
+    async def setContrast(self, r, g, b) :
+        """Set the per channel contrast values. See Display.setContrast"""
+        contrast = [int(255*_clip(x, 0, 1)) for x in (r, g, b)]
+        await self._waitOnComplete()
+        await self.transfer(self._FUNCTION_SET_CONTRAST, contrast, 0)
@@ -0,0 +1,361 @@
+"""
+Share one Modulo Controller among several processes.
+
+Only one process can open a controller's serial port. A Bridge owns the
+connection to the controller and listens on TCP or Unix domain sockets for
+clients, which connect with the usual Port class::
+
+    # In one process (or run the modulo-bridge script)
+    bridge = Bridge(openConnection())
+    bridge.listen('unix:///tmp/modulo')
+    bridge.serveForever()
+
+    # In any number of other processes
+    port = modulo.Port('unix:///tmp/modulo')
+
+Clients speak the same framed protocol as the controller. Transfers from all
+clients are sent to the controller as soon as they arrive, several at a time,
+and each response is returned to the client that sent the transfer. Events
+are sent to every client.
+"""
+
+from __future__ import print_function, division, absolute_import, unicode_literals
+import collections, errno, os, select, socket, threading, time
+
+from modulo.connection import Connection, openConnection, _encodeFrame, _FrameDecoder
+
+
+class _Request(object) :
+    """A transfer received from a client"""
+
+    __slots__ = ('client', 'packet', 'frame', 'sentTime')
+
+    def __init__(self, client, packet) :
+        self.client = client
+        self.packet = packet
+        self.frame = _encodeFrame(packet)
+        self.sentTime = None
+
+
+class _Client(object) :
+    """A process connected to the bridge"""
+
+    def __init__(self, sock, name) :
+        sock.setblocking(False)
+        self.socket = sock
+        self.name = name
+        self.closed = False
+        self.decoder = _FrameDecoder()
+        self.outgoing = bytearray()
+        self.transferCount = 0
+        self.eventCount = 0
+
+    def fileno(self) :
+        return self.socket.fileno()
+
+    def send(self, data) :
+        """Queue data for the client and send as much as possible without
+           blocking. Must be called with the bridge's lock held."""
+        if self.closed :
+            return
+        self.outgoing += data
+        self.flush()
+
+    def flush(self) :
+        try :
+            sent = self.socket.send(self.outgoing)
+        except (socket.error, OSError) as e :
+            if getattr(e, 'errno', None) not in (errno.EAGAIN, errno.EWOULDBLOCK) :
+                self.closed = True
+            return
+        del self.outgoing[:sent]
+
+
+class Bridge(object) :
+    """
+    Relays transfers and events between the controller at the other end of
+    *connection* and any number of clients. Up to *maxInFlight* transfers are
+    sent to the controller before waiting for their responses.
+    """
+
+    _CodeEcho = ord('X')
+    _CodeTransfer = ord('T')
+    _CodeReceive = ord('R')
+    _CodeQuit = ord('Q')
+    _CodeEvent = ord('V')
+
+    # The controller handles transfers in order, so once the oldest in flight
+    # transfer has waited this long for its response, the response was lost.
+    # This is shorter than the clients' timeout, so that the empty response
+    # sent in its place reaches the client before it gives up on the transfer.
+    _Timeout = Connection._Timeout/2
+
+    # The largest number of bytes read from a client at once
+    _ReadSize = 65536
+
+    def __init__(self, connection=None, maxInFlight=8) :
+        if connection is None :
+            connection = openConnection()
+
+        self._connection = connection
+        self._maxInFlight = max(1, int(maxInFlight))
+        self._listeners = []
+        self._unixPaths = []
+        self._clients = []
+        self._queued = collections.deque()
+        self._inFlight = collections.deque()
+        self._headStartTime = 0
+        self._transferCount = 0
+        self._droppedTransfers = 0
+        self._eventCount = 0
+
+        # Held while writing to the controller or a client and while modifying
+        # the queued and in flight transfers.
+        self._lock = threading.Lock()
+        self._closing = False
+        self._readerThread = None
+
+        # Written to by close() to wake up serveForever
+        self._wakeReader, self._wakeWriter = socket.socketpair()
+
+    def listen(self, url) :
+        """Accept clients at *url*, which is tcp://host:port or
+           unix:///path/to/socket. Returns the address of the listening
+           socket, which is useful when listening on TCP port 0."""
+        scheme, separator, rest = url.partition('://')
+        if scheme == 'tcp' :
+            host, _, port = rest.rpartition(':')
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((host, int(port)))
+        elif scheme == 'unix' :
+            if os.path.exists(rest) :
+                os.remove(rest)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(rest)
+            self._unixPaths.append(rest)
+        else :
+            raise ValueError("Unsupported bridge URL: " + url)
+
+        sock.listen(16)
+        self._listeners.append(sock)
+        return sock.getsockname()
+
+    def getClientCount(self) :
+        """Return the number of connected clients"""
+        return len(self._clients)
+
+    def getTransferCount(self) :
+        """Return the number of transfers sent to the controller"""
+        return self._transferCount
+
+    def getDroppedTransferCount(self) :
+        """Return the number of transfers that weren't sent, or whose
+           responses weren't returned, because their client had disconnected
+           or the controller didn't respond"""
+        return self._droppedTransfers
+
+    def getEventCount(self) :
+        """Return the number of events received from the controller"""
+        return self._eventCount
+
+    def serveForever(self) :
+        """Relay traffic until close() is called"""
+        self._readerThread = threading.Thread(target=self._readerLoop,
+            name='modulo-bridge-reader')
+        self._readerThread.daemon = True
+        self._readerThread.start()
+
+        try :
+            while not self._closing :
+                self._serveOnce()
+        finally :
+            self._closing = True
+            self._shutdown()
+
+    def _serveOnce(self) :
+        readable = self._listeners + self._clients + [self._wakeReader]
+        with self._lock :
+            writable = [c for c in self._clients if c.outgoing]
+
+        # Wake up often enough to expire lost responses on time, since the
+        # reader thread may be waiting for data for longer than the timeout
+        readable, writable, _ = select.select(readable, writable, [],
+            self._Timeout/2)
+
+        for s in readable :
+            if s is self._wakeReader :
+                s.recv(64)
+            elif s in self._listeners :
+                self._accept(s)
+            else :
+                self._receiveFromClient(s)
+
+        with self._lock :
+            for client in writable :
+                client.flush()
+
+            self._expireInFlight(time.time())
+
+            # Everything received from every client is sent to the
+            # controller at once
+            self._sendQueued()
+
+            for client in [c for c in self._clients if c.closed] :
+                self._removeClient(client)
+
+    def close(self) :
+        """Stop serving. Can be called from any thread."""
+        self._closing = True
+        try :
+            self._wakeWriter.send(b'x')
+        except socket.error :
+            pass
+
+    def _shutdown(self) :
+        if self._readerThread is not None :
+            self._readerThread.join()
+
+        with self._lock :
+            for client in list(self._clients) :
+                self._removeClient(client)
+
+        for sock in self._listeners :
+            sock.close()
+        for path in self._unixPaths :
+            if os.path.exists(path) :
+                os.remove(path)
+
+        self._wakeReader.close()
+        self._wakeWriter.close()
+        self._connection.close()
+
+    def _accept(self, listener) :
+        sock, address = listener.accept()
+        if sock.family == socket.AF_INET :
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        with self._lock :
+            self._clients.append(_Client(sock, address))
+
+    def _removeClient(self, client) :
+        """Must be called with the lock held"""
+        client.closed = True
+        client.socket.close()
+        self._clients.remove(client)
+
+    def _receiveFromClient(self, client) :
+        try :
+            data = client.socket.recv(self._ReadSize)
+        except (socket.error, OSError) :
+            data = None
+
+        if not data :
+            with self._lock :
+                client.closed = True
+            return
+
+        client.decoder.feed(data)
+        with self._lock :
+            frame = client.decoder.nextFrame()
+            while frame is not None :
+                code = frame[0]
+                if code == self._CodeTransfer :
+                    self._queued.append(_Request(client, frame))
+                elif code == self._CodeEcho :
+                    # Answer pings without bothering the controller
+                    client.send(_encodeFrame(frame))
+                elif code == self._CodeQuit :
+                    client.closed = True
+                    break
+
+                frame = client.decoder.nextFrame()
+
+    def _sendQueued(self) :
+        """Send as many queued transfers as possible in a single write. Must
+           be called with the lock held."""
+        now = time.time()
+        frames = []
+        while self._queued and len(self._inFlight) < self._maxInFlight :
+            request = self._queued.popleft()
+            if request.client.closed :
+                self._droppedTransfers += 1
+                continue
+
+            request.sentTime = now
+            if not self._inFlight :
+                self._headStartTime = now
+            self._inFlight.append(request)
+            frames.append(request.frame)
+
+        if frames :
+            self._transferCount += len(frames)
+            self._connection.sendFrames(frames)
+
+    def _readerLoop(self) :
+        """Receive packets from the controller and deliver them to clients"""
+        while not self._closing :
+            try :
+                packet = self._connection._receivePacket()
+            except Exception as e :
+                # The controller is gone, so there's nothing left to relay
+                print("Lost the connection to the Modulo Controller:", e)
+                self.close()
+                return
+
+            now = time.time()
+            with self._lock :
+                if packet is None :
+                    # Nothing arrived within the timeout
+                    pass
+                elif packet[0] == self._CodeReceive :
+                    if self._inFlight :
+                        self._headStartTime = now
+                        self._completeRequest(self._inFlight.popleft(), packet, now)
+                elif packet[0] == self._CodeEvent :
+                    self._eventCount += 1
+                    frame = _encodeFrame(packet)
+                    for client in self._clients :
+                        client.eventCount += 1
+                        client.send(frame)
+
+                # Check on every pass, since events may keep arriving while a
+                # response is lost
+                self._expireInFlight(now)
+                self._sendQueued()
+
+    def _completeRequest(self, request, packet, now) :
+        """Return a response to the client that sent the request. Must be
+           called with the lock held."""
+        self._recordTransfer(request, packet[2:], now)
+
+        client = request.client
+        if client.closed :
+            self._droppedTransfers += 1
+            return
+
+        client.transferCount += 1
+        client.send(_encodeFrame(packet))
+
+    def _expireInFlight(self, now) :
+        """Fail the oldest in flight transfer if its response was lost. Must be
+           called with the lock held."""
+        if self._inFlight and now - self._headStartTime > self._Timeout :
+            self._headStartTime = now
+            self._failRequest(self._inFlight.popleft(), now)
+
+    def _failRequest(self, request, now) :
+        """Send an empty response for a transfer whose response was lost, so
+           that the client matches its later responses to the right transfers.
+           Must be called with the lock held."""
+        self._recordTransfer(request, None, now)
+        self._droppedTransfers += 1
+
+        if not request.client.closed :
+            request.client.send(_encodeFrame([self._CodeReceive, request.packet[1]]))
+
+    def _recordTransfer(self, request, receiveData, now) :
+        """Add a relayed transfer to the connection's metrics. See Port.stats"""
+        packet = request.packet
+        self._connection.metrics.recordTransfer(packet[1], packet[2],
+            len(packet) - 5, receiveData, now - request.sentTime)
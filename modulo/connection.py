@@ -1,5 +1,131 @@
 from __future__ import print_function, division, absolute_import, unicode_literals
 import serial
+import collections, threading, time
+
+from modulo.metrics import TransferMetrics
+
+_Delimeter = 0x7E
+_Escape = 0x7D
+
+_DelimeterByte = bytearray([_Delimeter])
+_EscapeByte = bytearray([_Escape])
+_EscapedDelimeter = bytearray([_Escape, _Delimeter ^ (1 << 5)])
+_EscapedEscape = bytearray([_Escape, _Escape ^ (1 << 5)])
+
+def _encodeFrame(data) :
+    """Return a complete frame for *data* (bytes, bytearray, memoryview or a
+       list of ints), with the delimeter and escape bytes escaped and the
+       whole thing wrapped in delimeters."""
+    body = bytearray(data)
+
+    # Escape bytes must be handled first so that the escape bytes inserted
+    # for delimeters aren't escaped again.
+    if _Escape in body :
+        body = body.replace(_EscapeByte, _EscapedEscape)
+    if _Delimeter in body :
+        body = body.replace(_DelimeterByte, _EscapedDelimeter)
+
+    return _DelimeterByte + body + _DelimeterByte
+
+
+def _grepPorts(regexp) :
+    """This is a copy of serial.list_ports.grep that has been modified to
+       work around an error that occurs on OSX 10.10.5, where the desc
+       field is None which causes the grep to fail"""
+    import re
+    from serial.tools import list_ports
+    r = re.compile(regexp, re.I)
+    for port, desc, hwid in list_ports.comports() :
+        if r.search(hwid) :
+            yield port, desc, hwid
+
+# Strings such as device types that are shared by all ports. See Port._bytesToString
+_internedStrings = {}
+
+# Held while updating an inventory cache file. See Port._saveInventoryCache
+_inventoryCacheLock = threading.Lock()
+
+def _getControllerKey(path) :
+    """Return a string that identifies the controller at *path*. This is the
+       USB serial number if it's available, otherwise the path."""
+    import re
+    from serial.tools import list_ports
+    for port, desc, hwid in list_ports.comports() :
+        if port == path :
+            match = re.search(r'SER=(\S+)', hwid)
+            if match :
+                return 'SER=' + match.group(1)
+    return path
+
+def _findControllerPaths() :
+    """Return the paths of all Modulo Controllers connected via USB"""
+    # Modulo Controller will contain in the hardware description:
+    #    "16d0:a67" on OSX
+    #    "16D0:0A67" on Windows 71
+    return [port[0] for port in _grepPorts("16d0:0?b58")]
+
+def _findControllerPath(controller=0) :
+    """Return the path of the Modulo Controller with the specified index"""
+    from serial.tools import list_ports
+
+    paths = _findControllerPaths()
+    if controller < len(paths) :
+        return paths[controller]
+
+    print(list_ports.comports())
+    raise IOError("Couldn't find a Modulo Controller connected via USB")
+
+
+class _FrameDecoder(object) :
+    """Splits a stream of received bytes into unescaped frames. Data can be
+       fed in arbitrarily sized chunks and complete frames are returned as
+       soon as they are available."""
+
+    def __init__(self) :
+        self._buffer = bytearray()
+
+    def feed(self, data) :
+        """Append received bytes to the end of the buffer"""
+        self._buffer += data
+
+    def nextFrame(self) :
+        """Remove and return the next complete frame as a bytearray, or None
+           if a complete frame hasn't been received yet."""
+        buffer = self._buffer
+        while True :
+            start = buffer.find(_DelimeterByte)
+            if start < 0 :
+                # Nothing in the buffer can be part of a frame
+                del buffer[:]
+                return None
+
+            end = buffer.find(_DelimeterByte, start+1)
+            if end < 0 :
+                # Discard anything before the start of the partial frame
+                del buffer[:start]
+                return None
+
+            if end == start+1 :
+                # Skip over empty frames (consecutive delimeters)
+                del buffer[:end]
+                continue
+
+            frame = buffer[start+1:end]
+            del buffer[:end+1]
+            return self._unescape(frame)
+
+    def _unescape(self, frame) :
+        if _Escape not in frame :
+            return frame
+
+        parts = frame.split(_EscapeByte)
+        result = parts[0]
+        for part in parts[1:] :
+            if part :
+                part[0] ^= (1 << 5)
+            result += part
+        return result
+
 
 class Port(object) :
     """
@@ -30,29 +156,122 @@ class Port(object) :
     _StatusOn = 1
     _StatusBlinking = 2
 
-    def __init__(self, serialPortPath=None) :
+    def __init__(self, serialPortPath=None, threaded=False, inventoryCache=None,
+                 connection=None) :
+        """Open the port. If *serialPortPath* isn't specified, the first Modulo
+           Controller connected via USB is used. It can also be a URL such as
+           tcp://host:port. See openConnection for the supported URLs.
+           *connection* is an already open Connection to use instead.
+
+           *inventoryCache* is the path of a file used to store the devices
+           found by enumerate, so that the next process to open the same
+           controller can skip enumerating the bus if the devices are
+           still connected."""
         self._portInitialized = False
         self._lastAssignedAddress = 9
-        self._connection = SerialConnection(serialPortPath)
+        if connection is None :
+            connection = openConnection(serialPortPath)
+        self._connection = connection
         self._modulos = []
+        self._modulosByID = {}
+        self._modulosByAddress = {}
+        self._inventory = None
+        self._deviceTypes = {}
+        self._inventoryCachePath = inventoryCache
+        self._coalesceEvents = False
+        self._coalescedEvents = 0
+        self._eventCount = 0
+        self._eventRateSamples = collections.deque([(time.time(), 0)], 10)
+        self._statsExporters = []
+
+        # Held while binding a module to its device. See ModuloBase._init
+        self._bindingLock = threading.RLock()
+
+        # In threaded mode a background thread receives events and responses,
+        # so devices can be used from several threads at once. Callbacks are
+        # still called from whichever thread calls loop().
+        if threaded :
+            self._connection.startReaderThread()
 
         import atexit
         atexit.register(self._connection.close)
 
-    def _bytesToString(self, bytes) :
-        s = ''
-        for b in bytes :
-            if b == 0 :
-                break
-            s = s + chr(b)
-        return s
+    def transfer(self, address, command, sendData, receiveLen) :
+        """Send a transfer to the device at *address* and return the received
+           data, or None if the transfer failed"""
+        return self._connection.transfer(address, command, sendData, receiveLen)
+
+    def queueTransfer(self, address, command, sendData, receiveLen) :
+        """Send a transfer without waiting for its response. Returns a
+           PendingTransfer whose result() method waits for the received data."""
+        return self._connection.queueTransfer(address, command, sendData, receiveLen)
+
+    def _isPipelined(self) :
+        return self._connection._maxInFlight > 1
+
+    def setMaxInFlight(self, count) :
+        """Set the maximum number of transfers that can be sent to the controller
+           before waiting for their responses. When greater than 1, transfers
+           that don't receive any data (such as drawing operations or setting
+           outputs) return without waiting for the response, so they can be
+           sent as fast as the connection allows."""
+        self._connection.setMaxInFlight(count)
+
+    # What to do when an event arrives and the event queue is full.
+    # See setEventQueueLimit.
+    OverflowDropOldest = 0
+    OverflowCoalesce = 1
+    OverflowRaise = 2
+
+    def setEventQueueLimit(self, maxEvents, overflowPolicy=OverflowDropOldest) :
+        """Set the maximum number of events that can be waiting to be processed
+           by loop(), and what to do with new events when that many are waiting.
+           The policy can be OverflowDropOldest (the default), OverflowCoalesce
+           (drop the oldest event from the same device with the same event code)
+           or OverflowRaise (drop the new event and raise an IOError from loop)."""
+        self._connection.setOutOfBandLimit(maxEvents, overflowPolicy)
+
+    def getDroppedEventCount(self) :
+        """Return the number of events that have been dropped because the event
+           queue was full"""
+        return self._connection.getDroppedPacketCount()
+
+    def _bytesToString(self, data) :
+        """Convert a null terminated ascii string to a str. The result is
+           interned, so that equal strings share a single object."""
+        s = bytes(bytearray(data)).split(b'\0', 1)[0].decode('ascii', 'replace')
+        return _internedStrings.setdefault(s, s)
 
     def _findModuloByID(self, id) :
         """Find the modulo object with the specified deviceID"""
-        for m in self._modulos :
-            if (m._deviceID == id) :
-                return m
-        return None
+        return self._modulosByID.get(id)
+
+    def _findModuloByAddress(self, address) :
+        """Find the modulo object with the specified I2C address"""
+        return self._modulosByAddress.get(address)
+
+    def _addModulo(self, m) :
+        self._modulos.append(m)
+        self._indexModulo(m)
+
+    def _removeModulo(self, m) :
+        if m in self._modulos :
+            self._modulos.remove(m)
+            self._unindexModulo(m)
+
+    def _indexModulo(self, m) :
+        """Add the modulo to the deviceID and address lookup tables"""
+        if m._deviceID is not None :
+            self._modulosByID[m._deviceID] = m
+        if m._address is not None :
+            self._modulosByAddress[m._address] = m
+
+    def _unindexModulo(self, m) :
+        """Remove the modulo from the deviceID and address lookup tables"""
+        if self._modulosByID.get(m._deviceID) is m :
+            del self._modulosByID[m._deviceID]
+        if self._modulosByAddress.get(m._address) is m :
+            del self._modulosByAddress[m._address]
 
     def runForever(self) :
         """Continue to process events forever"""
@@ -62,38 +281,415 @@ class Port(object) :
     def loop(self, noWait=False) :
         """Call loop as often as possible to handle events and execute callbacks"""
         for m in self._modulos :
-            m.getAddress()
+            m._loop()
+
+        if self._statsExporters :
+            self._runStatsExporters()
+
+        if self._coalesceEvents :
+            # Receive everything that's waiting before dispatching, so that
+            # repeated position changes can be collapsed into one.
+            packets = []
+            packet = self._connection.getNextPacket(noWait)
+            while packet :
+                packets.append(packet)
+                packet = self._connection.getNextPacket(noWait=True)
+
+            for packet in self._coalescePackets(packets) :
+                self._processPacket(packet)
+
+            return bool(packets)
 
         gotPacket = False
         packet = self._connection.getNextPacket(noWait)
         while packet :
             gotPacket = True
-            if (packet[0] == self._CodeEvent) :
-                event = packet[1:]
-
-                eventCode = event[0]
-                deviceID = event[1] | (event[2] << 8)
-                eventData = event[3] | (event[4] << 8)
-
-                
-                m = self._findModuloByID(deviceID)
-                if m :
-                    m._processEvent(eventCode, eventData)
-            elif (packet[0] != self._CodeEcho) :
-                # Discard echo packet if it's received out of band
-                # No other type of packet should be received.
-                print('Invalid out of band packet: ', packet)
+            self._processPacket(packet)
 
             # Never wait when checking to see if there are additional packets
             packet = self._connection.getNextPacket(noWait=True)
 
         return gotPacket
 
+    def _processPacket(self, packet) :
+        if (packet[0] == self._CodeEvent) :
+            event = packet[1:]
+
+            eventCode = event[0]
+            deviceID = event[1] | (event[2] << 8)
+            eventData = event[3] | (event[4] << 8)
+
+            self._eventCount += 1
+            m = self._findModuloByID(deviceID)
+            if m :
+                m._processEvent(eventCode, eventData)
+        elif (packet[0] != self._CodeEcho) :
+            # Discard echo packet if it's received out of band
+            # No other type of packet should be received.
+            print('Invalid out of band packet: ', packet)
+
+    def stats(self) :
+        """Return a dict of transfer and event statistics for the port:
+
+           - transfers, timeouts: the number of transfers and how many of them
+             received no response
+           - bytesSent, bytesReceived: the bytes written to and read from the
+             controller, including framing
+           - latency: a dict with the count, min, mean, max, p50, p90, p99 and
+             p999 of the round trip times of successful transfers in seconds,
+             and the histogram buckets as a list of (upperBound, count)
+           - devices: a dict mapping each device ID (or 'broadcast', or
+             'address N' for unknown addresses) to its transfers, timeouts,
+             bytesSent and bytesReceived, and the same counters for each
+             function in a 'commands' dict
+           - events, eventsPerSecond: the number of events dispatched by loop()
+             and the rate over the last few calls to stats()
+           - outOfBandQueueDepth, maxOutOfBandQueueDepth, droppedEvents: the
+             events waiting to be dispatched, the most that have waited at
+             once, and the number dropped because the queue was full
+        """
+        connection = self._connection
+        key = connection.getKey()
+        with connection._lock :
+            metrics = connection.metrics
+            result = {
+                'controller' : key,
+                'uptime' : time.time() - metrics.startTime,
+                'transfers' : metrics.transfers,
+                'timeouts' : metrics.timeouts,
+                'bytesSent' : metrics.bytesSent,
+                'bytesReceived' : metrics.bytesReceived,
+                'packetsSent' : metrics.packetsSent,
+                'packetsReceived' : metrics.packetsReceived,
+                'latency' : metrics.latency.snapshot(),
+                'outOfBandQueueDepth' : len(connection._outOfBandPackets),
+                'maxOutOfBandQueueDepth' : metrics.maxOutOfBandDepth,
+                'droppedEvents' : connection.getDroppedPacketCount(),
+            }
+            commands = metrics.getCommandCounters()
+
+        devices = {}
+        for (address, command), counters in commands.items() :
+            device = self._getStatsDevice(address)
+            deviceStats = devices.get(device)
+            if deviceStats is None :
+                deviceStats = devices[device] = {'transfers' : 0, 'timeouts' : 0,
+                    'bytesSent' : 0, 'bytesReceived' : 0, 'commands' : {}}
+
+            deviceStats['commands'][command] = counters
+            for key in ('transfers', 'timeouts', 'bytesSent', 'bytesReceived') :
+                deviceStats[key] += counters[key]
+        result['devices'] = devices
+
+        # The event rate is measured since the oldest of the samples, which
+        # are taken at most once per second
+        now = time.time()
+        sampleTime, sampleCount = self._eventRateSamples[0]
+        result['events'] = self._eventCount
+        result['eventsPerSecond'] = (self._eventCount - sampleCount)/max(now - sampleTime, 1e-6)
+        if now - self._eventRateSamples[-1][0] >= 1 :
+            self._eventRateSamples.append((now, self._eventCount))
+
+        return result
+
+    def _getStatsDevice(self, address) :
+        if address == self._BroadcastAddress :
+            return 'broadcast'
+
+        m = self._findModuloByAddress(address)
+        if m is not None and m._deviceID is not None :
+            return m._deviceID
+
+        for info in self.getDevices() :
+            if info.address == address :
+                return info.deviceID
+        return 'address %d' % address
+
+    def addStatsExporter(self, exporter, interval=10) :
+        """Call *exporter* with the result of stats() every *interval*
+           seconds, from loop(). See modulo.metrics.PrometheusExporter"""
+        self._statsExporters.append([exporter, interval, time.time() + interval])
+
+    def removeStatsExporter(self, exporter) :
+        self._statsExporters = [e for e in self._statsExporters if e[0] is not exporter]
+
+    def _runStatsExporters(self) :
+        now = time.time()
+        stats = None
+        for entry in self._statsExporters :
+            exporter, interval, nextTime = entry
+            if now >= nextTime :
+                if stats is None :
+                    stats = self.stats()
+                entry[2] = now + interval
+                exporter(stats)
+
+    def setCoalesceEvents(self, enabled) :
+        """When enabled, each call to loop() only processes the newest of several
+           events that just report a device's current state (like a knob or
+           joystick position change). Events such as button presses and
+           releases are always processed."""
+        self._coalesceEvents = enabled
+
+    def getCoalescedEventCount(self) :
+        """Return the number of events that were skipped because a newer event
+           replaced them"""
+        return self._coalescedEvents
+
+    def _coalescePackets(self, packets) :
+        """Remove state events that are followed by a newer event with the same
+           device ID and event code. Any other event from the same device in
+           between prevents the earlier one from being removed, so callbacks
+           for that event still see the state that preceded it."""
+        result = []
+        latest = {}
+
+        for packet in packets :
+            if packet[0] == self._CodeEvent :
+                eventCode = packet[1]
+                deviceID = packet[2] | (packet[3] << 8)
+
+                m = self._findModuloByID(deviceID)
+                if m and eventCode in m._coalescableEvents :
+                    key = (deviceID, eventCode)
+                    if key in latest :
+                        result[latest[key]] = None
+                        self._coalescedEvents += 1
+                    latest[key] = len(result)
+                else :
+                    for key in [k for k in latest if k[0] == deviceID] :
+                        del latest[key]
+
+            result.append(packet)
+
+        return [packet for packet in result if packet is not None]
+
+    def enumerate(self, full=False) :
+        """Find all of the devices connected to the port and return a list of
+           DeviceInfo objects, sorted by device ID. The results are kept in the
+           port's inventory, which modules use to find their device without
+           any additional bus traffic.
+
+           Calling enumerate again only reads the type, version and address of
+           devices that weren't found before, and removes devices that are
+           no longer connected. Pass *full* to read the version and address of
+           every device again."""
+        if self._inventory is None and not full and self._loadInventoryCache() :
+            return self.getDevices()
+
+        if full or self._inventory is None :
+            self._inventory = {}
+
+        inventory = {}
+        deviceID = self._getNextDeviceID(0)
+        while deviceID is not None and deviceID not in inventory :
+            info = self._inventory.get(deviceID)
+            if info is None :
+                info = DeviceInfo(deviceID, self._getDeviceType(deviceID),
+                    self._getVersion(deviceID), self._getAddress(deviceID))
+            inventory[deviceID] = info
+
+            deviceID = self._getNextDeviceID(deviceID)
+
+        self._inventory = inventory
+        self._saveInventoryCache()
+        return self.getDevices()
+
+    def _loadInventoryCache(self) :
+        """Load the inventory from the cache file and check that each device is
+           still connected with the same address. Returns whether the cached
+           inventory was valid and complete. If it was valid but new devices
+           have been attached, the inventory is loaded but False is returned."""
+        if not self._inventoryCachePath :
+            return False
+
+        import json
+        try :
+            with open(self._inventoryCachePath) as f :
+                cache = json.load(f)
+            devices = cache[self._connection.getKey()]
+            inventory = {}
+            for d in devices :
+                deviceType = _internedStrings.setdefault(d['deviceType'], d['deviceType'])
+                inventory[d['deviceID']] = DeviceInfo(d['deviceID'], deviceType,
+                    d['version'], d['address'])
+        except (IOError, ValueError, KeyError, TypeError) :
+            return False
+
+        # Checking each address is much faster than reading all of the
+        # device types, and will find devices that have been removed, replaced
+        # or reset.
+        for info in inventory.values() :
+            if info.address is None or self._getAddress(info.deviceID) != info.address :
+                return False
+
+        self._inventory = inventory
+
+        # A device attached since the cache was written doesn't have an address
+        # yet. If there is one, the cached devices are still valid, but the bus
+        # has to be scanned to find the new one.
+        deviceID = self._getNextUnassignedDeviceID(0)
+        while deviceID is not None and deviceID != 0xFFFF and deviceID in inventory :
+            deviceID = self._getNextUnassignedDeviceID(deviceID)
+        return deviceID is None or deviceID in inventory
+
+    def _saveInventoryCache(self) :
+        if not self._inventoryCachePath or self._inventory is None :
+            return
+
+        # Ports in a PortGroup can share a cache file and enumerate at the
+        # same time.
+        with _inventoryCacheLock :
+            self._writeInventoryCache()
+
+    def _writeInventoryCache(self) :
+        import json, os
+        try :
+            with open(self._inventoryCachePath) as f :
+                cache = json.load(f)
+            if not isinstance(cache, dict) :
+                cache = {}
+        except (IOError, ValueError) :
+            cache = {}
+
+        cache[self._connection.getKey()] = [
+            {'deviceID' : info.deviceID,
+             'deviceType' : info.deviceType,
+             'version' : info.version,
+             'address' : info.address } for info in self.getDevices()]
+
+        try :
+            tempPath = self._inventoryCachePath + '.tmp'
+            with open(tempPath, 'w') as f :
+                json.dump(cache, f, indent=1)
+            if os.path.exists(self._inventoryCachePath) :
+                os.remove(self._inventoryCachePath)
+            os.rename(tempPath, self._inventoryCachePath)
+        except (IOError, OSError) :
+            pass
+
+    def getDevices(self) :
+        """Return a list of DeviceInfo objects for the devices found by the last
+           call to enumerate, sorted by device ID."""
+        if self._inventory is None :
+            return []
+        return sorted(self._inventory.values(), key=lambda info : info.deviceID)
+
+    def _findUnusedDevice(self, deviceType) :
+        """Return the ID of the first device of the specified type that isn't
+           being used by a modulo object, or None. The bus is only enumerated
+           when no matching device is already in the inventory."""
+        if self._inventory is not None :
+            deviceID = self._findUnusedInventoryDevice(deviceType)
+            if deviceID is not None :
+                return deviceID
+
+        self.enumerate()
+        return self._findUnusedInventoryDevice(deviceType)
+
+    def _findUnusedInventoryDevice(self, deviceType) :
+        for info in self.getDevices() :
+            if info.deviceType == deviceType and self._findModuloByID(info.deviceID) is None :
+                return info.deviceID
+        return None
+
+    def _getInventoryAddress(self, deviceID) :
+        """Return the I2C address of the specified device from the inventory,
+           or read it from the device if it isn't known"""
+        info = self._inventory and self._inventory.get(deviceID)
+        if info and info.address is not None :
+            return info.address
+
+        address = self._getAddress(deviceID)
+        if info :
+            info.address = address
+        return address
+
+    def assignAllAddresses(self) :
+        """Make sure that every device on the bus has a unique I2C address.
+           Devices without an address are found with a single pass over the
+           unassigned devices, and when several devices share an address all
+           but one of them are given a new one. The addresses are recorded in
+           the inventory, so modules can be bound to their devices without
+           any additional bus traffic."""
+        self.enumerate()
+
+        unassigned = []
+        deviceID = self._getNextUnassignedDeviceID(0)
+        while deviceID is not None and deviceID not in unassigned :
+            unassigned.append(deviceID)
+            deviceID = self._getNextUnassignedDeviceID(deviceID)
+
+        # Another port (possibly in another process) may have given devices
+        # an address since they were enumerated
+        for info in self._inventory.values() :
+            if info.address in (None, 0, 127) and info.deviceID not in unassigned :
+                info.address = self._getAddress(info.deviceID)
+
+        needsAddress = []
+
+        # Find devices that share an address. The device that a modulo object
+        # is already using keeps its address.
+        devicesByAddress = {}
+        for info in self.getDevices() :
+            if info.address not in (None, 0, 127) :
+                devicesByAddress.setdefault(info.address, []).append(info.deviceID)
+
+        for address, deviceIDs in devicesByAddress.items() :
+            if len(deviceIDs) > 1 :
+                m = self._findModuloByAddress(address)
+                if m is not None and m._deviceID in deviceIDs :
+                    keep = m._deviceID
+                else :
+                    keep = deviceIDs[0]
+                needsAddress.extend(d for d in deviceIDs if d != keep)
+
+        needsAddress.extend(d for d in unassigned if d not in needsAddress)
+
+        for deviceID in needsAddress :
+            address = self._pickAddress()
+            sendData = [deviceID & 0xFF, deviceID >> 8, address]
+            self._connection.queueTransfer(self._BroadcastAddress,
+                self._BroadcastCommandSetAddress, sendData, 0)
+
+            if deviceID in self._inventory :
+                self._inventory[deviceID].address = address
+
+            m = self._findModuloByID(deviceID)
+            if m is not None and m._address is not None :
+                m._setBinding(deviceID, address)
+
+        self._connection.waitForTransfers()
+        self._saveInventoryCache()
+
+    def _pickAddress(self, used=()) :
+        """Return an I2C address that isn't used by any known device or in
+           *used*"""
+        used = set(used)
+        used.update(self._modulosByAddress)
+        if self._inventory :
+            used.update(info.address for info in self._inventory.values())
+
+        # Addresses up to the broadcast address and 127 are reserved. Start
+        # after the last assigned address and wrap around.
+        first = self._BroadcastAddress+1
+        count = 127 - first
+        for i in range(count) :
+            address = first + (self._lastAssignedAddress + 1 + i - first) % count
+            if address not in used :
+                self._lastAssignedAddress = address
+                return address
+
+        raise IOError("There are no I2C addresses available")
+
     def _globalReset(self) :
         """Reset all modulos to their initial state"""
         self._connection.transfer(self._BroadcastAddress, self._BroadcastCommandGlobalReset, [], 0)
 
-        for m in modulos :
+        # Resetting clears the address of every device
+        self._inventory = None
+
+        for m in self._modulos :
             m._reset()
 
     def _exitBootloader(self) :
@@ -127,13 +723,17 @@ class Port(object) :
         resultData = self._connection.transfer(
             self._BroadcastAddress, self._BroadcastCommandGetNextUnassignedDeviceID, sendData, 2)
         if resultData :
-            resultData[1] | (resultData[0] << 8)
+            return resultData[1] | (resultData[0] << 8)
 
     def _setAddress(self, deviceID, address) :
         """Set the I2C address of the modulo with the specified ID"""
         sendData = [deviceID & 0xFF, deviceID >> 8, address]
         self._connection.transfer(self._BroadcastAddress, self._BroadcastCommandSetAddress,
             sendData, 0)
+
+        if self._inventory and deviceID in self._inventory :
+            self._inventory[deviceID].address = address
+            self._saveInventoryCache()
     
     def _getAddress(self, deviceID) :
         """Get the I2C address of the modulo with the specified ID"""
@@ -161,42 +761,143 @@ class Port(object) :
 
     def _getDeviceType(self, deviceID) :
         """Get the device type string of the modulo with the specified ID"""
+        # A device's type never changes, so it only needs to be read once
+        deviceType = self._deviceTypes.get(deviceID)
+        if deviceType is not None :
+            return deviceType
+
         sendData = [deviceID & 0xFF, deviceID >> 8]
         resultData = self._connection.transfer(
             self._BroadcastAddress, self._BroadcastCommandGetDeviceType, sendData, 31)
-        return self._bytesToString(resultData)
+        if resultData is None :
+            return None
 
+        deviceType = self._bytesToString(resultData)
 
-class SerialConnection(object) :
-    _Delimeter = 0x7E
-    _Escape = 0x7D
+        # There's no type if no device has the ID (yet), so don't remember that
+        if deviceType :
+            self._deviceTypes[deviceID] = deviceType
+        return deviceType
+
+
+class DeviceInfo(object) :
+    """
+    Information about a device connected to a Port. See Port.enumerate
+    """
+
+    def __init__(self, deviceID, deviceType, version, address) :
+        self.deviceID = deviceID
+        """The device's unique ID"""
+
+        self.deviceType = deviceType
+        """The device type string, such as 'co.modulo.knob'"""
+
+        self.version = version
+        """The device's firmware version"""
+
+        self.address = address
+        """The device's I2C address. 0 or 127 if it hasn't been assigned."""
+
+    def __repr__(self) :
+        return 'DeviceInfo(%r, %r, %r, %r)' % (self.deviceID, self.deviceType,
+            self.version, self.address)
+
+
+class PendingTransfer(object) :
+    """
+    A transfer that has been sent to the controller, but whose response may not
+    have been received yet. These are returned by Connection.queueTransfer
+    and ModuloBase.queueTransfer.
+    """
+
+    def __init__(self, connection, done=False, address=None, command=None,
+                 sendSize=0) :
+        self._connection = connection
+        self._done = done
+        self._result = None
+        self._sentTime = time.time()
+        self._address = address
+        self._command = command
+        self._sendSize = sendSize
+
+    def done(self) :
+        """Return whether the response has been received"""
+        return self._done
+
+    def result(self) :
+        """Wait for the response and return the received data, or None if the
+           transfer failed"""
+        if not self._done :
+            self._connection._waitForTransfer(self)
+        return self._result
+
+    def _complete(self, result) :
+        self._result = result
+        self._done = True
+
+
+class Connection(object) :
+    """
+    A connection to a Modulo Controller over a stream of bytes. The stream is
+    any object with the same read, write, inWaiting, flush and close methods
+    as serial.Serial, where read returns an empty string if nothing arrives
+    within the timeout. Subclasses open streams over different transports.
+    See openConnection.
+
+    The interface used by Port is sendPacket, getNextPacket, transfer,
+    queueTransfer, waitForTransfers, getKey and close.
+    """
+
+    _Delimeter = _Delimeter
+    _Escape = _Escape
 
     _CodeEcho = ord('X')
     _CodeTransfer = ord('T')
     _CodeReceive = ord('R')
     _CodeQuit = ord('Q')
 
-    def __init__(self, path=None, controller=0) :
-        super(SerialConnection, self).__init__()
+    _Timeout = .1
 
-        if path is None :
-            from serial.tools import list_ports
+    # What to do when a packet arrives and the out of band queue is full
+    OverflowDropOldest = Port.OverflowDropOldest
+    OverflowCoalesce = Port.OverflowCoalesce
+    OverflowRaise = Port.OverflowRaise
 
-            # Modulo Controller will contain in the hardware description:
-            #    "16d0:a67" on OSX
-            #    "16D0:0A67" on Windows 71
-            for port in self._grepPorts("16d0:0?b58") :
-                if (controller == 0) :
-                    path = port[0]
-                    break
-                controller -= 1
+    def __init__(self, stream, key=None) :
+        """Connect to the controller at the other end of *stream*. *key* is a
+           string that identifies the controller. See getKey."""
+        super(Connection, self).__init__()
 
-        if path is None :
-            print(list_ports.comports())
-            raise IOError("Couldn't find a Modulo Controller connected via USB")
+        self._stream = stream
+        self._key = key
+        self._closed = False
+        self._decoder = _FrameDecoder()
+        self._outOfBandPackets = collections.deque()
+        self._maxOutOfBandPackets = 1000
+        self._overflowPolicy = self.OverflowDropOldest
+        self._overflowed = False
+        self._droppedPackets = 0
+        self._pendingTransfers = collections.deque()
+        self._maxInFlight = 1
+
+        # When the oldest pending transfer became the oldest. The controller
+        # handles transfers one at a time, so the transfers behind it can't
+        # have been lost until it has been waiting for longer than the timeout.
+        self._headStartTime = 0
 
-        self._serial = serial.Serial(path, timeout=.1)
-        self._outOfBandPackets = []
+        self.metrics = TransferMetrics()
+        """Counters for the transfers and bytes sent and received. See Port.stats"""
+
+        # Held while sending and while modifying the pending transfers and out
+        # of band packets, so that several threads can share the connection.
+        self._lock = threading.RLock()
+        self._condition = threading.Condition(self._lock)
+        self._readerThread = None
+        self._closing = False
+
+        # The exception that stopped the reader thread, if any. It's raised
+        # again by transfers and getNextPacket.
+        self._readerError = None
 
         # The arduino samd usb serial implementation seems to swallow some
         # initial data when the connection is being set up. To work around this,
@@ -205,86 +906,444 @@ class SerialConnection(object) :
         while not self.getNextPacket() :
             self.sendPacket([self._CodeEcho])
 
-    def _grepPorts(self, regexp) :
-        """This is a copy of serial.list_ports.grep that has been modified to
-           work around an error that occurs on OSX 10.10.5, where the desc
-           field is None which causes the grep to fail"""
-        import re
-        from serial.tools import list_ports
-        r = re.compile(regexp, re.I)
-        for port, desc, hwid in list_ports.comports() :
-            if r.search(hwid) :
-                yield port, desc, hwid
+    def getKey(self) :
+        """Return a string that identifies the controller, such as its USB
+           serial number"""
+        return self._key
 
-    def sendPacket(self, data) :
-    
-        packet = []
-        for x in data :
-            if x == self._Delimeter or x == self._Escape :
-                packet.append(self._Escape)
-                packet.append(x ^ (1 << 5))
+    def startReaderThread(self) :
+        """Start a background thread that receives all packets from the
+           controller. Responses are delivered to the threads waiting on them
+           and events are queued for getNextPacket as soon as they arrive, so
+           any number of threads can call transfer concurrently."""
+        with self._lock :
+            if self._readerThread is not None :
+                return
+
+            self._readerThread = threading.Thread(target=self._readerLoop,
+                name='modulo-reader')
+            self._readerThread.daemon = True
+            self._readerThread.start()
+
+    def _readerLoop(self) :
+        while not self._closing :
+            try :
+                packet = self._receivePacket()
+            except Exception as e :
+                # The stream is broken (for instance the controller was
+                # unplugged), so nothing waiting on a response will get one.
+                with self._condition :
+                    self._readerError = e
+                    while self._pendingTransfers :
+                        self._completeTransfer(None)
+                    self._condition.notify_all()
+                return
+
+            with self._condition :
+                if packet is not None and packet[0] == self._CodeReceive :
+                    self._completeTransfer(packet[2:])
+                elif packet is not None :
+                    self._queueOutOfBandPacket(packet)
+
+                # Expire lost responses even when other packets keep arriving
+                self._expireTransfers()
+                self._condition.notify_all()
+
+    def _checkReaderError(self) :
+        """Raise the error that stopped the reader thread, if there was one.
+           Must be called with the lock held."""
+        if self._readerError is not None :
+            raise self._readerError
+
+    def _expireTransfers(self) :
+        """Fail the oldest pending transfer if it has waited longer than the
+           timeout for its response. Must be called with the lock held."""
+        if (self._pendingTransfers and
+                time.time() - self._headStartTime > self._Timeout) :
+            self._completeTransfer(None)
+
+    def setOutOfBandLimit(self, maxPackets, overflowPolicy=OverflowDropOldest) :
+        """Set the maximum number of events and other out of band packets that
+           can be queued, and what to do when a packet arrives and the queue is
+           full:
+
+           OverflowDropOldest discards the oldest queued packet.
+
+           OverflowCoalesce discards the oldest queued event with the same
+           device and event code as the new one, or the oldest packet if there
+           isn't one.
+
+           OverflowRaise discards the new packet and raises an IOError from the
+           next call to getNextPacket."""
+        with self._lock :
+            self._maxOutOfBandPackets = max(1, int(maxPackets))
+            self._overflowPolicy = overflowPolicy
+
+            while len(self._outOfBandPackets) > self._maxOutOfBandPackets :
+                self._outOfBandPackets.popleft()
+                self._droppedPackets += 1
+
+    def getDroppedPacketCount(self) :
+        """Return the number of out of band packets discarded because the queue
+           was full"""
+        return self._droppedPackets
+
+    def _queueOutOfBandPacket(self, packet) :
+        """Add a packet to the out of band queue. Must be called with the lock held"""
+        queue = self._outOfBandPackets
+        if len(queue) >= self._maxOutOfBandPackets :
+            self._droppedPackets += 1
+
+            if self._overflowPolicy == self.OverflowRaise :
+                self._overflowed = True
+                return
+
+            if self._overflowPolicy == self.OverflowCoalesce :
+                # Events that have the same code, event code and device ID
+                # begin with the same 4 bytes
+                key = packet[:4]
+                for i, queuedPacket in enumerate(queue) :
+                    if queuedPacket[:4] == key :
+                        del queue[i]
+                        break
+                else :
+                    queue.popleft()
             else :
-                packet.append(x)
+                queue.popleft()
 
-        self._serial.write([self._Delimeter] + packet + [self._Delimeter])
-        
-    def transfer(self, address, command, sendData, receiveLen) :
+        queue.append(packet)
+        self.metrics.recordOutOfBandDepth(len(queue))
+
+    def setMaxInFlight(self, count) :
+        """Set the maximum number of transfers that may be sent before waiting
+           for their responses. The default of 1 waits for the response to
+           each transfer before sending the next one."""
+        self._maxInFlight = max(1, int(count))
+
+    def queueTransfer(self, address, command, sendData, receiveLen) :
+        """Send a transfer without waiting for its response and return a
+           PendingTransfer that can be used to retrieve the result. If the
+           maximum number of transfers are already in flight, this first
+           waits for the oldest one to complete."""
         if address is None :
-            return None
+            return PendingTransfer(self, done=True)
+
+        sendBuffer = bytearray([self._CodeTransfer, address, command, len(sendData),
+            receiveLen])
+        sendBuffer += bytearray(sendData)
+
+        with self._lock :
+            self._checkReaderError()
+            while len(self._pendingTransfers) >= self._maxInFlight :
+                self._receiveResponse()
+
+            self.sendPacket(sendBuffer)
+
+            pendingTransfer = PendingTransfer(self, address=address,
+                command=command, sendSize=len(sendData))
+            if not self._pendingTransfers :
+                self._headStartTime = pendingTransfer._sentTime
+            self._pendingTransfers.append(pendingTransfer)
+        return pendingTransfer
+
+    def transfer(self, address, command, sendData, receiveLen) :
+        return self.queueTransfer(address, command, sendData, receiveLen).result()
+
+    def waitForTransfers(self) :
+        """Wait until the responses to all queued transfers have been received"""
+        with self._lock :
+            while self._pendingTransfers :
+                self._receiveResponse()
+
+    def _waitForTransfer(self, pendingTransfer) :
+        with self._lock :
+            while not pendingTransfer._done :
+                self._receiveResponse()
 
-        sendBuffer = [self._CodeTransfer, address, command, len(sendData),
-            receiveLen] + sendData
+    def _receiveResponse(self) :
+        """Receive packets until a response arrives and use it to complete the
+           oldest pending transfer. Responses are always received in the same
+           order that the transfers were sent. Other packets are queued in the
+           out of band packet list.
 
-        self.sendPacket(sendBuffer)
+           When the reader thread is running, this just waits for it to receive
+           something. Must be called with the lock held."""
+        if self._readerThread is not None :
+            self._checkReaderError()
+            self._condition.wait(self._Timeout)
+            return
 
-        # Receive packets and queue them in the out of band packet list until
-        # we receive a response packet.
         receiveData = self._receivePacket()
         while (receiveData != None and receiveData[0] != self._CodeReceive) :
-            self._outOfBandPackets.append(receiveData)
+            self._queueOutOfBandPacket(receiveData)
             receiveData = self._receivePacket()
 
         if receiveData is None :
-            return None
+            self._completeTransfer(None)
+        else :
+            self._completeTransfer(receiveData[2:])
 
-        return receiveData[2:]
+    def _completeTransfer(self, receiveData) :
+        if self._pendingTransfers :
+            pendingTransfer = self._pendingTransfers.popleft()
+            self._headStartTime = time.time()
+            self.metrics.recordTransfer(pendingTransfer._address,
+                pendingTransfer._command, pendingTransfer._sendSize, receiveData,
+                time.time() - pendingTransfer._sentTime)
+            pendingTransfer._complete(receiveData)
 
     def getNextPacket(self, noWait=False) :
-        if noWait and (not self._outOfBandPackets) and (self._serial.inWaiting() == 0):
-            return None
+        with self._lock :
+            self._checkReaderError()
+            if self._readerThread is not None and not noWait :
+                deadline = time.time() + self._Timeout
+                while not self._outOfBandPackets and time.time() < deadline :
+                    self._condition.wait(deadline - time.time())
+                    self._checkReaderError()
 
-        if self._outOfBandPackets :
-            p = self._outOfBandPackets[0]
-            self._outOfBandPackets = self._outOfBandPackets[1:]
-            return p
-        else :
-            return self._receivePacket()
+            if self._overflowed :
+                self._overflowed = False
+                raise IOError("Out of band packet queue overflowed")
+
+            if self._outOfBandPackets :
+                return self._outOfBandPackets.popleft()
+
+            if self._readerThread is not None :
+                return None
+
+            # Responses to queued transfers may arrive while looking for events
+            packet = self._receivePacket(noWait)
+            while packet is not None and packet[0] == self._CodeReceive :
+                self._completeTransfer(packet[2:])
+                packet = self._receivePacket(noWait)
+            return packet
+
+    def sendPacket(self, data) :
+        frame = _encodeFrame(data)
+        with self._lock :
+            self._stream.write(frame)
+            self.metrics.recordSend(len(frame))
+
+    def sendFrames(self, frames) :
+        """Send several already encoded packets (see _encodeFrame) in a single
+           write"""
+        with self._lock :
+            self._stream.write(b''.join(bytes(frame) for frame in frames))
+            for frame in frames :
+                self.metrics.recordSend(len(frame))
 
     def close(self) :
-        self.sendPacket([self._CodeQuit])
-        self._serial.flush();
+        if self._closed :
+            return
+        self._closed = True
 
-    def _readByte(self) :
-        c = self._serial.read()
-        if c:
-            return ord(c)
+        # There's no point saying goodbye over a broken stream
+        if self._readerError is None :
+            try :
+                self.waitForTransfers()
+                self.sendPacket([self._CodeQuit])
+                self._stream.flush();
+            except (IOError, OSError) :
+                pass
+
+        if self._readerThread is not None :
+            self._closing = True
+            self._readerThread.join()
+
+        self._stream.close()
+
+    def _receivePacket(self, noWait=False) :
+        """Return the next packet, reading as many bytes as are available at a
+           time. Returns None if the read times out (or if *noWait* is True
+           and no complete packet has been received yet)."""
+        frame = self._decoder.nextFrame()
+        while frame is None :
+            waiting = self._stream.inWaiting()
+            if noWait and waiting == 0 :
+                return None
+
+            data = self._stream.read(max(waiting, 1))
+            if not data :
+                return None
+
+            self.metrics.recordReceive(len(data))
+            self._decoder.feed(data)
+            frame = self._decoder.nextFrame()
+
+        self.metrics.recordPacket()
+        return list(frame)
+
+
+class SerialConnection(Connection) :
+    """A connection to a Modulo Controller through pyserial"""
+
+    def __init__(self, path=None, controller=0) :
+        """Open the Modulo Controller at *path*, or the one with the specified
+           index if *path* is None."""
+        if path is None :
+            path = _findControllerPath(controller)
+
+        self._path = path
+        super(SerialConnection, self).__init__(
+            serial.Serial(path, timeout=self._Timeout), _getControllerKey(path))
+
+
+class FDConnection(Connection) :
+    """A connection to a Modulo Controller that reads and writes the serial
+       device directly with os.read and os.write, without pyserial. Only
+       available on POSIX systems."""
+
+    def __init__(self, path) :
+        self._path = path
+        super(FDConnection, self).__init__(_FDStream(path, self._Timeout),
+            _getControllerKey(path))
+
+
+class TCPConnection(Connection) :
+    """A connection to a Modulo Controller whose serial stream is shared over
+       TCP, for instance by modulo-bridge"""
+
+    def __init__(self, host, port) :
+        import socket
+        sock = socket.create_connection((host, port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        super(TCPConnection, self).__init__(_SocketStream(sock, self._Timeout),
+            key='tcp://%s:%d' % (host, port))
 
-    def _receivePacket(self) :
-        c = self._readByte()
-        if (c is None) :
-            return None
 
-        while (c != self._Delimeter and c is not None) :
-            c = self._readByte()
+class UnixConnection(Connection) :
+    """A connection to a Modulo Controller whose serial stream is shared over
+       a Unix domain socket, for instance by modulo-bridge"""
 
-        while (c == self._Delimeter) :
-            c = self._readByte()
+    def __init__(self, path) :
+        import socket
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        super(UnixConnection, self).__init__(_SocketStream(sock, self._Timeout),
+            key='unix://' + path)
 
-        data = []
-        while (c != self._Delimeter and c is not None) :
-            if (c == self._Escape) :
-                c = self._readByte() ^ (1 << 5)
-            data.append(c)
-            c = self._readByte()
 
+class LoopbackConnection(Connection) :
+    """A connection to an in-memory simulated controller. See
+       modulo.simulator."""
+
+    def __init__(self, controller=None) :
+        from modulo.simulator import SimulatedController
+        if controller is None :
+            controller = SimulatedController()
+
+        self.controller = controller
+        """The SimulatedController. Add simulated devices to it."""
+
+        super(LoopbackConnection, self).__init__(controller.openStream(),
+            key='loop://')
+
+
+def openConnection(url=None, controller=0) :
+    """Open a connection to a Modulo Controller. *url* can be:
+
+       - None, to use the Modulo Controller with the index *controller*
+       - A serial port path, or serial:///dev/ttyACM0, to use pyserial
+       - fd:///dev/ttyACM0, to use the serial port with plain file
+         descriptor I/O (POSIX only)
+       - tcp://host:port, to connect to a controller shared over TCP
+       - unix:///path/to/socket, to connect to a controller shared over a
+         Unix domain socket
+       - loop://, to connect to a simulated controller
+    """
+    if url is None :
+        return SerialConnection(None, controller)
+
+    scheme, separator, rest = url.partition('://')
+    if not separator :
+        return SerialConnection(url)
+    if scheme == 'serial' :
+        return SerialConnection(rest)
+    if scheme == 'fd' :
+        return FDConnection(rest)
+    if scheme == 'tcp' :
+        host, _, port = rest.rpartition(':')
+        return TCPConnection(host, int(port))
+    if scheme == 'unix' :
+        return UnixConnection(rest)
+    if scheme == 'loop' :
+        return LoopbackConnection()
+
+    raise ValueError("Unsupported connection URL: " + url)
+
+
+class _FDStream(object) :
+    """A serial port stream using os.read and os.write"""
+
+    def __init__(self, path, timeout) :
+        import os, tty
+        self._fd = os.open(path, os.O_RDWR | os.O_NOCTTY)
+        if os.isatty(self._fd) :
+            tty.setraw(self._fd)
+        self.timeout = timeout
+        self.name = path
+
+    def write(self, data) :
+        import os
+        data = memoryview(bytes(data))
+        while data :
+            data = data[os.write(self._fd, data):]
+
+    def inWaiting(self) :
+        import fcntl, struct, termios
+        result = fcntl.ioctl(self._fd, termios.FIONREAD, struct.pack(str('I'), 0))
+        return struct.unpack(str('I'), result)[0]
+
+    def read(self, size=1) :
+        import os, select
+        if not select.select([self._fd], [], [], self.timeout)[0] :
+            return b''
+        return os.read(self._fd, size)
+
+    def flush(self) :
+        import os, termios
+        if os.isatty(self._fd) :
+            termios.tcdrain(self._fd)
+
+    def close(self) :
+        import os
+        os.close(self._fd)
+
+
+class _SocketStream(object) :
+    """A stream over a connected socket"""
+
+    # The size of each read when data is available
+    _ReadSize = 4096
+
+    def __init__(self, sock, timeout) :
+        sock.settimeout(timeout)
+        self._socket = sock
+
+    def write(self, data) :
+        self._socket.sendall(bytes(data))
+
+    def inWaiting(self) :
+        # The number of bytes isn't available, so just report whether
+        # there are any.
+        import select
+        if select.select([self._socket], [], [], 0)[0] :
+            return self._ReadSize
+        return 0
+
+    def read(self, size=1) :
+        import socket
+        try :
+            data = self._socket.recv(size)
+        except socket.timeout :
+            return b''
+
+        if not data :
+            raise IOError("The connection to the Modulo Controller was closed")
         return data
+
+    def flush(self) :
+        pass
+
+    def close(self) :
+        self._socket.close()
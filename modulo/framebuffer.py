@@ -0,0 +1,407 @@
+"""
+A host side framebuffer for the Modulo Display.
+
+A FrameBuffer has the same drawing methods as a Display. Drawing is done both
+into a copy of the screen kept on the host and into a list of ops. When the
+frame is refreshed, either the ops are sent or just the rows of pixels that
+changed since the last frame are sent, whichever takes fewer bytes. This is a
+big win for content that changes in many small places, like plots and
+sparklines::
+
+    fb = FrameBuffer(display)
+    for x in range(fb.width) :
+        fb.drawLine(x, 32, x, 32-samples[x])
+    fb.refresh()
+"""
+
+from __future__ import print_function, division, absolute_import, unicode_literals
+from array import array
+import math
+
+from modulo.modulos import _clip
+
+# A 5x7 font covering printable ASCII (32 to 126). Each character is 5
+# columns, with the top row in the least significant bit.
+_Font = bytearray([
+    0x00,0x00,0x00,0x00,0x00, 0x00,0x00,0x5F,0x00,0x00, 0x00,0x07,0x00,0x07,0x00, 0x14,0x7F,0x14,0x7F,0x14,
+    0x24,0x2A,0x7F,0x2A,0x12, 0x23,0x13,0x08,0x64,0x62, 0x36,0x49,0x55,0x22,0x50, 0x00,0x05,0x03,0x00,0x00,
+    0x00,0x1C,0x22,0x41,0x00, 0x00,0x41,0x22,0x1C,0x00, 0x14,0x08,0x3E,0x08,0x14, 0x08,0x08,0x3E,0x08,0x08,
+    0x00,0x50,0x30,0x00,0x00, 0x08,0x08,0x08,0x08,0x08, 0x00,0x60,0x60,0x00,0x00, 0x20,0x10,0x08,0x04,0x02,
+    0x3E,0x51,0x49,0x45,0x3E, 0x00,0x42,0x7F,0x40,0x00, 0x42,0x61,0x51,0x49,0x46, 0x21,0x41,0x45,0x4B,0x31,
+    0x18,0x14,0x12,0x7F,0x10, 0x27,0x45,0x45,0x45,0x39, 0x3C,0x4A,0x49,0x49,0x30, 0x01,0x71,0x09,0x05,0x03,
+    0x36,0x49,0x49,0x49,0x36, 0x06,0x49,0x49,0x29,0x1E, 0x00,0x36,0x36,0x00,0x00, 0x00,0x56,0x36,0x00,0x00,
+    0x08,0x14,0x22,0x41,0x00, 0x14,0x14,0x14,0x14,0x14, 0x00,0x41,0x22,0x14,0x08, 0x02,0x01,0x51,0x09,0x06,
+    0x32,0x49,0x79,0x41,0x3E, 0x7E,0x11,0x11,0x11,0x7E, 0x7F,0x49,0x49,0x49,0x36, 0x3E,0x41,0x41,0x41,0x22,
+    0x7F,0x41,0x41,0x22,0x1C, 0x7F,0x49,0x49,0x49,0x41, 0x7F,0x09,0x09,0x09,0x01, 0x3E,0x41,0x49,0x49,0x7A,
+    0x7F,0x08,0x08,0x08,0x7F, 0x00,0x41,0x7F,0x41,0x00, 0x20,0x40,0x41,0x3F,0x01, 0x7F,0x08,0x14,0x22,0x41,
+    0x7F,0x40,0x40,0x40,0x40, 0x7F,0x02,0x0C,0x02,0x7F, 0x7F,0x04,0x08,0x10,0x7F, 0x3E,0x41,0x41,0x41,0x3E,
+    0x7F,0x09,0x09,0x09,0x06, 0x3E,0x41,0x51,0x21,0x5E, 0x7F,0x09,0x19,0x29,0x46, 0x46,0x49,0x49,0x49,0x31,
+    0x01,0x01,0x7F,0x01,0x01, 0x3F,0x40,0x40,0x40,0x3F, 0x1F,0x20,0x40,0x20,0x1F, 0x3F,0x40,0x38,0x40,0x3F,
+    0x63,0x14,0x08,0x14,0x63, 0x07,0x08,0x70,0x08,0x07, 0x61,0x51,0x49,0x45,0x43, 0x00,0x7F,0x41,0x41,0x00,
+    0x02,0x04,0x08,0x10,0x20, 0x00,0x41,0x41,0x7F,0x00, 0x04,0x02,0x01,0x02,0x04, 0x40,0x40,0x40,0x40,0x40,
+    0x00,0x01,0x02,0x04,0x00, 0x20,0x54,0x54,0x54,0x78, 0x7F,0x48,0x44,0x44,0x38, 0x38,0x44,0x44,0x44,0x20,
+    0x38,0x44,0x44,0x48,0x7F, 0x38,0x54,0x54,0x54,0x18, 0x08,0x7E,0x09,0x01,0x02, 0x0C,0x52,0x52,0x52,0x3E,
+    0x7F,0x08,0x04,0x04,0x78, 0x00,0x44,0x7D,0x40,0x00, 0x20,0x40,0x44,0x3D,0x00, 0x7F,0x10,0x28,0x44,0x00,
+    0x00,0x41,0x7F,0x40,0x00, 0x7C,0x04,0x18,0x04,0x78, 0x7C,0x08,0x04,0x04,0x78, 0x38,0x44,0x44,0x44,0x38,
+    0x7C,0x14,0x14,0x14,0x08, 0x08,0x14,0x14,0x18,0x7C, 0x7C,0x08,0x04,0x04,0x08, 0x48,0x54,0x54,0x54,0x20,
+    0x04,0x3F,0x44,0x40,0x20, 0x3C,0x40,0x40,0x20,0x7C, 0x1C,0x20,0x40,0x20,0x1C, 0x3C,0x40,0x30,0x40,0x3C,
+    0x44,0x28,0x10,0x28,0x44, 0x0C,0x50,0x50,0x50,0x3C, 0x44,0x64,0x54,0x4C,0x44, 0x00,0x08,0x36,0x41,0x00,
+    0x00,0x00,0x7F,0x00,0x00, 0x00,0x41,0x36,0x08,0x00, 0x08,0x04,0x08,0x10,0x08,
+])
+
+_White = 0xFFFFFF
+_Black = 0x000000
+
+def _toPixel(r, g, b, a=1) :
+    """Convert a color to a 0xRRGGBB pixel value, or None if it's transparent"""
+    if a <= 0 :
+        return None
+    r,g,b = [int(255*_clip(x,0,1)) for x in (r,g,b)]
+    return (r << 16) | (g << 8) | b
+
+
+class FrameBuffer(object) :
+    """
+    Draws on a Display by way of a copy of the screen kept on the host. Use it
+    in place of the Display for all drawing. The copy is only accurate if all
+    drawing goes through the FrameBuffer. Text is drawn with a host copy of
+    the display's font, which may differ from it in a few characters. The
+    screen is assumed to be black when the FrameBuffer is created.
+    """
+
+    # The size in bytes of each op, for choosing how to send a frame
+    _OpSizes = {
+        'clear' : 1, 'setLineColor' : 5, 'setFillColor' : 5, 'setTextColor' : 5,
+        'setCursor' : 3, 'setTextSize' : 2, 'fillScreen' : 5, 'drawLine' : 5,
+        'drawRect' : 6, 'drawTriangle' : 7, 'drawCircle' : 4,
+    }
+
+    def __init__(self, display) :
+        self._display = display
+
+        self.width = display.width
+        """The width of the display in pixels"""
+
+        self.height = display.height
+        """The height of the display in pixels"""
+
+        # The frame being drawn and the frame that's on the display
+        self._pixels = array('L', [_Black])*(self.width*self.height)
+        self._shown = array('L', self._pixels)
+
+        self._ops = []
+        self._opsSize = 0
+        self._lastFrameSize = 0
+        self._lastFrameUsedOps = True
+
+        self._resetState()
+        self._frameState = self._getState()
+
+    def _resetState(self) :
+        self._lineColor = (1, 1, 1, 1)
+        self._fillColor = (1, 1, 1, 1)
+        self._textColor = (1, 1, 1, 1)
+        self._cursor = (0, 0)
+        self._textSize = 1
+
+    def _getState(self) :
+        return (self._lineColor, self._fillColor, self._textColor, self._cursor,
+            self._textSize)
+
+    def _record(self, name, *args) :
+        self._ops.append((name, args))
+        if name == 'write' :
+            self._opsSize += len(args[0]) + 2
+        else :
+            self._opsSize += self._OpSizes[name]
+
+    def getPixel(self, x, y) :
+        """Return the (r, g, b) color of a pixel in the frame being drawn, with
+           each component between 0 and 255"""
+        pixel = self._pixels[y*self.width + x]
+        return (pixel >> 16, (pixel >> 8) & 0xFF, pixel & 0xFF)
+
+    def getLastFrameSize(self) :
+        """Return the number of op bytes that were sent for the last frame"""
+        return self._lastFrameSize
+
+    def getLastFrameUsedOps(self) :
+        """Return True if the last frame was sent as drawing ops, or False if
+           the changed pixels were sent instead"""
+        return self._lastFrameUsedOps
+
+    def clear(self) :
+        """Fill the screen with black, set the line, fill, and text colors to
+           white, and return the cursor to (0,0)"""
+        self._record('clear')
+        self._fill(_Black)
+        self._resetState()
+
+    def setLineColor(self, r, g, b, a=1) :
+        """Set the current line color."""
+        self._record('setLineColor', r, g, b, a)
+        self._lineColor = (r, g, b, a)
+
+    def setFillColor(self, r, g, b, a=1) :
+        """Set the current fill color"""
+        self._record('setFillColor', r, g, b, a)
+        self._fillColor = (r, g, b, a)
+
+    def setTextColor(self, r, g, b, a=1) :
+        """Set the current text color"""
+        self._record('setTextColor', r, g, b, a)
+        self._textColor = (r, g, b, a)
+
+    def setCursor(self, x, y) :
+        """Set the cursor position, which is where the next text will be drawn."""
+        self._record('setCursor', x, y)
+        self._cursor = (int(x), int(y))
+
+    def setTextSize(self, size) :
+        """Set the text size. This is a multiplier of the base text size,
+           which is 8px high."""
+        self._record('setTextSize', size)
+        self._textSize = int(size)
+
+    def fillScreen(self, r, g, b) :
+        """Fill the screen"""
+        self._record('fillScreen', r, g, b)
+        self._fill(_toPixel(r, g, b))
+
+    def drawLine(self, x0, y0, x1, y1) :
+        """Draw a line segment from (x0,y0) to (x1,y1)"""
+        self._record('drawLine', x0, y0, x1, y1)
+
+        color = _toPixel(*self._lineColor)
+        if color is not None :
+            self._line(int(x0), int(y0), int(x1), int(y1), color)
+
+    def drawRect(self, x, y, w, h, r=0) :
+        """Draw a rectangle with the upper left corner at (x,y) and the
+           specified width, height, and corner radius."""
+        self._record('drawRect', x, y, w, h, r)
+
+        x, y, w, h = int(x), int(y), int(w), int(h)
+        r = min(int(r), w//2, h//2)
+        if w <= 0 or h <= 0 :
+            return
+
+        # The inset of each row from the left and right edges
+        insets = [0]*h
+        for i in range(r) :
+            inset = r - int(round(math.sqrt(r*r - (r-i-.5)**2)))
+            insets[i] = insets[h-1-i] = inset
+
+        fill = _toPixel(*self._fillColor)
+        if fill is not None :
+            for i in range(h) :
+                self._hline(x+insets[i], x+w-1-insets[i], y+i, fill)
+
+        line = _toPixel(*self._lineColor)
+        if line is not None :
+            self._hline(x+insets[0], x+w-1-insets[0], y, line)
+            self._hline(x+insets[-1], x+w-1-insets[-1], y+h-1, line)
+            for i in range(h) :
+                # Extend corner rows far enough to connect to their neighbors
+                neighbor = max(insets[i-1] if i > 0 else 0,
+                    insets[i+1] if i < h-1 else 0)
+                end = max(insets[i], neighbor-1)
+                self._hline(x+insets[i], x+end, y+i, line)
+                self._hline(x+w-1-end, x+w-1-insets[i], y+i, line)
+
+    def drawTriangle(self, x0, y0, x1, y1, x2, y2) :
+        """Draw a triangle."""
+        self._record('drawTriangle', x0, y0, x1, y1, x2, y2)
+
+        points = sorted([(int(y0), int(x0)), (int(y1), int(x1)), (int(y2), int(x2))])
+        (ya, xa), (yb, xb), (yc, xc) = points
+
+        fill = _toPixel(*self._fillColor)
+        if fill is not None :
+            def edgeX(y, ys, xs, ye, xe) :
+                if ye == ys :
+                    return xs
+                return xs + (xe-xs)*(y-ys)/(ye-ys)
+
+            for y in range(ya, yc+1) :
+                xLong = edgeX(y, ya, xa, yc, xc)
+                if y < yb :
+                    xShort = edgeX(y, ya, xa, yb, xb)
+                else :
+                    xShort = edgeX(y, yb, xb, yc, xc)
+                left, right = sorted((xLong, xShort))
+                self._hline(int(round(left)), int(round(right)), y, fill)
+
+        line = _toPixel(*self._lineColor)
+        if line is not None :
+            self._line(xa, ya, xb, yb, line)
+            self._line(xb, yb, xc, yc, line)
+            self._line(xc, yc, xa, ya, line)
+
+    def drawCircle(self, x, y, radius) :
+        """ Draw a circle centered at (x,y) with the specified radius."""
+        self._record('drawCircle', x, y, radius)
+
+        x, y, radius = int(x), int(y), int(radius)
+
+        fill = _toPixel(*self._fillColor)
+        if fill is not None :
+            for dy in range(-radius, radius+1) :
+                dx = int(math.sqrt(radius*radius - dy*dy))
+                self._hline(x-dx, x+dx, y+dy, fill)
+
+        line = _toPixel(*self._lineColor)
+        if line is not None :
+            # Midpoint circle algorithm
+            dx, dy = radius, 0
+            error = 1 - radius
+            while dx >= dy :
+                for px, py in ((dx, dy), (dy, dx)) :
+                    self._setPixel(x+px, y+py, line)
+                    self._setPixel(x-px, y+py, line)
+                    self._setPixel(x+px, y-py, line)
+                    self._setPixel(x-px, y-py, line)
+                dy += 1
+                if error < 0 :
+                    error += 2*dy + 1
+                else :
+                    dx -= 1
+                    error += 2*(dy - dx) + 1
+
+    def write(self, s) :
+        """Write a string s at the cursor and advance the cursor"""
+        self._record('write', s)
+
+        color = _toPixel(*self._textColor)
+        size = self._textSize
+        x, y = self._cursor
+
+        for c in s :
+            if c == '\n' :
+                x, y = 0, y + 8*size
+                continue
+            if c == '\r' :
+                continue
+
+            # Wrap at the right edge of the screen
+            if x + 6*size > self.width :
+                x, y = 0, y + 8*size
+
+            code = ord(c)
+            if color is not None and 32 <= code <= 126 :
+                self._drawChar(x, y, code, color, size)
+            x += 6*size
+
+        self._cursor = (x, y)
+
+    def _drawChar(self, x, y, code, color, size) :
+        offset = 5*(code-32)
+        for col in range(5) :
+            bits = _Font[offset+col]
+            row = 0
+            while bits :
+                if bits & 1 :
+                    for i in range(size) :
+                        self._hline(x+col*size, x+col*size+size-1, y+row*size+i, color)
+                bits >>= 1
+                row += 1
+
+    def _fill(self, color) :
+        self._pixels[:] = array('L', [color])*len(self._pixels)
+
+    def _setPixel(self, x, y, color) :
+        if 0 <= x < self.width and 0 <= y < self.height :
+            self._pixels[y*self.width + x] = color
+
+    def _hline(self, x0, x1, y, color) :
+        if y < 0 or y >= self.height :
+            return
+        x0, x1 = max(x0, 0), min(x1, self.width-1)
+        if x1 < x0 :
+            return
+        start = y*self.width
+        self._pixels[start+x0:start+x1+1] = array('L', [color])*(x1-x0+1)
+
+    def _line(self, x0, y0, x1, y1, color) :
+        # Bresenham's line algorithm
+        dx, dy = abs(x1-x0), -abs(y1-y0)
+        sx = 1 if x0 < x1 else -1
+        sy = 1 if y0 < y1 else -1
+        error = dx + dy
+        while True :
+            self._setPixel(x0, y0, color)
+            if x0 == x1 and y0 == y1 :
+                break
+            e2 = 2*error
+            if e2 >= dy :
+                error += dy
+                x0 += sx
+            if e2 <= dx :
+                error += dx
+                y0 += sy
+
+    def _findChangedSpans(self) :
+        """Return a dict mapping each color to a list of (x0, x1, y) runs of
+           pixels that changed to that color"""
+        spans = {}
+        width = self.width
+        pixels, shown = self._pixels, self._shown
+        for y in range(self.height) :
+            start = y*width
+            if pixels[start:start+width] == shown[start:start+width] :
+                continue
+
+            x = 0
+            while x < width :
+                color = pixels[start+x]
+                if color == shown[start+x] :
+                    x += 1
+                    continue
+
+                end = x
+                while (end+1 < width and pixels[start+end+1] == color and
+                       pixels[start+end+1] != shown[start+end+1]) :
+                    end += 1
+                spans.setdefault(color, []).append((x, end, y))
+                x = end+1
+        return spans
+
+    def refresh(self, flip=False) :
+        """Send the frame to the display and show it"""
+        spans = self._findChangedSpans()
+        spansSize = sum(5 + 5*len(runs) for runs in spans.values())
+
+        # Replaying the ops also has to restore the state that was current
+        # at the start of the frame.
+        opsSize = self._opsSize + 20
+
+        display = self._display
+        if opsSize <= spansSize :
+            lineColor, fillColor, textColor, cursor, textSize = self._frameState
+            display.setLineColor(*lineColor)
+            display.setFillColor(*fillColor)
+            display.setTextColor(*textColor)
+            display.setCursor(*cursor)
+            display.setTextSize(textSize)
+
+            for name, args in self._ops :
+                getattr(display, name)(*args)
+
+            self._lastFrameSize = self._opsSize
+            self._lastFrameUsedOps = True
+        else :
+            for color, runs in spans.items() :
+                display.setLineColor((color >> 16)/255, ((color >> 8) & 0xFF)/255,
+                    (color & 0xFF)/255)
+                for x0, x1, y in runs :
+                    display.drawLine(x0, y, x1, y)
+
+            self._lastFrameSize = spansSize
+            self._lastFrameUsedOps = False
+
+        display.refresh(flip)
+
+        self._shown[:] = self._pixels
+        self._ops = []
+        self._opsSize = 0
+        self._frameState = self._getState()
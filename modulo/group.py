@@ -0,0 +1,189 @@
+"""
+Drive several Modulo Controllers at once.
+
+A PortGroup opens a Port for every controller and gives each one its own
+worker thread, so that transfers to different controllers happen in parallel
+instead of one after another::
+
+    group = PortGroup()
+    for info in group.enumerate() :
+        print(info.deviceID, info.deviceType)
+
+    knob = modulo.Knob(group.findPort(modulo.Knob.deviceType))
+
+    # Fill every controller's displays at the same time
+    displays = [modulo.Display(group.getPort(info.deviceID), info.deviceID)
+        for info in group.getDevices() if info.deviceType == modulo.Display.deviceType]
+
+    def draw(port) :
+        for display in displays :
+            if display._port is port :
+                display.fillScreen(1, 0, 0)
+                display.refresh()
+    group.map(draw)
+"""
+
+from __future__ import print_function, division, absolute_import, unicode_literals
+import collections, sys, threading
+
+from modulo.connection import Port, _findControllerPaths
+
+
+class _Call(object) :
+    """A function call that's waiting to run on a port's worker thread"""
+
+    def __init__(self, function, args) :
+        self._function = function
+        self._args = args
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def _run(self) :
+        try :
+            self._result = self._function(*self._args)
+        except Exception :
+            self._error = sys.exc_info()
+        self._done.set()
+
+    def done(self) :
+        """Return whether the call has finished"""
+        return self._done.is_set()
+
+    def result(self) :
+        """Wait for the call to finish and return its result. If the call
+           raised an exception, it's raised again here."""
+        self._done.wait()
+        if self._error is not None :
+            raise self._error[1]
+        return self._result
+
+
+class _PortWorker(object) :
+    """A thread that runs calls for one port in the order they're submitted"""
+
+    def __init__(self, port, index) :
+        self.port = port
+        self._calls = collections.deque()
+        self._condition = threading.Condition()
+        self._closing = False
+
+        self._thread = threading.Thread(target=self._run,
+            name='modulo-port-%d' % index)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, function, args) :
+        call = _Call(function, (self.port,) + tuple(args))
+        with self._condition :
+            self._calls.append(call)
+            self._condition.notify()
+        return call
+
+    def close(self) :
+        with self._condition :
+            self._closing = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self) :
+        while True :
+            with self._condition :
+                while not self._calls and not self._closing :
+                    self._condition.wait()
+                if not self._calls :
+                    return
+                call = self._calls.popleft()
+            call._run()
+
+
+class PortGroup(object) :
+    """
+    Opens every Modulo Controller connected via USB, or the ones at the
+    specified *paths* (which may also be URLs, see Port), or groups the
+    already open *ports*. The ports are opened in threaded mode, so devices
+    can be used from the group's worker threads and any other thread.
+    """
+
+    def __init__(self, paths=None, inventoryCache=None, ports=None) :
+        if ports is None :
+            if paths is None :
+                paths = _findControllerPaths()
+                if not paths :
+                    raise IOError("Couldn't find a Modulo Controller connected via USB")
+
+            ports = [Port(path, threaded=True, inventoryCache=inventoryCache)
+                for path in paths]
+
+        self.ports = list(ports)
+        """The Port for each controller"""
+
+        self._workers = dict((port, _PortWorker(port, i))
+            for i, port in enumerate(self.ports))
+        self._portsByDeviceID = {}
+
+    def submit(self, port, function, *args) :
+        """Call function(port, *args) on *port*'s worker thread and return an
+           object whose result() method waits for the return value."""
+        return self._workers[port].submit(function, args)
+
+    def map(self, function, *args) :
+        """Call function(port, *args) for every port at the same time, each
+           on its own port's worker thread. Returns a list of the results in
+           the same order as the ports."""
+        calls = [self.submit(port, function, *args) for port in self.ports]
+        return [call.result() for call in calls]
+
+    def enumerate(self, full=False) :
+        """Enumerate every controller in parallel and return a list of
+           DeviceInfo objects for all of their devices, sorted by device ID.
+           See Port.enumerate"""
+        self.map(Port.enumerate, full)
+        self._updateInventory()
+        return self.getDevices()
+
+    def getDevices(self) :
+        """Return DeviceInfo objects for the devices on every controller found
+           by the last call to enumerate, sorted by device ID"""
+        devices = []
+        for port in self.ports :
+            devices.extend(port.getDevices())
+        return sorted(devices, key=lambda info : info.deviceID)
+
+    def getPort(self, deviceID) :
+        """Return the port that the device with the specified ID is connected
+           to, or None if it wasn't found by enumerate"""
+        return self._portsByDeviceID.get(deviceID)
+
+    def findPort(self, deviceType) :
+        """Return the first port that has a device of the specified type that
+           isn't being used by a modulo object, or None"""
+        if not self._portsByDeviceID :
+            self.enumerate()
+
+        for port in self.ports :
+            if port._findUnusedInventoryDevice(deviceType) is not None :
+                return port
+        return None
+
+    def _updateInventory(self) :
+        self._portsByDeviceID = {}
+        for port in self.ports :
+            for info in port.getDevices() :
+                self._portsByDeviceID[info.deviceID] = port
+
+    def loop(self) :
+        """Handle events from every controller and execute callbacks. Returns
+           whether any events were received. Never waits for events."""
+        gotPacket = False
+        for port in self.ports :
+            if port.loop(noWait=True) :
+                gotPacket = True
+        return gotPacket
+
+    def close(self) :
+        """Stop the worker threads and close every port's connection"""
+        for worker in self._workers.values() :
+            worker.close()
+        for port in self.ports :
+            port._connection.close()
@@ -0,0 +1,272 @@
+"""
+Transfer metrics for a Modulo Controller connection.
+
+Every Connection records the number of transfers, timeouts and bytes sent to
+and received from each device, and a histogram of transfer round trip times.
+Port.stats() returns a snapshot of these, and Port.addStatsExporter() calls
+an exporter with a new snapshot at regular intervals::
+
+    from modulo.metrics import PrometheusExporter
+    port.addStatsExporter(PrometheusExporter('/var/lib/node_exporter/modulo.prom'))
+    port.addStatsExporter(lambda stats : print(stats['latency']['p99']), 5)
+"""
+
+from __future__ import print_function, division, absolute_import, unicode_literals
+import collections, time
+
+
+class LatencyHistogram(object) :
+    """
+    A histogram of durations with logarithmic buckets, in the style of
+    HdrHistogram. Each power of two number of microseconds is split into 8
+    buckets, so every recorded value is known to within 12.5%, from 1us to
+    hours, using only a few dozen buckets.
+    """
+
+    # Each power of two is split into 2**_SubBucketBits buckets
+    _SubBucketBits = 3
+    _SubBucketCount = 1 << _SubBucketBits
+
+    def __init__(self) :
+        self._counts = collections.defaultdict(int)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds) :
+        """Add a duration to the histogram"""
+        self._counts[self._bucketIndex(int(seconds*1e6))] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min :
+            self.min = seconds
+        if self.max is None or seconds > self.max :
+            self.max = seconds
+
+    def _bucketIndex(self, micros) :
+        if micros < self._SubBucketCount :
+            return max(micros, 0)
+
+        # The top 4 bits of the value select the bucket within its power of 2
+        shift = micros.bit_length() - self._SubBucketBits - 1
+        return (shift+1)*self._SubBucketCount + (micros >> shift) - self._SubBucketCount
+
+    def _bucketUpperBound(self, index) :
+        """Return the smallest duration in seconds that's above every value
+           in the bucket"""
+        if index < self._SubBucketCount :
+            return (index+1)/1e6
+
+        shift = index//self._SubBucketCount - 1
+        return ((self._SubBucketCount + index%self._SubBucketCount + 1) << shift)/1e6
+
+    def percentile(self, percent) :
+        """Return an upper bound on the specified percentile of the recorded
+           durations, or None if nothing has been recorded"""
+        if not self.count :
+            return None
+
+        threshold = self.count*percent/100.0
+        seen = 0
+        for index in sorted(self._counts) :
+            seen += self._counts[index]
+            if seen >= threshold :
+                return min(self._bucketUpperBound(index), self.max)
+        return self.max
+
+    def buckets(self) :
+        """Return a list of (upperBound, count) pairs for the non-empty buckets,
+           in increasing order. Durations are in seconds."""
+        return [(self._bucketUpperBound(index), self._counts[index])
+            for index in sorted(self._counts)]
+
+    def snapshot(self) :
+        return {
+            'count' : self.count,
+            'total' : self.total,
+            'min' : self.min,
+            'mean' : self.total/self.count if self.count else None,
+            'max' : self.max,
+            'p50' : self.percentile(50),
+            'p90' : self.percentile(90),
+            'p99' : self.percentile(99),
+            'p999' : self.percentile(99.9),
+            'buckets' : self.buckets(),
+        }
+
+
+class _CommandCounters(object) :
+
+    __slots__ = ('transfers', 'timeouts', 'bytesSent', 'bytesReceived', 'latency')
+
+    def __init__(self) :
+        self.transfers = 0
+        self.timeouts = 0
+        self.bytesSent = 0
+        self.bytesReceived = 0
+        self.latency = 0.0
+
+    def snapshot(self) :
+        return {
+            'transfers' : self.transfers,
+            'timeouts' : self.timeouts,
+            'bytesSent' : self.bytesSent,
+            'bytesReceived' : self.bytesReceived,
+            'meanLatency' : (self.latency/(self.transfers - self.timeouts)
+                if self.transfers > self.timeouts else None),
+        }
+
+
+class TransferMetrics(object) :
+    """
+    The counters kept by a Connection. The record methods are only called by
+    the connection, with its lock held or from its reader thread, so they
+    don't do any locking of their own.
+    """
+
+    def __init__(self) :
+        self.startTime = time.time()
+        self.bytesSent = 0
+        self.bytesReceived = 0
+        self.packetsSent = 0
+        self.packetsReceived = 0
+        self.transfers = 0
+        self.timeouts = 0
+        self.maxOutOfBandDepth = 0
+        self.latency = LatencyHistogram()
+        self._commands = {}
+
+    def recordSend(self, frameSize) :
+        self.packetsSent += 1
+        self.bytesSent += frameSize
+
+    def recordReceive(self, byteCount) :
+        self.bytesReceived += byteCount
+
+    def recordPacket(self) :
+        self.packetsReceived += 1
+
+    def recordOutOfBandDepth(self, depth) :
+        if depth > self.maxOutOfBandDepth :
+            self.maxOutOfBandDepth = depth
+
+    def recordTransfer(self, address, command, sendSize, receiveData, seconds) :
+        """Record a completed transfer. *receiveData* is None if the transfer
+           failed."""
+        counters = self._commands.get((address, command))
+        if counters is None :
+            counters = self._commands[(address, command)] = _CommandCounters()
+
+        counters.transfers += 1
+        counters.bytesSent += sendSize
+        self.transfers += 1
+
+        if receiveData is None :
+            counters.timeouts += 1
+            self.timeouts += 1
+        else :
+            counters.bytesReceived += len(receiveData)
+            counters.latency += seconds
+            self.latency.record(seconds)
+
+    def getCommandCounters(self) :
+        """Return a dict mapping (address, command) to a dict of counters"""
+        return dict((key, counters.snapshot())
+            for key, counters in self._commands.items())
+
+
+def formatPrometheus(stats, prefix='modulo') :
+    """Return the stats returned by Port.stats() in the Prometheus text
+       exposition format"""
+    lines = []
+    controller = _escapeLabel(stats['controller'])
+
+    def metric(name, kind, help, samples) :
+        lines.append('# HELP %s_%s %s' % (prefix, name, help))
+        lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+        for labels, value in samples :
+            labels = ','.join(['controller="%s"' % controller] +
+                ['%s="%s"' % (k, _escapeLabel(v)) for k, v in labels])
+            lines.append('%s_%s{%s} %s' % (prefix, name, labels, _formatValue(value)))
+
+    metric('transfers_total', 'counter', 'Transfers sent to devices',
+        [((), stats['transfers'])])
+    metric('transfer_timeouts_total', 'counter', 'Transfers that received no response',
+        [((), stats['timeouts'])])
+    metric('bytes_sent_total', 'counter', 'Bytes written to the controller',
+        [((), stats['bytesSent'])])
+    metric('bytes_received_total', 'counter', 'Bytes read from the controller',
+        [((), stats['bytesReceived'])])
+    metric('events_total', 'counter', 'Events dispatched by Port.loop',
+        [((), stats['events'])])
+    metric('events_per_second', 'gauge', 'Recent rate of dispatched events',
+        [((), stats['eventsPerSecond'])])
+    metric('dropped_events_total', 'counter', 'Events dropped because the queue was full',
+        [((), stats['droppedEvents'])])
+    metric('event_queue_depth', 'gauge', 'Events waiting to be dispatched',
+        [((), stats['outOfBandQueueDepth'])])
+
+    latency = stats['latency']
+    name = '%s_transfer_latency_seconds' % prefix
+    lines.append('# HELP %s Transfer round trip time' % name)
+    lines.append('# TYPE %s histogram' % name)
+    cumulative = 0
+    for upperBound, count in latency['buckets'] :
+        cumulative += count
+        lines.append('%s_bucket{controller="%s",le="%s"} %d' % (name, controller,
+            _formatValue(upperBound), cumulative))
+    lines.append('%s_bucket{controller="%s",le="+Inf"} %d' % (name, controller, latency['count']))
+    lines.append('%s_sum{controller="%s"} %s' % (name, controller, _formatValue(latency['total'])))
+    lines.append('%s_count{controller="%s"} %d' % (name, controller, latency['count']))
+
+    samples = []
+    for device, deviceStats in sorted(stats['devices'].items(), key=lambda item : str(item[0])) :
+        for command, counters in sorted(deviceStats['commands'].items()) :
+            samples.append(((('device', device), ('command', command)), counters))
+
+    for key, kind, help in (
+            ('transfers', 'counter', 'Transfers sent to each device command'),
+            ('timeouts', 'counter', 'Transfers to each device command that received no response'),
+            ('bytesSent', 'counter', 'Payload bytes sent to each device command'),
+            ('bytesReceived', 'counter', 'Payload bytes received from each device command')) :
+        metric('command_%s_total' % _snakeCase(key), kind, help,
+            [(labels, counters[key]) for labels, counters in samples])
+
+    return '\n'.join(lines) + '\n'
+
+def _escapeLabel(value) :
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _formatValue(value) :
+    if value is None :
+        return 'NaN'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _snakeCase(name) :
+    return ''.join('_' + c.lower() if c.isupper() else c for c in name)
+
+
+class PrometheusExporter(object) :
+    """
+    A stats exporter that writes the stats in the Prometheus text format to
+    *path*, for the node_exporter textfile collector or any web server. The
+    file is replaced atomically, so it's never read half written.
+    """
+
+    def __init__(self, path, prefix='modulo') :
+        self.path = path
+        self.prefix = prefix
+
+    def __call__(self, stats) :
+        import os
+        tempPath = self.path + '.tmp'
+        with open(tempPath, 'w') as f :
+            f.write(formatPrometheus(stats, self.prefix))
+
+        try :
+            os.rename(tempPath, self.path)
+        except OSError :
+            # Windows can't rename over an existing file
+            os.remove(self.path)
+            os.rename(tempPath, self.path)
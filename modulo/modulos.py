@@ -1,6 +1,8 @@
 from __future__ import print_function, division, absolute_import, unicode_literals
 import ctypes, ctypes.util
 import time
+import threading
+import collections
 
 def _clip(x, min, max) :
     if x < min :
@@ -15,6 +17,18 @@ class ModuloBase(object) :
     of this class directly.
     """
 
+    # The device type string, such as "co.modulo.knob". Set by each subclass.
+    deviceType = None
+
+    # Event codes for events that only report the current state of the device,
+    # so that only the newest one needs to be processed. See Port.setCoalesceEvents
+    _coalescableEvents = ()
+
+    # Limits on how long Port.loop waits between attempts to find a device that
+    # isn't connected (in seconds). The delay doubles after each attempt.
+    _MinInitRetryDelay = .1
+    _MaxInitRetryDelay = 5.0
+
     def __init__(self, port, deviceType, deviceID) :
         if port is None :
             raise ValueError("Cannot create a Module with an invalid port")
@@ -22,8 +36,10 @@ class ModuloBase(object) :
         self._deviceType = deviceType
         self._deviceID = deviceID
         self._address = None
+        self._nextInitTime = 0
+        self._initRetryDelay = 0
 
-        self._port._modulos.append(self)
+        self._port._addModulo(self)
 
     def __del__(self) :
         self.close()
@@ -31,13 +47,34 @@ class ModuloBase(object) :
     def close(self) :
         """Disconnect this object from its associated Port"""
         if (self._port) :
-            self._port._modulos.remove(self)
+            self._port._removeModulo(self)
 
     def transfer(self, command, sendData, receiveLen) :
-        return self._port._connection.transfer(self.getAddress(), command, sendData, receiveLen)
+        # When pipelining is enabled, don't wait for the responses to transfers
+        # that don't receive any data.
+        if receiveLen == 0 and self._port._isPipelined() :
+            return self._port.queueTransfer(self.getAddress(), command, sendData, receiveLen)
+
+        return self._port.transfer(self.getAddress(), command, sendData, receiveLen)
+
+    def queueTransfer(self, command, sendData, receiveLen) :
+        """Send a transfer without waiting for the response. Returns a
+           PendingTransfer whose result() method waits for the received data."""
+        return self._port.queueTransfer(self.getAddress(), command,
+            sendData, receiveLen)
 
     def _reset(self) :
-        self._address = None
+        self._setBinding(self._deviceID, None)
+        self._nextInitTime = 0
+        self._initRetryDelay = 0
+
+    def _setBinding(self, deviceID, address) :
+        """Set the device ID and address, keeping the port's lookup tables
+           up to date"""
+        self._port._unindexModulo(self)
+        self._deviceID = deviceID
+        self._address = address
+        self._port._indexModulo(self)
 
     def _processEvent(self, eventCode, eventData) :
         pass
@@ -50,8 +87,7 @@ class ModuloBase(object) :
     def setDeviceID(self, deviceID) :
         """Set the ID of the modulo that this object should connect to"""
         if (deviceID != self._deviceID) :
-            self._deviceID = deviceID
-            self._address = None
+            self._setBinding(deviceID, None)
 
     def getAddress(self) :
         """Return the I2C address or None if no modulo was found"""
@@ -59,34 +95,54 @@ class ModuloBase(object) :
         return self._address
 
     def _loop(self) :
-        if self._disconnected :
-            if self.getAddress() != None :
-                self._disconnected = False
+        """Called by Port.loop. If the device hasn't been found yet, try to find
+           it again, backing off exponentially after each failed attempt so
+           that a missing device doesn't keep the bus busy."""
+        if self._address is not None :
+            return
+
+        now = time.time()
+        if now < self._nextInitTime :
+            return
+
+        self._init()
+
+        if self._address is None :
+            self._initRetryDelay = _clip(self._initRetryDelay*2,
+                self._MinInitRetryDelay, self._MaxInitRetryDelay)
+            self._nextInitTime = now + self._initRetryDelay
+        else :
+            self._initRetryDelay = 0
 
     def _init(self) :
         if self._address is not None :
             return False
 
-        if self._deviceID is None:
-            deviceID = self._port._getNextDeviceID(0)
-            while (deviceID is not None) :
-                m = self._port._findModuloByID(deviceID)
+        # In threaded mode several threads may bind modules at the same time
+        with self._port._bindingLock :
+            if self._address is not None :
+                return False
 
-                if m is None :
-                    if (self._port._getDeviceType(deviceID) == self._deviceType) :
-                        self._deviceID = deviceID
-                        break
+            if self._deviceID is None:
+                deviceID = self._port._findUnusedDevice(self._deviceType)
+                if deviceID is not None :
+                    self._setBinding(deviceID, None)
 
-                deviceID = self._port._getNextDeviceID(deviceID)
+            if self._deviceID is None :
+                return False
 
-        if self._deviceID is None :
-            return False
+            address = self._port._getInventoryAddress(self._deviceID)
+            if (address == 0 or address == 127) :
+                # Address every device that needs one in a single sweep, so the
+                # modules bound after this one don't need any more bus traffic
+                self._port.assignAllAddresses()
+                address = self._port._getInventoryAddress(self._deviceID)
+
+            if address is None :
+                # The device isn't connected. Port.loop will look for it again.
+                return False
 
-        self._address = self._port._getAddress(self._deviceID)
-        if (self._address == 0 or self._address == 127) :
-            self._port._lastAssignedAddress += 1
-            self._address = self._port._lastAssignedAddress
-            self._port._setAddress(self._deviceID, self._address)
+            self._setBinding(self._deviceID, address)
 
         return True
 
@@ -97,6 +153,8 @@ class Knob(ModuloBase) :
     If *deviceID* isn't specified, finds the first unused KnobModule.
     """
 
+    deviceType = "co.modulo.knob"
+
     _FunctionGetButton = 0
     _FunctionGetPosition = 1
     _FunctionAddOffsetPosition = 2
@@ -105,8 +163,10 @@ class Knob(ModuloBase) :
     _EventButtonChanged = 0
     _EventPositionChanged = 1
 
+    _coalescableEvents = (_EventPositionChanged,)
+
     def __init__(self, port, deviceID = None) :
-        super(Knob, self).__init__(port, "co.modulo.knob", deviceID)
+        super(Knob, self).__init__(port, self.deviceType, deviceID)
 
         self._buttonState = False
         self._position = 0
@@ -209,14 +269,18 @@ class Joystick(ModuloBase):
     If *deviceID* isn't specified, finds the first unused KnobModule.
     """
 
+    deviceType = "co.modulo.joystick"
+
     _FUNCTION_GET_BUTTON=0
     _FUNCTION_GET_POSITION=1
 
     _EVENT_BUTTON_CHANGED=0
     _EVENT_POSITION_CHANGED=1
 
+    _coalescableEvents = (_EVENT_POSITION_CHANGED,)
+
     def __init__(self, port, deviceID = None) :
-        super(Joystick, self).__init__(port, "co.modulo.joystick", deviceID)
+        super(Joystick, self).__init__(port, self.deviceType, deviceID)
 
         self._buttonState = 0
         self._hPos = 128
@@ -307,11 +371,15 @@ class Joystick(ModuloBase):
 
 class TemperatureProbe(ModuloBase) :
 
+    deviceType = "co.modulo.tempprobe"
+
     _FunctionGetTemperature = 0
     _EventTemperatuteChanged = 0
 
+    _coalescableEvents = (_EventTemperatuteChanged,)
+
     def __init__(self, port, deviceID = None) :
-        super(TemperatureProbe, self).__init__(port, "co.modulo.tempprobe", deviceID)
+        super(TemperatureProbe, self).__init__(port, self.deviceType, deviceID)
         self.isValid = False
         """ A function that will be called when the probe's temperature changes.
 
@@ -370,6 +438,8 @@ class IRRemote(ModuloBase) :
     soon. Please check community.modulo.co for more information on the status
     of this feature."""
 
+    deviceType = "co.modulo.ir"
+
     _FUNCTION_RECEIVE = 0
     _FUNCTION_GET_READ_SIZE = 1
     _FUNCTION_CLEAR_READ = 2
@@ -381,7 +451,7 @@ class IRRemote(ModuloBase) :
     _EVENT_RECEIVE = 0
 
     def __init__(self, port, deviceID = None) :
-        super(IRRemote, self).__init__(port, "co.modulo.ir", deviceID)
+        super(IRRemote, self).__init__(port, self.deviceType, deviceID)
 
     def setBreakLength(self, l) :
         """Set the no signal time that's required before the receiver considers
@@ -429,6 +499,8 @@ class IRRemote(ModuloBase) :
 
 
 class BlankSlate(ModuloBase) :
+    deviceType = "co.modulo.blankslate"
+
     _FUNCTION_GET_DIGITAL_INPUT = 0
     _FUNCTION_GET_DIGITAL_INPUTS = 1
     _FUNCTION_GET_ANALOG_INPUT = 2
@@ -442,7 +514,7 @@ class BlankSlate(ModuloBase) :
     _FUNCTION_SET_PWM_FREQUENCY = 10
 
     def __init__(self, port, deviceID = None) :
-        super(BlankSlate, self).__init__(port, "co.modulo.blankslate", deviceID)
+        super(BlankSlate, self).__init__(port, self.deviceType, deviceID)
 
     def getDigitalInput(self, pin) :
         """Disables the output on the specified pin and returns the pin's value"""
@@ -510,6 +582,8 @@ class BlankSlate(ModuloBase) :
 
 class MotorDriver(ModuloBase) :
 
+    deviceType = "co.modulo.motor"
+
     ModeDisabled = 0
     ModeDC = 1
     ModeStepper = 2
@@ -527,7 +601,7 @@ class MotorDriver(ModuloBase) :
     _EventFaultChanged = 1;
 
     def __init__(self, port, deviceID = None) :
-        super(MotorDriver, self).__init__(port, "co.modulo.motor", deviceID)
+        super(MotorDriver, self).__init__(port, self.deviceType, deviceID)
 
         self.positionReachedCallback = None
         """ A function that will be called when the stepper target position is
@@ -696,6 +770,8 @@ class Display(ModuloBase) :
     If *deviceID* isn't specified, finds the first unused MiniDisplayModule.
     """
 
+    deviceType = "co.modulo.display"
+
     _FUNCTION_APPEND_OP = 0
     _FUNCTION_IS_COMPLETE = 1
     _FUNCTION_GET_BUTTONS = 2
@@ -723,8 +799,15 @@ class Display(ModuloBase) :
 
     _OP_BUFFER_SIZE = 28
 
+    # The largest number of op bytes sent in a single APPEND_OP transfer
+    _MAX_APPEND_SIZE = 28
+
+    # Queued ops are sent once they reach this many bytes, even if refresh()
+    # hasn't been called yet.
+    _MAX_QUEUED_OPS_SIZE = 256
+
     def __init__(self, port, deviceID = None) :
-        super(Display, self).__init__(port, "co.modulo.display", deviceID)
+        super(Display, self).__init__(port, self.deviceType, deviceID)
 
         self.width = 96
         """The width of the display in pixels"""
@@ -753,14 +836,312 @@ class Display(ModuloBase) :
         """
 
         self._currentOp = -1
-        self._opBuffer = bytearray(self._OP_BUFFER_SIZE)
-        self._opBufferLen = 0
+        self._pendingText = bytearray()
+        self._textSize = 1
         self._buttonState = 0
         self._isRefreshing = False
         self._availableSpace = 0
+        self._queuedOps = []
+        self._queuedOpsSize = 0
+
+        # The last value sent for each state setting op, or missing if the
+        # state on the display isn't known.
+        self._drawState = {}
+        self._suppressedOps = 0
+
+        # Background refresh. _pendingFrame is a frame that has been
+        # submitted but not yet picked up by the refresh thread.
+        self._refreshThread = None
+        self._refreshCondition = threading.Condition()
+        self._refreshClosing = False
+        self._pendingFrame = None
+        self._sendingFrame = False
+        self._refreshError = None
+
+        # Frame scheduling. Frames that have been refreshed but not sent yet
+        # are merged into _scheduledOps.
+        self._frameInterval = None
+        self._nextFrameTime = 0
+        self._nextBusyPollTime = 0
+        self._scheduledOps = []
+        self._scheduledFrames = 0
+        self._scheduledFlip = False
+        self._skippedFrames = 0
+        self._frameSize = 0
+        self._lastFrameSize = 0
+        self._frameTimes = collections.deque(maxlen=16)
+
 
+    def _reset(self) :
+        super(Display, self)._reset()
+        self._drawState.clear()
+
+    def close(self) :
+        self.setBackgroundRefresh(False)
+        super(Display, self).close()
+
+    def setBackgroundRefresh(self, enabled=True) :
+        """When enabled, refresh() returns immediately and a background thread
+           sends the frame as soon as the display has finished drawing the
+           previous one, so the next frame can be drawn while the display is
+           busy. If refresh() is called again before the previous frame has
+           started sending, it waits for it. flush() waits until everything
+           has been sent."""
+        if enabled and self._refreshThread is None :
+            self._refreshClosing = False
+            self._refreshThread = threading.Thread(target=self._refreshLoop)
+            self._refreshThread.daemon = True
+            self._refreshThread.start()
+        elif not enabled and self._refreshThread is not None :
+            try :
+                self.flush()
+            finally :
+                with self._refreshCondition :
+                    self._refreshClosing = True
+                    self._refreshCondition.notify_all()
+                self._refreshThread.join()
+                self._refreshThread = None
+
+    def _refreshLoop(self) :
+        while True :
+            with self._refreshCondition :
+                while self._pendingFrame is None and not self._refreshClosing :
+                    self._refreshCondition.wait()
+
+                if self._pendingFrame is None :
+                    return
+
+                ops, isRefresh = self._pendingFrame
+                self._pendingFrame = None
+                self._sendingFrame = True
+                self._refreshCondition.notify_all()
+
+            try :
+                self._sendOps(ops)
+                if isRefresh :
+                    self._isRefreshing = True
+            except Exception as e :
+                self._refreshError = e
+            finally :
+                with self._refreshCondition :
+                    self._sendingFrame = False
+                    self._refreshCondition.notify_all()
+
+    def _submitFrame(self, isRefresh) :
+        """Hand the queued ops to the refresh thread, waiting for it to pick
+           up the previously submitted frame first"""
+        with self._refreshCondition :
+            while self._pendingFrame is not None :
+                self._refreshCondition.wait()
+            self._raiseRefreshError()
+
+            if self._queuedOps :
+                self._pendingFrame = (self._queuedOps, isRefresh)
+                self._queuedOps = []
+                self._queuedOpsSize = 0
+                self._refreshCondition.notify_all()
+
+    def _waitForRefreshThread(self) :
+        with self._refreshCondition :
+            while self._pendingFrame is not None or self._sendingFrame :
+                self._refreshCondition.wait()
+            self._raiseRefreshError()
+
+    def _raiseRefreshError(self) :
+        error, self._refreshError = self._refreshError, None
+        if error is not None :
+            raise error
+
+    def setFrameRate(self, fps) :
+        """Limit the number of frames per second sent to the display. After
+           this, refresh() never waits for the display. Frames are sent from
+           refresh() and Port.loop() once they're due and the display has
+           finished the previous one. Frames that are refreshed faster than
+           that are merged, and frames that are covered by a later clear()
+           aren't sent at all. Pass None to send every frame again."""
+        if fps is None :
+            self.flush()
+            self._frameInterval = None
+        else :
+            self._frameInterval = 1.0/fps
+
+    def getFrameRate(self) :
+        """Return the number of frames per second recently sent to the display"""
+        times = self._frameTimes
+        if len(times) < 2 or times[-1] == times[0] :
+            return 0.0
+        return (len(times)-1)/(times[-1]-times[0])
+
+    def getQueuedFrameCount(self) :
+        """Return the number of frames that have been refreshed but not sent"""
+        return self._scheduledFrames
+
+    def getSkippedFrameCount(self) :
+        """Return the number of frames that were merged into a later frame or
+           covered by a later clear() instead of being shown"""
+        return self._skippedFrames
+
+    def getLastFrameSize(self) :
+        """Return the number of op bytes sent for the last frame"""
+        return self._lastFrameSize
+
+    def _loop(self) :
+        super(Display, self)._loop()
+
+        if self._scheduledFrames :
+            self._runFrameScheduler()
+
+    def _scheduleFrame(self, flip) :
+        ops = self._queuedOps
+        self._queuedOps = []
+        self._queuedOpsSize = 0
+
+        # Everything before the last clear is drawn over, so earlier frames
+        # don't need to be sent at all. Clear doesn't reset the text size,
+        # so the newest text size op is kept.
+        for i in range(len(ops)-1, -1, -1) :
+            if ops[i][0] == self._OpClear :
+                dropped = self._scheduledOps + ops[:i]
+                kept = [op for op in dropped if op[0] == self._OpSetTextSize][-1:]
+
+                self._skippedFrames += self._scheduledFrames
+                self._scheduledFrames = 0
+                self._scheduledOps = kept + ops[i:]
+                break
+        else :
+            self._scheduledOps += ops
+
+        self._scheduledFrames += 1
+        self._scheduledFlip = flip
+
+    def _runFrameScheduler(self, force=False) :
+        """Send the scheduled frames as one frame if it's time for the next
+           frame and the display is ready for it. If force is True, send them
+           now, waiting for the display if necessary."""
+        if not self._scheduledFrames :
+            return
+
+        now = time.time()
+        if not force :
+            if now < self._nextFrameTime :
+                return
+
+            if self._refreshThread is not None :
+                if self._pendingFrame is not None :
+                    return
+            elif self._isRefreshing :
+                # Check whether the display is done without waiting for it
+                if now < self._nextBusyPollTime :
+                    return
+                if not self._isEmpty() :
+                    self._nextBusyPollTime = now + .005
+                    return
+                self._isRefreshing = False
+
+        ops = self._scheduledOps
+        ops.append(bytearray([self._OpRefresh, self._scheduledFlip]))
+        self._skippedFrames += self._scheduledFrames-1
+        self._scheduledOps = []
+        self._scheduledFrames = 0
+
+        self._lastFrameSize = sum(len(op) for op in ops)
+        self._frameTimes.append(now)
+
+        interval = self._frameInterval or 0
+        self._nextFrameTime += interval
+        if self._nextFrameTime < now :
+            self._nextFrameTime = now + interval
+
+        if self._refreshThread is not None :
+            with self._refreshCondition :
+                while self._pendingFrame is not None :
+                    self._refreshCondition.wait()
+                self._pendingFrame = (ops, True)
+                self._refreshCondition.notify_all()
+        else :
+            self._sendOps(ops)
+            self._isRefreshing = True
+
+    def getSuppressedOpCount(self) :
+        """Return the number of state changes that weren't sent because the
+           display was already in that state"""
+        return self._suppressedOps
+
+    def _setState(self, data) :
+        """Send an op that sets drawing state, unless it wouldn't change the
+           state on the display"""
+        opCode, value = data[0], tuple(data[1:])
+        if self._drawState.get(opCode) == value :
+            self._suppressedOps += 1
+            return
+
+        self._drawState[opCode] = value
+        self._sendOp(data)
 
     def _sendOp(self, data) :
+        """Add an op to the queue of ops that will be sent to the display on
+           the next refresh or flush"""
+        if isinstance(data, bytearray) :
+            op = data
+        else :
+            op = bytearray(int(x) for x in data)
+        self._queuedOps.append(op)
+        self._queuedOpsSize += len(op)
+
+        self._frameSize += len(op)
+
+        # With background refresh or frame scheduling, the frame is kept on the
+        # host until refresh()
+        if (self._refreshThread is None and self._frameInterval is None and
+            self._queuedOpsSize >= self._MAX_QUEUED_OPS_SIZE) :
+            self._flushOps()
+
+    def flush(self) :
+        """Send all drawing operations to the display without refreshing it.
+           Drawing operations are normally kept on the host until refresh()
+           is called so that they can be sent in as few transfers as
+           possible."""
+        self._endOp()
+        self._runFrameScheduler(force=True)
+
+        if self._refreshThread is not None :
+            self._submitFrame(False)
+            self._waitForRefreshThread()
+        else :
+            self._flushOps()
+
+    def _flushOps(self) :
+        if not self._queuedOps :
+            return
+
+        ops = self._queuedOps
+        self._queuedOps = []
+        self._queuedOpsSize = 0
+
+        self._sendOps(ops)
+
+    def _sendOps(self, ops) :
+        # The previous frame must finish drawing before the next one is sent
+        self._waitOnRefresh()
+
+        for data in self._packOps(ops) :
+            self._appendOps(data)
+
+    def _packOps(self, ops) :
+        """Combine ops into as few APPEND_OP payloads as possible without
+           splitting any op across payloads"""
+        payloads = []
+        payload = bytearray()
+        for op in ops :
+            if payload and len(payload) + len(op) > self._MAX_APPEND_SIZE :
+                payloads.append(payload)
+                payload = bytearray()
+            payload += op
+        if payload :
+            payloads.append(payload)
+        return payloads
+
+    def _appendOps(self, data) :
         while (self._availableSpace < len(data)) :
             receiveData = self.transfer(self._FUNCTION_GET_AVAILABLE_SPACE, [], 2)
             if receiveData :
@@ -771,95 +1152,99 @@ class Display(ModuloBase) :
 
         self._availableSpace -= len(data)
 
-        self.transfer(self._FUNCTION_APPEND_OP, [int(x) for x in data], 0)
+        self.transfer(self._FUNCTION_APPEND_OP, data, 0)
 
     def _beginOp(self, opCode) :
         if opCode == self._currentOp :
             return
 
         self._currentOp = opCode
-        self._opBufferLen  = 1
-        self._opBuffer[0] = opCode
-
-    def _appendToOp(self, data) :
-        self._opBuffer[self._opBufferLen] = data
-        self._opBufferLen += 1
-
-        if (self._currentOp == self._OpDrawString and
-            self._opBufferLen == self._OP_BUFFER_SIZE-1) :
-            self._endOp()
-            self._beginOp(self._OpDrawString)
 
     def _endOp(self) :
         if self._currentOp == self._OpDrawString :
-
-            self._opBuffer[self._opBufferLen] = 0
-            self._opBufferLen += 1
-            dataToSend = [x for x in self._opBuffer[:self._opBufferLen]]
-            self._sendOp(dataToSend)
-            self._opBufferLen = 0
             self._currentOp = -1
 
+            # Split the text into DrawString ops that fit in the op buffer,
+            # leaving room for the op code and the terminating 0.
+            text = memoryview(self._pendingText)
+            chunkSize = self._OP_BUFFER_SIZE-2
+            for i in range(0, len(text), chunkSize) :
+                op = bytearray([self._OpDrawString])
+                op += text[i:i+chunkSize]
+                op.append(0)
+                self._sendOp(op)
+
+            self._pendingText = bytearray()
+
     def clear(self) :
         """Fill the screen with black, set the line, fill, and text colors to white,
             and return the cursor to (0,0)"""
         self._endOp()
-        self._waitOnRefresh();
 
+        self._drawState.clear()
         self._sendOp([self._OpClear])
 
     def setLineColor(self, r, g, b, a=1) :
         """Set the current line color."""
         self._endOp()
-        self._waitOnRefresh()
 
         r,g,b,a = [int(255*_clip(x,0,1)) for x in (r,g,b,a)]
 
-        self._sendOp([self._OpSetLineColor, r, g, b, a])
+        self._setState([self._OpSetLineColor, r, g, b, a])
 
     def setFillColor(self, r, g, b, a=1) :
         """Set the current fill color"""
         self._endOp()
-        self._waitOnRefresh()
 
         r,g,b,a = [int(255*_clip(x,0,1)) for x in (r,g,b,a)]
 
-        self._sendOp([self._OpSetFillColor, r, g, b, a])
+        self._setState([self._OpSetFillColor, r, g, b, a])
 
     def setTextColor(self, r, g, b, a=1) :
         """Set the current text color"""
         self._endOp()
-        self._waitOnRefresh()
 
         r,g,b,a = [int(255*_clip(x,0,1)) for x in (r,g,b,a)]
 
-        self._sendOp([self._OpSetTextColor, r, g, b, a])
+        self._setState([self._OpSetTextColor, r, g, b, a])
 
     def setCursor(self, x, y) :
         """Set the cursor position, which is where the next text will be drawn."""
         self._endOp()
-        self._waitOnRefresh()
 
         # Convert to 8 bit two's complement representation
         x = ctypes.c_ubyte(int(x)).value
         y = ctypes.c_ubyte(int(y)).value
 
-        self._sendOp([self._OpSetCursor, x, y])
+        self._setState([self._OpSetCursor, x, y])
 
     def refresh(self, flip=False) :
-        """Display the results of all previous drawing commands.
-           Note that after calling refresh, the next drawing operation will
-           block until the frame has been drawn."""
+        """Send all previous drawing commands to the display and show the
+           results. Note that after calling refresh, the next frame will not
+           be sent until this one has been drawn. See setBackgroundRefresh()
+           and setFrameRate() to avoid waiting for it."""
         self._endOp()
-        self._waitOnRefresh()
+
+        if self._frameInterval is not None :
+            self._scheduleFrame(flip)
+            self._frameSize = 0
+            self._runFrameScheduler()
+            return
 
         self._sendOp([self._OpRefresh, flip])
-        self._isRefreshing = True
+        self._lastFrameSize = self._frameSize
+        self._frameSize = 0
+        self._frameTimes.append(time.time())
+
+        if self._refreshThread is not None :
+            self._submitFrame(True)
+        else :
+            self._flushOps()
+            self._isRefreshing = True
 
     def fillScreen(self, r, g, b) :
         """Fill the screen"""
         self._endOp()
-        self._waitOnRefresh()
 
         r,g,b = [int(255*_clip(x,0,1)) for x in (r,g,b)]
 
@@ -871,7 +1256,6 @@ class Display(ModuloBase) :
            All values must be between -127 and 128.
         """
         self._endOp();
-        self._waitOnRefresh();
 
         # XXX: Need to add proper line clipping implementation
 
@@ -888,7 +1272,6 @@ class Display(ModuloBase) :
            specified width, height, and corner radius.
         """
         self._endOp()
-        self._waitOnRefresh();
 
         # Helper function which clips a dimension (pos and length) of a rect
         def _clipRange(x, w, maxWidth) :
@@ -922,7 +1305,6 @@ class Display(ModuloBase) :
 
            Values must be between -128 and 127."""
         self._endOp()
-        self._waitOnRefresh();
 
         # Convert to 8 bit two's complement representation
         x0 = ctypes.c_ubyte(int(x0)).value
@@ -941,7 +1323,6 @@ class Display(ModuloBase) :
             radius must be between 0 and 255
         """
         self._endOp()
-        self._waitOnRefresh();
 
         # Convert to 8 bit two's complement representation
         x = ctypes.c_ubyte(int(x)).value
@@ -954,38 +1335,62 @@ class Display(ModuloBase) :
         """ Write a string s. You can also print to the display with
             print >>display,"Hello Modulo" (Python 2) or
             print("Hello Modulo", file=display) (Python 3)"""
-        self._waitOnRefresh();
 
         if self._currentOp != self._OpDrawString :
             self._endOp()
             self._beginOp(self._OpDrawString)
 
-        for c in s :
-            self._appendToOp(ord(c))
+        # Drawing text moves the cursor
+        self._drawState.pop(self._OpSetCursor, None)
+
+        if not isinstance(s, bytes) :
+            s = s.encode('latin-1', 'replace')
+        self._pendingText += s
+
+    def drawTextAt(self, x, y, s) :
+        """Write the string s with its upper left corner at (x, y)"""
+        self.setCursor(x, y)
+        self.write(s)
+
+    def writeLines(self, x, y, lines, lineHeight=None) :
+        """Write each string in lines on its own line, starting at (x, y).
+           By default the lines are spaced by the height of the current text
+           size."""
+        if lineHeight is None :
+            lineHeight = 8*self._textSize
+
+        for line in lines :
+            self.drawTextAt(x, y, line)
+            y += lineHeight
 
     def setTextSize(self, size) :
         """Set the text size. This is a multiplier of the base text size,
            which is 8px high."""
         self._endOp()
-        self._waitOnRefresh();
 
-        self._sendOp([self._OpSetTextSize, size])
+        self._textSize = int(size)
+        self._setState([self._OpSetTextSize, self._textSize])
 
     def isComplete(self) :
         """ Return whether all previous drawing operations have been completed."""
+        self.flush()
         retval = self.transfer(self._FUNCTION_IS_COMPLETE, [], 1)
         return retval and retval[0]
 
     def isEmpty(self) :
         """Return whether the queue of drawing operations is empty. If the display
            is still refreshing, it may be empty but not complete."""
+        self.flush()
+        return self._isEmpty()
+
+    def _isEmpty(self) :
         retval = self.transfer(self._FUNCTION_IS_EMPTY, [], 1)
         return retval and bool(retval[0])
 
     def _waitOnRefresh(self) :
         if self._isRefreshing :
             self._isRefreshing = False
-            while not self.isEmpty() :
+            while not self._isEmpty() :
                 time.sleep(.005)
 
 
@@ -1075,3 +1480,12 @@ class Display(ModuloBase) :
                 if buttonReleased & (1 << i) and self.buttonReleaseCallback :
                     self.buttonReleaseCallback(self, i)
 
+
+# The class used for each type of device
+_moduloClasses = dict((cls.deviceType, cls) for cls in
+    (Knob, Joystick, TemperatureProbe, IRRemote, BlankSlate, MotorDriver, Display))
+
+def getModuloClass(deviceType) :
+    """Return the class used for devices with the specified type string
+       (such as Knob for "co.modulo.knob"), or None if the type is unknown."""
+    return _moduloClasses.get(deviceType)
@@ -0,0 +1,312 @@
+"""
+A retained mode drawing API for the Modulo Display.
+
+Instead of redrawing the whole screen every frame, add nodes to a Scene and
+change their attributes. Each call to render() compares the scene to the last
+frame that was sent and only redraws the parts of the screen that changed::
+
+    scene = Scene(display)
+    label = scene.add(Text(0, 0, "Temp"))
+    value = scene.add(Text(0, 10, ""))
+
+    while True :
+        value.text = str(probe.getTemperatureC())
+        scene.render()
+        port.loop()
+"""
+
+from __future__ import print_function, division, absolute_import, unicode_literals
+
+
+def _intersects(a, b) :
+    return (a[0] < b[0]+b[2] and b[0] < a[0]+a[2] and
+            a[1] < b[1]+b[3] and b[1] < a[1]+a[3])
+
+def _union(a, b) :
+    x0 = min(a[0], b[0])
+    y0 = min(a[1], b[1])
+    x1 = max(a[0]+a[2], b[0]+b[2])
+    y1 = max(a[1]+a[3], b[1]+b[3])
+    return (x0, y0, x1-x0, y1-y0)
+
+def _color(color) :
+    """Convert a color to an (r, g, b, a) tuple. None is transparent."""
+    if color is None :
+        return (0, 0, 0, 0)
+    if len(color) == 3 :
+        return tuple(color) + (1,)
+    return tuple(color)
+
+
+class Node(object) :
+    """
+    The base class for everything that can be drawn in a Scene. Change a node's
+    attributes at any time; the change will be drawn by the next Scene.render().
+    """
+
+    def __init__(self) :
+        self.visible = True
+        """Whether the node is drawn"""
+
+    def _key(self) :
+        """Return a tuple that's equal for two nodes that draw the same pixels"""
+        raise NotImplementedError()
+
+    def _bounds(self) :
+        """Return the (x, y, width, height) of the pixels the node covers"""
+        raise NotImplementedError()
+
+    def _draw(self, display) :
+        raise NotImplementedError()
+
+
+class Rect(Node) :
+    """A rectangle with an optional corner radius"""
+
+    def __init__(self, x, y, width, height, fill=(1,1,1), line=None, radius=0) :
+        super(Rect, self).__init__()
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.fill = fill
+        self.line = line
+        self.radius = radius
+
+    def _key(self) :
+        return ('rect', self.x, self.y, self.width, self.height,
+            _color(self.fill), _color(self.line), self.radius)
+
+    def _bounds(self) :
+        return (int(self.x), int(self.y), int(self.width), int(self.height))
+
+    def _draw(self, display) :
+        display.setFillColor(*_color(self.fill))
+        display.setLineColor(*_color(self.line))
+        display.drawRect(self.x, self.y, self.width, self.height, self.radius)
+
+
+class Line(Node) :
+    """A line segment from (x0, y0) to (x1, y1)"""
+
+    def __init__(self, x0, y0, x1, y1, color=(1,1,1)) :
+        super(Line, self).__init__()
+        self.x0 = x0
+        self.y0 = y0
+        self.x1 = x1
+        self.y1 = y1
+        self.color = color
+
+    def _key(self) :
+        return ('line', self.x0, self.y0, self.x1, self.y1, _color(self.color))
+
+    def _bounds(self) :
+        x0, x1 = sorted((int(self.x0), int(self.x1)))
+        y0, y1 = sorted((int(self.y0), int(self.y1)))
+        return (x0, y0, x1-x0+1, y1-y0+1)
+
+    def _draw(self, display) :
+        display.setLineColor(*_color(self.color))
+        display.drawLine(self.x0, self.y0, self.x1, self.y1)
+
+
+class Circle(Node) :
+    """A circle centered at (x, y)"""
+
+    def __init__(self, x, y, radius, fill=(1,1,1), line=None) :
+        super(Circle, self).__init__()
+        self.x = x
+        self.y = y
+        self.radius = radius
+        self.fill = fill
+        self.line = line
+
+    def _key(self) :
+        return ('circle', self.x, self.y, self.radius, _color(self.fill),
+            _color(self.line))
+
+    def _bounds(self) :
+        r = int(self.radius)
+        return (int(self.x)-r, int(self.y)-r, 2*r+1, 2*r+1)
+
+    def _draw(self, display) :
+        display.setFillColor(*_color(self.fill))
+        display.setLineColor(*_color(self.line))
+        display.drawCircle(self.x, self.y, self.radius)
+
+
+class Triangle(Node) :
+    """A triangle with corners (x0, y0), (x1, y1) and (x2, y2)"""
+
+    def __init__(self, x0, y0, x1, y1, x2, y2, fill=(1,1,1), line=None) :
+        super(Triangle, self).__init__()
+        self.points = [(x0, y0), (x1, y1), (x2, y2)]
+        self.fill = fill
+        self.line = line
+
+    def _key(self) :
+        return ('triangle', tuple(self.points), _color(self.fill), _color(self.line))
+
+    def _bounds(self) :
+        xs = [int(p[0]) for p in self.points]
+        ys = [int(p[1]) for p in self.points]
+        return (min(xs), min(ys), max(xs)-min(xs)+1, max(ys)-min(ys)+1)
+
+    def _draw(self, display) :
+        display.setFillColor(*_color(self.fill))
+        display.setLineColor(*_color(self.line))
+        (x0, y0), (x1, y1), (x2, y2) = self.points
+        display.drawTriangle(x0, y0, x1, y1, x2, y2)
+
+
+class Text(Node) :
+    """Text with its upper left corner at (x, y). Each character of the
+       built in font is 6x8 pixels times the text size."""
+
+    def __init__(self, x, y, text, color=(1,1,1), size=1) :
+        super(Text, self).__init__()
+        self.x = x
+        self.y = y
+        self.text = text
+        self.color = color
+        self.size = size
+
+    def _key(self) :
+        return ('text', self.x, self.y, self.text, _color(self.color), self.size)
+
+    def _bounds(self) :
+        lines = self.text.split('\n')
+        return (int(self.x), int(self.y),
+            6*self.size*max(len(line) for line in lines),
+            8*self.size*len(lines))
+
+    def _draw(self, display) :
+        display.setTextColor(*_color(self.color))
+        display.setTextSize(self.size)
+        display.setCursor(self.x, self.y)
+        display.write(self.text)
+
+
+class Scene(object) :
+    """
+    A list of nodes that are drawn on a display in order, so later nodes are
+    drawn on top of earlier ones. Nodes are assumed to be opaque.
+    """
+
+    # When more than this fraction of the screen changes, the whole screen is
+    # redrawn instead.
+    _FullRedrawFraction = .5
+
+    def __init__(self, display, background=(0,0,0)) :
+        self._display = display
+        self._nodes = []
+        self._background = tuple(background)
+        self._renderedBackground = None
+        self._rendered = {}
+
+    def add(self, node) :
+        """Add a node on top of all existing nodes and return it"""
+        self._nodes.append(node)
+        return node
+
+    def remove(self, node) :
+        """Remove a node from the scene"""
+        self._nodes.remove(node)
+
+    def setBackground(self, r, g, b) :
+        """Set the color that's drawn behind all of the nodes"""
+        self._background = (r, g, b)
+
+    def invalidate(self) :
+        """Redraw everything on the next render(), for instance after drawing
+           on the display without using the scene."""
+        self._renderedBackground = None
+
+    def render(self) :
+        """Send the changes since the last render to the display and refresh
+           it. Returns whether anything was drawn."""
+        screen = (0, 0, self._display.width, self._display.height)
+
+        current = {}
+        for node in self._nodes :
+            if node.visible :
+                current[id(node)] = (node, node._key(), node._bounds())
+
+        if self._background != self._renderedBackground :
+            dirty = [screen]
+        else :
+            dirty = self._findChangedRegions(current)
+
+        if not dirty :
+            self._rendered = current
+            return False
+
+        area = sum(r[2]*r[3] for r in dirty)
+        if area > self._FullRedrawFraction*screen[2]*screen[3] :
+            dirty = [screen]
+
+        display = self._display
+        if dirty == [screen] :
+            display.fillScreen(*self._background)
+        else :
+            display.setFillColor(*self._background)
+            display.setLineColor(0, 0, 0, 0)
+            for r in dirty :
+                display.drawRect(*r)
+
+        # Redraw every node that overlaps a region that was painted over,
+        # including regions painted by nodes below it.
+        painted = list(dirty)
+        for node in self._nodes :
+            entry = current.get(id(node))
+            if entry is None :
+                continue
+
+            bounds = entry[2]
+            if any(_intersects(bounds, r) for r in painted) :
+                node._draw(display)
+                painted.append(bounds)
+
+        display.refresh()
+
+        self._renderedBackground = self._background
+        self._rendered = current
+        return True
+
+    def _findChangedRegions(self, current) :
+        """Return a list of non-overlapping rectangles covering the old and new
+           bounds of every node that was added, removed, or changed"""
+        regions = []
+        for nodeID, (node, key, bounds) in self._rendered.items() :
+            entry = current.get(nodeID)
+            if entry is None or entry[1] != key :
+                regions.append(bounds)
+
+        for nodeID, (node, key, bounds) in current.items() :
+            entry = self._rendered.get(nodeID)
+            if entry is None or entry[1] != key :
+                regions.append(bounds)
+
+        # Clip to the screen and drop empty regions
+        w, h = self._display.width, self._display.height
+        clipped = []
+        for x, y, rw, rh in regions :
+            x0, y0 = max(x, 0), max(y, 0)
+            x1, y1 = min(x+rw, w), min(y+rh, h)
+            if x1 > x0 and y1 > y0 :
+                clipped.append((x0, y0, x1-x0, y1-y0))
+
+        # Merge overlapping regions so no pixel is painted twice
+        merged = []
+        while clipped :
+            r = clipped.pop()
+            i = 0
+            while i < len(merged) :
+                if _intersects(r, merged[i]) :
+                    r = _union(r, merged.pop(i))
+                    i = 0
+                else :
+                    i += 1
+            merged.append(r)
+
+        return merged
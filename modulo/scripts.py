@@ -2,22 +2,18 @@ from __future__ import print_function
 
 import modulo, sys, time
 
+_classNames = {
+    modulo.Knob : "Knob",
+    modulo.BlankSlate : "Blank Slate",
+    modulo.Joystick : "Joystick",
+    modulo.TemperatureProbe : "Temp Probe",
+    modulo.Display : "Display",
+    modulo.MotorDriver : "Motor Driver",
+    modulo.IRRemote : "IR Remote",
+}
+
 def _getNameForType(deviceType) :
-    if deviceType == "co.modulo.knob":
-        return "Knob"
-    if deviceType == "co.modulo.blankslate":
-        return "Blank Slate"
-    if deviceType == "co.modulo.joystick":
-        return "Joystick"
-    if deviceType == "co.modulo.tempprobe":
-        return "Temp Probe"
-    if deviceType == "co.modulo.display":
-        return "Display"
-    if deviceType == "co.modulo.motor":
-        return "Motor Driver"
-    if deviceType == "co.modulo.ir":
-        return "IR Remote"
-    return "Unknown"
+    return _classNames.get(modulo.getModuloClass(deviceType), "Unknown")
 
 
 def list() :
@@ -30,11 +26,11 @@ def list() :
 
     port = modulo.Port()
 
-    deviceID = port._getNextDeviceID(0)
-    while deviceID is not None :
-        deviceType = port._getDeviceType(deviceID)
-        version = port._getVersion(deviceID)
-        
+    for info in port.enumerate() :
+        deviceID = info.deviceID
+        deviceType = info.deviceType
+        version = info.version
+
         if args.interactive :
             port._setStatus(deviceID,port._StatusBlinking)
 
@@ -48,6 +44,29 @@ def list() :
             sys.stdin.readline()
             port._setStatus(deviceID, port._StatusOff)
 
-        deviceID = port._getNextDeviceID(deviceID)
 
 
+def bridge() :
+    import argparse
+    from modulo.bridge import Bridge
+    from modulo.connection import openConnection
+
+    parser = argparse.ArgumentParser(
+        description='Share a Modulo Controller with other processes over TCP or Unix domain sockets')
+    parser.add_argument("-c", "--controller", default=None,
+        help="the controller's serial port or connection URL (default: the first Modulo Controller)")
+    parser.add_argument("-l", "--listen", action='append',
+        help="a tcp://host:port or unix:///path URL to accept clients on. Can be repeated. (default: tcp://localhost:9000)")
+    parser.add_argument("--max-in-flight", type=int, default=8,
+        help="the number of transfers sent to the controller before waiting for their responses")
+    args = parser.parse_args()
+
+    server = Bridge(openConnection(args.controller), args.max_in_flight)
+    for url in args.listen or ['tcp://localhost:9000'] :
+        server.listen(url)
+        print("Listening on", url)
+
+    try :
+        server.serveForever()
+    except KeyboardInterrupt :
+        pass
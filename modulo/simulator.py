@@ -0,0 +1,655 @@
+"""
+A simulated Modulo Controller, for running and benchmarking code without any
+hardware. The simulated controller speaks the same framed protocol as a real
+one, and the simulated devices respond to the same functions as real
+Modulos::
+
+    controller = SimulatedController(latency=.001)
+    knob = controller.addDevice(SimulatedKnob(1000))
+    display = controller.addDevice(SimulatedDisplay(1001))
+
+    port = controller.openPort()
+    k = modulo.Knob(port)
+    knob.turn(3)
+    port.loop()
+    print(k.getPosition())
+
+The controller can also be opened through a pseudo terminal with openPty(),
+so that programs in other processes can connect to it as if it was a serial
+port.
+"""
+
+from __future__ import print_function, division, absolute_import, unicode_literals
+import heapq, itertools, threading, time
+
+from modulo.connection import Port, Connection, LoopbackConnection, _encodeFrame, _FrameDecoder
+
+
+def _u16(data, i) :
+    return data[i] | (data[i+1] << 8)
+
+def _s32(data, i) :
+    value = data[i] | (data[i+1] << 8) | (data[i+2] << 16) | (data[i+3] << 24)
+    return value - (1 << 32) if value & 0x80000000 else value
+
+def _le16(value) :
+    value &= 0xFFFF
+    return [value & 0xFF, value >> 8]
+
+def _le32(value) :
+    value &= 0xFFFFFFFF
+    return [(value >> shift) & 0xFF for shift in (0, 8, 16, 24)]
+
+
+class SimulatedDevice(object) :
+    """
+    The base class for simulated Modulos. Subclasses implement _transfer to
+    respond to the device's functions.
+    """
+
+    deviceType = None
+
+    def __init__(self, deviceID, version=1) :
+        self.deviceID = deviceID
+        """The device ID, which must be unique on the controller"""
+
+        self.version = version
+        """The firmware version reported to the host"""
+
+        self.address = 0
+        """The I2C address assigned by the host, or 0 if there isn't one"""
+
+        self.status = 0
+        """The state of the status LED"""
+
+        self._controller = None
+
+    def reset(self) :
+        """Called for a global reset"""
+        self.address = 0
+
+    def sendEvent(self, eventCode, eventData) :
+        """Send an event to the host"""
+        if self._controller is not None :
+            self._controller._queueEvent(self.deviceID, eventCode, eventData)
+
+    def _transfer(self, command, data) :
+        """Handle a transfer sent to the device. Return the response data or
+           None if the device doesn't respond."""
+        return None
+
+
+class SimulatedKnob(SimulatedDevice) :
+    deviceType = "co.modulo.knob"
+
+    def __init__(self, deviceID, version=1) :
+        super(SimulatedKnob, self).__init__(deviceID, version)
+        self.position = 0
+        self.button = False
+        self.color = (0, 0, 0)
+
+    def turn(self, clicks) :
+        """Turn the knob by the specified number of clicks"""
+        self.position += clicks
+        self.sendEvent(1, self.position)
+
+    def press(self) :
+        self.button = True
+        self.sendEvent(0, 0x0100)
+
+    def release(self) :
+        self.button = False
+        self.sendEvent(0, 0x0001)
+
+    def _transfer(self, command, data) :
+        if command == 0 :
+            return [int(self.button)]
+        if command == 1 :
+            return _le16(self.position)
+        if command == 2 :
+            offset = _u16(data, 0)
+            self.position += offset - 0x10000 if offset & 0x8000 else offset
+            return []
+        if command == 3 :
+            self.color = tuple(data[:3])
+            return []
+
+
+class SimulatedJoystick(SimulatedDevice) :
+    deviceType = "co.modulo.joystick"
+
+    def __init__(self, deviceID, version=1) :
+        super(SimulatedJoystick, self).__init__(deviceID, version)
+        self.hPos = 128
+        self.vPos = 128
+        self.button = False
+
+    def move(self, hPos, vPos) :
+        """Move the joystick. Positions are between 0 and 255."""
+        self.hPos, self.vPos = hPos, vPos
+        self.sendEvent(1, (hPos << 8) | vPos)
+
+    def press(self) :
+        self.button = True
+        self.sendEvent(0, 0x0100)
+
+    def release(self) :
+        self.button = False
+        self.sendEvent(0, 0x0001)
+
+    def _transfer(self, command, data) :
+        if command == 0 :
+            return [int(self.button)]
+        if command == 1 :
+            return [self.hPos, self.vPos]
+
+
+class SimulatedTemperatureProbe(SimulatedDevice) :
+    deviceType = "co.modulo.tempprobe"
+
+    def __init__(self, deviceID, version=1) :
+        super(SimulatedTemperatureProbe, self).__init__(deviceID, version)
+        self.temperature = 200
+
+    def setTemperature(self, celsius) :
+        self.temperature = int(round(celsius*10))
+        self.sendEvent(0, self.temperature & 0xFFFF)
+
+    def _transfer(self, command, data) :
+        if command == 0 :
+            return _le16(self.temperature)
+
+
+class SimulatedBlankSlate(SimulatedDevice) :
+    deviceType = "co.modulo.blankslate"
+
+    def __init__(self, deviceID, version=1) :
+        super(SimulatedBlankSlate, self).__init__(deviceID, version)
+        self.inputs = 0
+        self.analogInputs = [0]*8
+        self.directions = 0
+        self.outputs = 0
+        self.pullups = 0
+        self.pwmValues = {}
+        self.pwmFrequencies = {}
+
+    def _transfer(self, command, data) :
+        if command == 0 :
+            self.directions &= ~(1 << data[0])
+            return [(self.inputs >> data[0]) & 1]
+        if command == 1 :
+            return [self.inputs]
+        if command == 2 :
+            self.directions &= ~(1 << data[0])
+            return _le16(self.analogInputs[data[0]])
+        if command == 3 :
+            self.directions = self._setBit(self.directions, data[0], data[1])
+        elif command == 4 :
+            self.directions = data[0]
+        elif command == 5 :
+            self.directions |= (1 << data[0])
+            self.outputs = self._setBit(self.outputs, data[0], data[1])
+        elif command == 6 :
+            self.outputs = data[0]
+        elif command == 7 :
+            self.directions |= (1 << data[0])
+            self.pwmValues[data[0]] = _u16(data, 1)/65535.0
+        elif command == 8 :
+            self.pullups = self._setBit(self.pullups, data[0], data[1])
+        elif command == 9 :
+            self.pullups = data[0]
+        elif command == 10 :
+            self.pwmFrequencies[data[0]] = _u16(data, 1)
+        else :
+            return None
+        return []
+
+    def _setBit(self, bits, bit, value) :
+        if value :
+            return bits | (1 << bit)
+        return bits & ~(1 << bit)
+
+
+class SimulatedMotorDriver(SimulatedDevice) :
+    deviceType = "co.modulo.motor"
+
+    def __init__(self, deviceID, version=1) :
+        super(SimulatedMotorDriver, self).__init__(deviceID, version)
+        self.channels = [0.0]*4
+        self.mode = 0
+        self.frequency = 0
+        self.currentLimit = 0
+        self.stepperSpeed = (0, 0)
+        self.stepperPosition = 0
+
+    def setFault(self, fault) :
+        self.sendEvent(1, 1 if fault else 2)
+
+    def _transfer(self, command, data) :
+        if command == 0 :
+            self.channels[data[0]] = _u16(data, 1)/65535.0
+        elif command == 1 :
+            self.mode = data[0]
+        elif command == 2 :
+            self.frequency = _u16(data, 0)
+        elif command == 3 :
+            self.currentLimit = data[0]
+        elif command == 4 :
+            self.stepperSpeed = (_u16(data, 0), data[2])
+        elif command == 5 :
+            return _le32(self.stepperPosition)
+        elif command == 6 :
+            # The simulated stepper reaches its target immediately
+            self.stepperPosition = _s32(data, 0)
+            self.sendEvent(0, 0)
+        elif command == 7 :
+            self.stepperPosition += _s32(data, 0)
+        else :
+            return None
+        return []
+
+
+class SimulatedIRRemote(SimulatedDevice) :
+    deviceType = "co.modulo.ir"
+
+    def __init__(self, deviceID, version=1) :
+        super(SimulatedIRRemote, self).__init__(deviceID, version)
+        self.received = bytearray()
+        self.sent = []
+        self.breakLength = 0
+        self._sendBuffer = bytearray(256)
+
+    def receive(self, data) :
+        """Simulate receiving raw IR data"""
+        self.received = bytearray(data)
+        self.sendEvent(0, len(self.received))
+
+    def _transfer(self, command, data) :
+        if command == 0 :
+            return list(self.received[data[0]:data[0]+data[1]])
+        if command == 1 :
+            return [len(self.received)]
+        if command == 2 :
+            self.received = bytearray()
+        elif command == 3 :
+            offset = data[0]
+            self._sendBuffer[offset:offset+len(data)-1] = bytearray(data[1:])
+        elif command == 4 :
+            self.sent.append(bytes(self._sendBuffer[:data[0]]))
+        elif command == 5 :
+            return [1]
+        elif command == 6 :
+            self.breakLength = _u16(data, 0)
+        else :
+            return None
+        return []
+
+
+class SimulatedDisplay(SimulatedDevice) :
+    """
+    A simulated display. Ops are counted but not drawn. Each refresh keeps the
+    display busy for *refreshTime* seconds, during which appended ops use up
+    the op buffer.
+    """
+
+    deviceType = "co.modulo.display"
+
+    # The length of each op, by op code. DrawString (9) ends with a 0.
+    _OpLengths = {0:2, 1:5, 2:5, 3:5, 4:5, 5:5, 6:6, 7:4, 8:7, 10:3, 11:2, 12:1}
+    _OpDrawString = 9
+    _OpRefresh = 0
+
+    def __init__(self, deviceID, version=1, refreshTime=.01, bufferSize=1024) :
+        super(SimulatedDisplay, self).__init__(deviceID, version)
+        self.refreshTime = refreshTime
+        self.bufferSize = bufferSize
+        self.buttons = 0
+        self.current = None
+        self.contrast = None
+
+        self.opCount = 0
+        """The number of ops that have been received"""
+
+        self.opBytes = 0
+        """The number of op bytes that have been received"""
+
+        self.frameCount = 0
+        """The number of refresh ops that have been received"""
+
+        self._partialOp = bytearray()
+        self._busyUntil = 0
+        self._queuedBytes = 0
+
+    def press(self, button) :
+        self.buttons |= (1 << button)
+        self.sendEvent(0, (1 << button) << 8)
+
+    def release(self, button) :
+        self.buttons &= ~(1 << button)
+        self.sendEvent(0, 1 << button)
+
+    def _isBusy(self) :
+        if time.time() >= self._busyUntil :
+            self._queuedBytes = 0
+            return False
+        return True
+
+    def _appendOps(self, data) :
+        if self._isBusy() :
+            self._queuedBytes += len(data)
+        self.opBytes += len(data)
+
+        ops = self._partialOp + bytearray(data)
+        i = 0
+        while i < len(ops) :
+            code = ops[i]
+            if code == self._OpDrawString :
+                end = ops.find(b'\0', i+1)
+                if end < 0 :
+                    break
+                length = end+1-i
+            else :
+                length = self._OpLengths.get(code, 1)
+                if i + length > len(ops) :
+                    break
+
+            self.opCount += 1
+            if code == self._OpRefresh :
+                self.frameCount += 1
+                self._busyUntil = max(self._busyUntil, time.time()) + self.refreshTime
+            i += length
+        self._partialOp = ops[i:]
+
+    def _transfer(self, command, data) :
+        if command == 0 :
+            self._appendOps(data)
+        elif command in (1, 4) :
+            return [int(not self._isBusy())]
+        elif command == 2 :
+            return [self.buttons]
+        elif command == 3 :
+            pass
+        elif command == 5 :
+            self._isBusy()
+            return _le16(max(self.bufferSize - self._queuedBytes, 0))
+        elif command == 6 :
+            self.current = data[0]
+        elif command == 7 :
+            self.contrast = list(data)
+        else :
+            return None
+        return []
+
+
+class SimulatedController(object) :
+    """
+    A simulated Modulo Controller with a bus of simulated devices.
+
+    Each transfer takes *latency* seconds plus the time to send its bytes at
+    *bandwidth* bytes per second (if not None). Transfers are handled one at
+    a time, like on a real bus.
+    """
+
+    _BroadcastAddress = Port._BroadcastAddress
+
+    def __init__(self, latency=0, bandwidth=None) :
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+        self.transferCount = 0
+        """The number of transfers that have been received"""
+
+        self.bytesReceived = 0
+        """The number of bytes received from the host"""
+
+        self.bytesSent = 0
+        """The number of bytes sent to the host"""
+
+        self._devices = []
+        self._decoder = _FrameDecoder()
+        self._condition = threading.Condition()
+
+        # Frames waiting to be sent, as a heap of (readyTime, sequence, frame)
+        self._outgoing = []
+        self._sequence = itertools.count()
+        self._ready = bytearray()
+        self._busyUntil = 0
+        self._ptyThread = None
+        self._closing = False
+
+    def addDevice(self, device) :
+        """Connect a simulated device to the bus and return it"""
+        with self._condition :
+            device._controller = self
+            self._devices.append(device)
+        return device
+
+    def removeDevice(self, device) :
+        """Disconnect a simulated device from the bus"""
+        with self._condition :
+            self._devices.remove(device)
+            device._controller = None
+
+    def getDevices(self) :
+        return list(self._devices)
+
+    def openStream(self) :
+        """Return an object with the same interface as serial.Serial that's
+           connected to this controller"""
+        return _SimulatedSerial(self, Connection._Timeout)
+
+    def openPort(self, **kwargs) :
+        """Return a Port connected to this controller. Keyword arguments are
+           passed to Port."""
+        return Port(connection=LoopbackConnection(self), **kwargs)
+
+    def openPty(self) :
+        """Create a pseudo terminal connected to this controller and return
+           its path, which can be passed to Port. Not available on Windows."""
+        import os, tty
+
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        path = os.ttyname(slave)
+
+        self._ptyFDs = (master, slave)
+        self._ptyThread = threading.Thread(target=self._ptyLoop, args=(master,),
+            name='modulo-simulator')
+        self._ptyThread.daemon = True
+        self._ptyThread.start()
+        return path
+
+    def close(self) :
+        """Stop the pseudo terminal, if there is one"""
+        import os
+
+        self._closing = True
+        if self._ptyThread is not None :
+            self._ptyThread.join()
+            self._ptyThread = None
+            for fd in self._ptyFDs :
+                os.close(fd)
+
+    def _ptyLoop(self, master) :
+        import os, select
+
+        while not self._closing :
+            with self._condition :
+                data, timeout = self._takeReady()
+            if data :
+                os.write(master, bytes(data))
+
+            # Wake up often enough to deliver events from other threads
+            readable = select.select([master], [], [], min(timeout, .005))[0]
+            if readable :
+                try :
+                    data = os.read(master, 4096)
+                except OSError :
+                    return
+                self._write(data)
+
+    def _takeReady(self) :
+        """Return the bytes that are ready to be sent and the time until the
+           next frame is ready. Must be called with the lock held."""
+        now = time.time()
+        while self._outgoing and self._outgoing[0][0] <= now :
+            self._ready += heapq.heappop(self._outgoing)[2]
+
+        data, self._ready = self._ready, bytearray()
+        self.bytesSent += len(data)
+
+        timeout = self._outgoing[0][0] - now if self._outgoing else 1.0
+        return data, timeout
+
+    def _queueFrame(self, readyTime, data) :
+        heapq.heappush(self._outgoing,
+            (readyTime, next(self._sequence), _encodeFrame(data)))
+        self._condition.notify_all()
+
+    def _queueEvent(self, deviceID, eventCode, eventData) :
+        with self._condition :
+            self._queueFrame(time.time(), [ord('V'), eventCode, deviceID & 0xFF,
+                deviceID >> 8, eventData & 0xFF, (eventData >> 8) & 0xFF])
+
+    def _write(self, data) :
+        """Handle bytes sent by the host"""
+        with self._condition :
+            self.bytesReceived += len(data)
+            self._decoder.feed(bytearray(data))
+
+            frame = self._decoder.nextFrame()
+            while frame is not None :
+                self._processFrame(frame)
+                frame = self._decoder.nextFrame()
+
+    def _processFrame(self, frame) :
+        code = frame[0]
+        if code == ord('X') :
+            self._queueFrame(time.time(), [code])
+        elif code == ord('T') and len(frame) >= 5 :
+            address, command, sendLen, receiveLen = frame[1:5]
+            data = frame[5:5+sendLen]
+
+            self.transferCount += 1
+            result = self._transfer(address, command, data)
+            if result is None :
+                result = []
+            else :
+                result = (list(result) + [0]*receiveLen)[:receiveLen]
+
+            response = [ord('R'), address] + result
+
+            # Transfers are handled one at a time
+            duration = self.latency
+            if self.bandwidth :
+                duration += (len(frame) + len(response))/self.bandwidth
+            self._busyUntil = max(self._busyUntil, time.time()) + duration
+            self._queueFrame(self._busyUntil, response)
+
+    def _findDevice(self, deviceID) :
+        for device in self._devices :
+            if device.deviceID == deviceID :
+                return device
+        return None
+
+    def _transfer(self, address, command, data) :
+        if address != self._BroadcastAddress :
+            for device in self._devices :
+                if device.address == address :
+                    return device._transfer(command, data)
+            return None
+
+        if command == Port._BroadcastCommandGlobalReset :
+            for device in self._devices :
+                device.reset()
+            return []
+
+        if command == Port._BroadcastCommandExitBootloader :
+            return []
+
+        if command in (Port._BroadcastCommandGetNextDeviceID,
+                       Port._BroadcastCommandGetNextUnassignedDeviceID) :
+            first = _u16(data, 0)
+            ids = [d.deviceID for d in self._devices if d.deviceID >= first and
+                   (command == Port._BroadcastCommandGetNextDeviceID or d.address == 0)]
+            if not ids :
+                return None
+            deviceID = min(ids)
+            return [deviceID >> 8, deviceID & 0xFF]
+
+        if len(data) < 2 :
+            return None
+        device = self._findDevice(_u16(data, 0))
+        if device is None :
+            return None
+
+        if command == Port._BroadcastCommandSetAddress :
+            device.address = data[2]
+            return []
+        if command == Port._BroadcastCommandGetAddress :
+            return [device.address]
+        if command == Port._BroadcastCommandGetDeviceType :
+            return list(bytearray(device.deviceType.encode('ascii')))
+        if command == Port._BroadcastCommandGetVersion :
+            return _le16(device.version)
+        if command == Port._BroadcastCommandSetStatusLED :
+            device.status = data[2]
+            return []
+        return None
+
+
+class _SimulatedSerial(object) :
+    """A connection to a SimulatedController with the same interface as
+       serial.Serial"""
+
+    def __init__(self, controller, timeout) :
+        self._controller = controller
+        self.timeout = timeout
+        self.name = 'sim://%x' % id(controller)
+        self._buffer = bytearray()
+        self._closed = False
+
+    def _checkOpen(self) :
+        # Like serial.Serial, a closed port can't be used
+        if self._closed :
+            raise IOError("The simulated port is closed")
+
+    def write(self, data) :
+        self._checkOpen()
+        self._controller._write(data)
+        return len(data)
+
+    def inWaiting(self) :
+        self._checkOpen()
+        with self._controller._condition :
+            data, timeout = self._controller._takeReady()
+            self._buffer += data
+        return len(self._buffer)
+
+    @property
+    def in_waiting(self) :
+        return self.inWaiting()
+
+    def read(self, size=1) :
+        self._checkOpen()
+        controller = self._controller
+        deadline = time.time() + self.timeout
+        with controller._condition :
+            while True :
+                data, timeout = controller._takeReady()
+                self._buffer += data
+
+                remaining = deadline - time.time()
+                if self._buffer or remaining <= 0 :
+                    break
+                controller._condition.wait(min(timeout, remaining))
+
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def flush(self) :
+        pass
+
+    def close(self) :
+        self._closed = True
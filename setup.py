@@ -18,7 +18,8 @@ setup(name='modulo-python',
     packages=['modulo'],
     entry_points={
         'console_scripts': [
-            'modulo-list=modulo.scripts:list'
+            'modulo-list=modulo.scripts:list',
+            'modulo-bridge=modulo.scripts:bridge'
         ]
     },
     install_requires=['pyserial']
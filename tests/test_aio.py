@@ -0,0 +1,111 @@
+"""
+Tests for AsyncPort and AsyncDisplay, run against a simulated controller on a
+pseudo terminal.
+"""
+
+from __future__ import print_function, division, absolute_import, unicode_literals
+import asyncio, os, unittest
+
+import modulo, modulo.aio
+from modulo.simulator import (SimulatedController, SimulatedKnob, SimulatedDisplay,
+    SimulatedTemperatureProbe)
+
+
+class _LossyController(SimulatedController) :
+    """A simulated controller that never responds to transfers sent to
+       LostAddress"""
+
+    LostAddress = 77
+
+    def _processFrame(self, frame) :
+        if frame[0] == ord('T') and frame[1] == self.LostAddress :
+            return
+        super(_LossyController, self)._processFrame(frame)
+
+
+@unittest.skipUnless(hasattr(os, 'openpty'), "Pseudo terminals aren't available")
+class AsyncPortTests(unittest.TestCase) :
+
+    def setUp(self) :
+        self.controller = _LossyController()
+        self.knob = self.controller.addDevice(SimulatedKnob(4))
+        self.knob.position = 7
+        self.controller.addDevice(SimulatedTemperatureProbe(3))
+        self.simulatedDisplay = self.controller.addDevice(SimulatedDisplay(5, refreshTime=0))
+        self.path = self.controller.openPty()
+
+    def tearDown(self) :
+        self.controller.close()
+
+    def runWithPort(self, function) :
+        async def main() :
+            async with modulo.aio.AsyncPort(self.path) as port :
+                return await function(port)
+        return asyncio.run(main())
+
+    def testAttach(self) :
+        async def run(port) :
+            knob = modulo.Knob(port)
+            self.assertRaises(RuntimeError, knob.getAddress)
+            self.assertTrue(await port.attach(knob))
+            self.assertFalse(await port.attach(modulo.Knob(port)))
+            return knob.getDeviceID(), knob.getAddress()
+        self.assertEqual(self.runWithPort(run), (4, self.knob.address))
+
+    def testPipelinedTransfersWithLatency(self) :
+        # The controller takes longer than the timeout to work through the
+        # transfers. Only the oldest one is timed, so none of them are lost.
+        self.controller.latency = .003
+        async def run(port) :
+            knob = modulo.Knob(port, 4)
+            probe = modulo.TemperatureProbe(port, 3)
+            await port.attach(knob)
+            await port.attach(probe)
+            port.setMaxInFlight(64)
+
+            knobResults = await asyncio.gather(*[port.transfer(knob.getAddress(), 1, [], 2)
+                for i in range(64)])
+            probeResults = await asyncio.gather(*[port.transfer(probe.getAddress(), 0, [], 2)
+                for i in range(8)])
+            return knobResults, probeResults
+        self.assertEqual(self.runWithPort(run), ([[7, 0]]*64, [[200, 0]]*8))
+
+    def testLostResponse(self) :
+        async def run(port) :
+            knob = modulo.Knob(port, 4)
+            await port.attach(knob)
+            port.setMaxInFlight(8)
+
+            lost = port.transfer(_LossyController.LostAddress, 0, [], 2)
+            self.assertEqual(await lost, None)
+            return await asyncio.gather(*[port.transfer(knob.getAddress(), 1, [], 2)
+                for i in range(4)])
+        self.assertEqual(self.runWithPort(run), [[7, 0]]*4)
+
+    def testEvents(self) :
+        async def run(port) :
+            knob = modulo.Knob(port, 4)
+            await port.attach(knob)
+            self.knob.turn(2)
+
+            events = port.events()
+            event = await asyncio.wait_for(events.__anext__(), 2)
+            await events.aclose()
+            return event, knob.getPosition()
+        self.assertEqual(self.runWithPort(run), ((4, 1, 9), 9))
+
+    def testDisplay(self) :
+        async def run(port) :
+            display = modulo.aio.AsyncDisplay(port)
+            await port.attach(display)
+            for i in range(3) :
+                display.clear()
+                display.drawTextAt(0, 0, "Frame %d" % i)
+                await display.refresh()
+            await display.flush()
+        self.runWithPort(run)
+        self.assertEqual(self.simulatedDisplay.frameCount, 3)
+
+
+if __name__ == '__main__' :
+    unittest.main()
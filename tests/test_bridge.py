@@ -0,0 +1,153 @@
+"""
+Tests for Bridge, run against the simulated controller.
+"""
+
+from __future__ import print_function, division, absolute_import, unicode_literals
+import os, shutil, socket, tempfile, threading, time, unittest
+
+import modulo
+from modulo.bridge import Bridge
+from modulo.connection import LoopbackConnection
+from modulo.simulator import (SimulatedController, SimulatedKnob,
+    SimulatedTemperatureProbe)
+
+
+class _LossyController(SimulatedController) :
+    """A simulated controller that never responds to transfers sent to
+       LostAddress"""
+
+    LostAddress = 77
+
+    def _processFrame(self, frame) :
+        if frame[0] == ord('T') and frame[1] == self.LostAddress :
+            return
+        super(_LossyController, self)._processFrame(frame)
+
+
+class BridgeTests(unittest.TestCase) :
+
+    def setUp(self) :
+        self.controller = _LossyController()
+        self.knob = self.controller.addDevice(SimulatedKnob(4))
+        self.controller.addDevice(SimulatedTemperatureProbe(3)).setTemperature(20)
+        self._ports = []
+        self._thread = None
+
+    def tearDown(self) :
+        for port in self._ports :
+            port._connection.close()
+        if self._thread is not None :
+            self.bridge.close()
+            self._thread.join()
+
+    def startBridge(self, **kwargs) :
+        self.connection = LoopbackConnection(self.controller)
+        self.bridge = Bridge(self.connection, **kwargs)
+        self.address = self.bridge.listen('tcp://127.0.0.1:0')
+        self._thread = threading.Thread(target=self.bridge.serveForever)
+        self._thread.start()
+
+    def openPort(self, url=None, **kwargs) :
+        if self._thread is None :
+            self.startBridge()
+        port = modulo.Port(url or 'tcp://127.0.0.1:%d' % self.address[1], **kwargs)
+        self._ports.append(port)
+        return port
+
+    def waitFor(self, condition, port) :
+        deadline = time.time() + 2
+        while not condition() and time.time() < deadline :
+            port.loop()
+        return condition()
+
+    def testTransfers(self) :
+        port = self.openPort()
+        probe = modulo.TemperatureProbe(port, 3)
+        for i in range(10) :
+            self.assertEqual(port.transfer(probe.getAddress(), 0, [], 2), [200, 0])
+
+        metrics = self.connection.metrics
+        self.assertEqual(self.bridge.getTransferCount(), metrics.packetsSent)
+        self.assertEqual(metrics.transfers, metrics.packetsSent)
+        self.assertEqual(metrics.timeouts, 0)
+
+    def testPipelinedClients(self) :
+        ports = [self.openPort(), self.openPort()]
+        probes = [modulo.TemperatureProbe(port, 3) for port in ports]
+        for port in ports :
+            port.setMaxInFlight(8)
+
+        pending = []
+        for i in range(20) :
+            for port, probe in zip(ports, probes) :
+                pending.append(port.queueTransfer(probe.getAddress(), 0, [], 2))
+        self.assertEqual([p.result() for p in pending], [[200, 0]]*40)
+        self.assertEqual(self.bridge.getClientCount(), 2)
+
+    def testQueuedTransfersWithLatency(self) :
+        # Most of the client's transfers wait in the bridge for longer than
+        # the timeout before they're sent to the controller, but none of them
+        # are dropped
+        self.controller.latency = .003
+        self.startBridge(maxInFlight=4)
+        port = self.openPort()
+        knob = modulo.Knob(port, 4).getAddress()
+        probe = modulo.TemperatureProbe(port, 3).getAddress()
+        port.setMaxInFlight(64)
+
+        pending = [port.queueTransfer(address, command, [], 2)
+            for i in range(32) for address, command in ((knob, 1), (probe, 0))]
+        self.assertEqual([p.result() for p in pending], [[0, 0], [200, 0]]*32)
+        self.assertEqual(self.bridge.getDroppedTransferCount(), 0)
+
+    def testLostResponse(self) :
+        port = self.openPort()
+        probe = modulo.TemperatureProbe(port, 3).getAddress()
+        port.setMaxInFlight(8)
+
+        # The client gets an empty response in place of the lost one before
+        # it gives up on the transfer, so its later responses still match
+        self.assertEqual(port.transfer(self.controller.LostAddress, 0, [], 2), [])
+        pending = [port.queueTransfer(probe, 0, [], 2) for i in range(8)]
+        self.assertEqual([p.result() for p in pending], [[200, 0]]*8)
+        self.assertEqual(self.bridge.getDroppedTransferCount(), 1)
+        self.assertEqual(port._connection.metrics.timeouts, 0)
+
+    def testEventsAreSentToEveryClient(self) :
+        ports = [self.openPort(), self.openPort(threaded=True)]
+        knobs = [modulo.Knob(port, 4) for port in ports]
+        for knob in knobs :
+            knob.getPosition()
+
+        self.knob.turn(3)
+        for port, knob in zip(ports, knobs) :
+            self.assertTrue(self.waitFor(lambda : knob.getPosition() == 3, port))
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), "Unix domain sockets aren't available")
+    def testUnixSocket(self) :
+        self.startBridge()
+        directory = tempfile.mkdtemp()
+        try :
+            path = os.path.join(directory, 'modulo')
+            self.bridge.listen('unix://' + path)
+            port = self.openPort('unix://' + path)
+            probe = modulo.TemperatureProbe(port, 3)
+            self.assertEqual(port.transfer(probe.getAddress(), 0, [], 2), [200, 0])
+        finally :
+            shutil.rmtree(directory)
+
+    def testControllerFailure(self) :
+        port = self.openPort()
+        probe = modulo.TemperatureProbe(port, 3)
+        probe.getAddress()
+
+        # Unplug the controller. The bridge stops and its clients see the
+        # connection close instead of waiting for responses.
+        self.connection._stream.close()
+        self._thread.join(5)
+        self.assertFalse(self._thread.is_alive())
+        self.assertRaises(IOError, port.transfer, probe.getAddress(), 0, [], 2)
+
+
+if __name__ == '__main__' :
+    unittest.main()
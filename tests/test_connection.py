@@ -0,0 +1,599 @@
+"""
+Tests for Port and Connection, run against the simulated controller.
+"""
+
+from __future__ import print_function, division, absolute_import, unicode_literals
+import os, shutil, tempfile, threading, time, unittest
+
+import modulo
+from modulo.connection import (Connection, openConnection, _encodeFrame,
+    _FrameDecoder)
+from modulo.modulos import getModuloClass
+from modulo.simulator import (SimulatedController, SimulatedKnob, SimulatedDisplay,
+    SimulatedBlankSlate, SimulatedTemperatureProbe)
+
+
+class _PortTestCase(unittest.TestCase) :
+
+    def setUp(self) :
+        self.controller = SimulatedController()
+        self._ports = []
+
+    def tearDown(self) :
+        for port in self._ports :
+            port._connection.close()
+
+    def openPort(self, **kwargs) :
+        port = self.controller.openPort(**kwargs)
+        self._ports.append(port)
+        return port
+
+
+class FramingTests(_PortTestCase) :
+
+    def testEncodeFrame(self) :
+        self.assertEqual(_encodeFrame([1, 2, 3]), bytearray([0x7E, 1, 2, 3, 0x7E]))
+
+    def testEncodeEscapes(self) :
+        # The escape byte is escaped first, so the escapes inserted for
+        # delimeters aren't escaped again
+        self.assertEqual(_encodeFrame([0x7E, 1, 0x7D]),
+            bytearray([0x7E, 0x7D, 0x5E, 1, 0x7D, 0x5D, 0x7E]))
+        self.assertEqual(_encodeFrame(b'\x7d\x7e'),
+            bytearray([0x7E, 0x7D, 0x5D, 0x7D, 0x5E, 0x7E]))
+
+    def testTransfer(self) :
+        self.controller.addDevice(SimulatedTemperatureProbe(3)).setTemperature(25.5)
+        port = self.openPort()
+        probe = modulo.TemperatureProbe(port)
+
+        self.assertEqual(probe.getDeviceID(), 3)
+        self.assertEqual(port.transfer(probe.getAddress(), 0, [], 2), [255, 0])
+
+    def testSendEscapedData(self) :
+        knob = self.controller.addDevice(SimulatedKnob(4))
+        port = self.openPort()
+        address = modulo.Knob(port).getAddress()
+
+        port.transfer(address, 3, [0x7E, 0x7D, 1], 0)
+        self.assertEqual(knob.color, (0x7E, 0x7D, 1))
+
+
+class DecoderTests(_PortTestCase) :
+
+    def testSplitFrames(self) :
+        data = bytes(_encodeFrame([1, 0x7E, 2]) + _encodeFrame([0x7D, 3]))
+
+        # Feed one byte at a time, so that the escape sequences are split
+        decoder = _FrameDecoder()
+        frames = []
+        for i in range(len(data)) :
+            decoder.feed(data[i:i+1])
+            frame = decoder.nextFrame()
+            if frame is not None :
+                frames.append(list(frame))
+        self.assertEqual(frames, [[1, 0x7E, 2], [0x7D, 3]])
+
+    def testNoiseAndEmptyFrames(self) :
+        decoder = _FrameDecoder()
+        decoder.feed(b'noise\x7e\x7e\x7e\x01\x02\x7e\x7e')
+        self.assertEqual(decoder.nextFrame(), bytearray([1, 2]))
+        self.assertEqual(decoder.nextFrame(), None)
+
+        # The last delimeter can start the next frame
+        decoder.feed(b'\x03\x7e')
+        self.assertEqual(decoder.nextFrame(), bytearray([3]))
+
+    def testReceiveEscapedData(self) :
+        self.controller.addDevice(SimulatedTemperatureProbe(3)).temperature = 0x7D7E
+        port = self.openPort()
+        address = modulo.TemperatureProbe(port).getAddress()
+
+        self.assertEqual(port.transfer(address, 0, [], 2), [0x7E, 0x7D])
+
+
+class PipelineTests(_PortTestCase) :
+
+    def testQueueTransfer(self) :
+        self.controller.addDevice(SimulatedTemperatureProbe(3)).setTemperature(20)
+        port = self.openPort()
+        probe = modulo.TemperatureProbe(port)
+        port.setMaxInFlight(8)
+
+        pending = [port.queueTransfer(probe.getAddress(), 0, [], 2) for i in range(20)]
+        self.assertEqual([p.result() for p in pending], [[200, 0]]*20)
+
+    def testResponsesMatchTransfers(self) :
+        self.controller.addDevice(SimulatedTemperatureProbe(3)).setTemperature(20)
+        self.controller.addDevice(SimulatedKnob(4)).position = 7
+        port = self.openPort()
+        probe = modulo.TemperatureProbe(port).getAddress()
+        knob = modulo.Knob(port).getAddress()
+        port.setMaxInFlight(8)
+
+        pending = [port.queueTransfer(address, command, [], 2)
+            for i in range(10) for address, command in ((probe, 0), (knob, 1))]
+        self.assertEqual([p.result() for p in pending], [[200, 0], [7, 0]]*10)
+
+    def testPipelinedTransfersWithLatency(self) :
+        # Working through all of the transfers takes longer than the timeout,
+        # but each response arrives in time after the one before it
+        self.controller.latency = .003
+        self.controller.addDevice(SimulatedTemperatureProbe(3)).setTemperature(20)
+        port = self.openPort()
+        probe = modulo.TemperatureProbe(port)
+        port.setMaxInFlight(64)
+
+        pending = [port.queueTransfer(probe.getAddress(), 0, [], 2) for i in range(64)]
+        self.assertEqual([p.result() for p in pending], [[200, 0]]*64)
+
+    def testPipelinedOutputs(self) :
+        knob = self.controller.addDevice(SimulatedKnob(4))
+        port = self.openPort()
+        m = modulo.Knob(port)
+        port.setMaxInFlight(8)
+
+        for i in range(10) :
+            m.setColor(0, 0, i/10)
+        m.setColor(1, 0, 0)
+        port._connection.waitForTransfers()
+        self.assertEqual(knob.color[0], 255)
+
+
+class ThreadedTests(_PortTestCase) :
+
+    def testThreadedTransfers(self) :
+        self.controller.addDevice(SimulatedTemperatureProbe(3)).setTemperature(20)
+        self.controller.addDevice(SimulatedBlankSlate(5))
+        port = self.openPort(threaded=True)
+        probe = modulo.TemperatureProbe(port)
+        blankSlate = modulo.BlankSlate(port)
+        errors = []
+
+        def run(function, expected) :
+            try :
+                for i in range(50) :
+                    self.assertEqual(function(), expected)
+            except Exception as e :
+                errors.append(e)
+
+        threads = [
+            threading.Thread(target=run, args=(lambda : port.transfer(probe.getAddress(), 0, [], 2), [200, 0])),
+            threading.Thread(target=run, args=(blankSlate.getDigitalInputs, 0))]
+        for t in threads :
+            t.start()
+        for t in threads :
+            t.join()
+        self.assertEqual(errors, [])
+
+    def testPipelinedTransfersWithLatency(self) :
+        # The controller takes longer than the timeout to work through the
+        # transfers. Only the oldest one is timed, so none of them are lost.
+        self.controller.latency = .003
+        self.controller.addDevice(SimulatedTemperatureProbe(3)).setTemperature(20)
+        self.controller.addDevice(SimulatedKnob(4)).position = 7
+        port = self.openPort(threaded=True)
+        probe = modulo.TemperatureProbe(port).getAddress()
+        knob = modulo.Knob(port).getAddress()
+        port.setMaxInFlight(64)
+
+        pending = [port.queueTransfer(knob, 1, [], 2) for i in range(64)]
+        self.assertEqual([p.result() for p in pending], [[7, 0]]*64)
+
+        # Later transfers get their own responses
+        for i in range(8) :
+            self.assertEqual(port.transfer(probe, 0, [], 2), [200, 0])
+
+    def testConcurrentBinding(self) :
+        devices = [self.controller.addDevice(SimulatedKnob(i)) for i in range(1, 9)]
+        port = self.openPort(threaded=True)
+        modules = [modulo.Knob(port, d.deviceID) for d in devices]
+
+        threads = [threading.Thread(target=m.getAddress) for m in modules]
+        for t in threads :
+            t.start()
+        for t in threads :
+            t.join()
+
+        addresses = [m.getAddress() for m in modules]
+        self.assertEqual(addresses, [d.address for d in devices])
+        self.assertEqual(len(set(addresses)), len(devices))
+
+    def testThreadedEvents(self) :
+        knob = self.controller.addDevice(SimulatedKnob(4))
+        port = self.openPort(threaded=True)
+        m = modulo.Knob(port)
+        m.getPosition()
+
+        knob.turn(2)
+        deadline = time.time() + 2
+        while m.getPosition() != 2 and time.time() < deadline :
+            port.loop()
+        self.assertEqual(m.getPosition(), 2)
+
+    def testReaderErrorFailsTransfers(self) :
+        self.controller.addDevice(SimulatedTemperatureProbe(3))
+        port = self.openPort(threaded=True)
+        probe = modulo.TemperatureProbe(port)
+        address = probe.getAddress()
+
+        # Unplug the controller
+        port._connection._stream.close()
+        start = time.time()
+        self.assertRaises(IOError, port.transfer, address, 0, [], 2)
+        self.assertRaises(IOError, port.loop)
+        self.assertLess(time.time() - start, 1)
+
+    def testLostResponseExpiresDuringEvents(self) :
+        connection = Connection(_EventFloodStream())
+        connection.startReaderThread()
+        try :
+            start = time.time()
+            self.assertEqual(connection.transfer(10, 0, [], 2), None)
+            self.assertLess(time.time() - start, 1)
+        finally :
+            connection.close()
+
+
+class _EventFloodStream(object) :
+    """A stream from a controller that sends a steady stream of events and
+       never responds to transfers"""
+
+    def __init__(self) :
+        self._echo = False
+
+    def write(self, data) :
+        if b'X' in bytes(data) :
+            self._echo = True
+        return len(data)
+
+    def inWaiting(self) :
+        return 0
+
+    def read(self, size=1) :
+        time.sleep(.01)
+        if self._echo :
+            self._echo = False
+            return bytes(_encodeFrame(b'X'))
+        return bytes(_encodeFrame([ord('V'), 1, 4, 0, 1, 0]))
+
+    def flush(self) :
+        pass
+
+    def close(self) :
+        pass
+
+
+class EventQueueTests(_PortTestCase) :
+
+    def setUp(self) :
+        super(EventQueueTests, self).setUp()
+        self.knob = self.controller.addDevice(SimulatedKnob(4))
+
+    def turnAndWait(self, port, clicks, dropped) :
+        for i in range(clicks) :
+            self.knob.turn(1)
+        deadline = time.time() + 2
+        while port.getDroppedEventCount() < dropped and time.time() < deadline :
+            time.sleep(.01)
+
+    def testEventQueueLimit(self) :
+        port = self.openPort(threaded=True)
+        m = modulo.Knob(port)
+        m.getPosition()
+        port.setEventQueueLimit(2)
+
+        # The oldest events are dropped
+        self.turnAndWait(port, 10, 8)
+        self.assertEqual(port.getDroppedEventCount(), 8)
+        port.loop(noWait=True)
+        self.assertEqual(m.getPosition(), 10)
+
+    def testEventQueueOverflowRaises(self) :
+        port = self.openPort(threaded=True)
+        modulo.Knob(port).getPosition()
+        port.setEventQueueLimit(2, port.OverflowRaise)
+
+        self.turnAndWait(port, 5, 3)
+        self.assertRaises(IOError, port.loop, True)
+
+
+class CoalesceTests(_PortTestCase) :
+
+    def testEvents(self) :
+        knob = self.controller.addDevice(SimulatedKnob(4))
+        port = self.openPort()
+        m = modulo.Knob(port)
+        m.getPosition()
+
+        presses = []
+        m.buttonPressCallback = presses.append
+        knob.turn(-3)
+        knob.press()
+        port.loop()
+        port.loop(noWait=True)
+
+        self.assertEqual(m.getPosition(), -3)
+        self.assertEqual(m.getButton(), True)
+        self.assertEqual(presses, [m])
+
+    def testCoalesceEvents(self) :
+        knob = self.controller.addDevice(SimulatedKnob(4))
+        port = self.openPort()
+        m = modulo.Knob(port)
+        m.getPosition()
+        port.setCoalesceEvents(True)
+
+        positions = []
+        m.positionChangeCallback = lambda m : positions.append(m.getPosition())
+        presses = []
+        m.buttonPressCallback = presses.append
+
+        for i in range(5) :
+            knob.turn(1)
+        port._connection.waitForTransfers()
+        time.sleep(.01)
+        port.loop(noWait=True)
+        self.assertEqual(positions, [5])
+        self.assertEqual(port.getCoalescedEventCount(), 4)
+
+        # A button press between position changes keeps the earlier position
+        del positions[:]
+        knob.turn(1)
+        knob.press()
+        knob.turn(1)
+        time.sleep(.01)
+        port.loop(noWait=True)
+        self.assertEqual(positions, [6, 7])
+        self.assertEqual(presses, [m])
+
+
+class DispatchTests(_PortTestCase) :
+
+    def testEventsGoToTheirModule(self) :
+        knobs = [self.controller.addDevice(SimulatedKnob(i)) for i in (4, 5)]
+        port = self.openPort()
+        modules = [modulo.Knob(port, 4), modulo.Knob(port, 5)]
+        positions = []
+        for m in modules :
+            m.getAddress()
+            m.positionChangeCallback = lambda m : positions.append((m.getDeviceID(), m.getPosition()))
+
+        knobs[1].turn(2)
+        knobs[0].turn(-1)
+        port.loop()
+        port.loop(noWait=True)
+        self.assertEqual(positions, [(5, 2), (4, -1)])
+
+    def testSetDeviceID(self) :
+        self.controller.addDevice(SimulatedKnob(4))
+        self.controller.addDevice(SimulatedKnob(5))
+        port = self.openPort()
+        m = modulo.Knob(port, 4)
+        m.getAddress()
+
+        m.setDeviceID(5)
+        self.assertIs(port._findModuloByID(4), None)
+        self.assertIs(port._findModuloByID(5), m)
+        self.assertIs(port._findModuloByAddress(m.getAddress()), m)
+
+
+class RetryTests(_PortTestCase) :
+
+    def testMissingDeviceIsRetriedLater(self) :
+        port = self.openPort()
+        m = modulo.Knob(port, 50)
+        port.loop(noWait=True)
+
+        # Looking for the device again is rate limited
+        count = self.controller.transferCount
+        for i in range(20) :
+            port.loop(noWait=True)
+        self.assertEqual(self.controller.transferCount, count)
+
+        knob = self.controller.addDevice(SimulatedKnob(50))
+        deadline = time.time() + 2
+        while knob.address == 0 and time.time() < deadline :
+            port.loop()
+        self.assertEqual(m.getAddress(), knob.address)
+
+
+class EnumerateTests(_PortTestCase) :
+
+    def testEnumerate(self) :
+        self.controller.addDevice(SimulatedDisplay(7))
+        self.controller.addDevice(SimulatedKnob(2))
+        port = self.openPort()
+
+        devices = port.enumerate()
+        self.assertEqual([(d.deviceID, d.deviceType) for d in devices],
+            [(2, 'co.modulo.knob'), (7, 'co.modulo.display')])
+
+    def testEnumerateAgain(self) :
+        for deviceID in (2, 3) :
+            self.controller.addDevice(SimulatedKnob(deviceID))
+        removed = self.controller.addDevice(SimulatedKnob(7))
+        port = self.openPort()
+        port.enumerate()
+
+        # Devices that were already found aren't read again
+        count = self.controller.transferCount
+        self.assertEqual([d.deviceID for d in port.enumerate()], [2, 3, 7])
+        self.assertEqual(self.controller.transferCount - count, 4)
+
+        self.controller.removeDevice(removed)
+        self.assertEqual([d.deviceID for d in port.enumerate()], [2, 3])
+
+    def testModulesUseInventory(self) :
+        self.controller.addDevice(SimulatedKnob(2))
+        self.controller.addDevice(SimulatedDisplay(7))
+        port = self.openPort()
+        port.enumerate()
+
+        # Modules find their device without any more bus traffic
+        count = self.controller.transferCount
+        self.assertEqual(port._findUnusedDevice('co.modulo.display'), 7)
+        self.assertEqual(self.controller.transferCount, count)
+
+
+class InventoryCacheTests(_PortTestCase) :
+
+    def setUp(self) :
+        super(InventoryCacheTests, self).setUp()
+        self._directory = tempfile.mkdtemp()
+        self.cachePath = os.path.join(self._directory, 'inventory.json')
+
+    def tearDown(self) :
+        super(InventoryCacheTests, self).tearDown()
+        shutil.rmtree(self._directory)
+
+    def testInventoryCache(self) :
+        self.controller.addDevice(SimulatedKnob(1))
+        modulo.Knob(self.openPort(inventoryCache=self.cachePath)).getAddress()
+
+        # Another process finds the cached devices without enumerating again
+        count = self.controller.transferCount
+        port = self.openPort(inventoryCache=self.cachePath)
+        self.assertEqual([d.deviceID for d in port.enumerate()], [1])
+        self.assertLess(self.controller.transferCount - count, 5)
+
+    def testInventoryCacheFindsNewDevices(self) :
+        self.controller.addDevice(SimulatedKnob(1))
+        modulo.Knob(self.openPort(inventoryCache=self.cachePath)).getAddress()
+
+        self.controller.addDevice(SimulatedDisplay(2))
+        port = self.openPort(inventoryCache=self.cachePath)
+        self.assertEqual([d.deviceID for d in port.enumerate()], [1, 2])
+        self.assertEqual(modulo.Display(port).getDeviceID(), 2)
+
+    def testInventoryCacheFindsRemovedDevices(self) :
+        self.controller.addDevice(SimulatedKnob(1))
+        removed = self.controller.addDevice(SimulatedDisplay(2))
+        self.openPort(inventoryCache=self.cachePath).enumerate()
+
+        self.controller.removeDevice(removed)
+        port = self.openPort(inventoryCache=self.cachePath)
+        self.assertEqual([d.deviceID for d in port.enumerate()], [1])
+
+
+class DeviceTypeTests(_PortTestCase) :
+
+    def testEmptyDeviceTypeIsNotCached(self) :
+        port = self.openPort()
+        self.assertFalse(port._getDeviceType(20))
+
+        self.controller.addDevice(SimulatedKnob(20))
+        port.enumerate()
+        self.assertEqual(modulo.Knob(port).getDeviceID(), 20)
+
+    def testDeviceTypes(self) :
+        self.controller.addDevice(SimulatedKnob(1))
+        devices = [self.openPort().enumerate()[0] for i in range(2)]
+
+        # Every port shares one copy of each type string
+        self.assertIs(devices[0].deviceType, devices[1].deviceType)
+        self.assertIs(getModuloClass(devices[0].deviceType), modulo.Knob)
+        self.assertIs(getModuloClass('co.modulo.unknown'), None)
+
+
+class AddressTests(_PortTestCase) :
+
+    def testAddressesAcrossPorts(self) :
+        first = self.controller.addDevice(SimulatedBlankSlate(10))
+        second = self.controller.addDevice(SimulatedBlankSlate(11))
+
+        # Two ports on the same controller mustn't hand out the same address
+        modulo.BlankSlate(self.openPort(), 10).getAddress()
+        modulo.BlankSlate(self.openPort(), 11).getAddress()
+        self.assertNotEqual(first.address, second.address)
+
+    def testAddressesAcrossStalePorts(self) :
+        first = self.controller.addDevice(SimulatedBlankSlate(10))
+        second = self.controller.addDevice(SimulatedBlankSlate(11))
+        ports = [self.openPort(), self.openPort()]
+        ports[1].enumerate()
+
+        # The second port's inventory is out of date once the first port has
+        # addressed the devices, but it doesn't address them again
+        modulo.BlankSlate(ports[0], 10).getAddress()
+        address = second.address
+        self.assertEqual(modulo.BlankSlate(ports[1], 11).getAddress(), address)
+        self.assertEqual(second.address, address)
+        self.assertNotEqual(first.address, second.address)
+
+    def testAssignAllAddresses(self) :
+        devices = [self.controller.addDevice(SimulatedBlankSlate(i)) for i in (10, 11, 12)]
+        devices[0].address = devices[1].address = 20
+        port = self.openPort()
+
+        # Devices with the same address are given new ones
+        port.assignAllAddresses()
+        addresses = [d.address for d in devices]
+        self.assertEqual(len(set(addresses)), 3)
+        self.assertNotIn(0, addresses)
+        self.assertIn(20, addresses)
+        self.assertEqual([d.address for d in port.getDevices()], addresses)
+
+    def testAssignAllAddressesKeepsBoundAddress(self) :
+        devices = [self.controller.addDevice(SimulatedBlankSlate(i)) for i in (10, 11)]
+        port = self.openPort()
+        m = modulo.BlankSlate(port, 11)
+        address = m.getAddress()
+
+        # The module keeps its address when another device is given the same one
+        devices[0].address = address
+        port.enumerate(full=True)
+        port.assignAllAddresses()
+        self.assertEqual(devices[1].address, address)
+        self.assertNotEqual(devices[0].address, address)
+        self.assertEqual(m.getDigitalInputs(), 0)
+
+    def testBindingTransfers(self) :
+        for i in range(1, 9) :
+            self.controller.addDevice(SimulatedKnob(i))
+        port = self.openPort()
+
+        # The bus is walked once to find the devices and once to address them,
+        # rather than every time a module is bound
+        for i in range(8) :
+            modulo.Knob(port).getAddress()
+        self.assertLessEqual(self.controller.transferCount, 76)
+
+
+class OpenConnectionTests(unittest.TestCase) :
+
+    def testLoopback(self) :
+        connection = openConnection('loop://')
+        connection.controller.addDevice(SimulatedKnob(4))
+        port = modulo.Port(connection=connection)
+        try :
+            self.assertEqual(modulo.Knob(port).getDeviceID(), 4)
+        finally :
+            connection.close()
+
+    def testUnsupportedURL(self) :
+        self.assertRaises(ValueError, openConnection, 'http://localhost')
+
+    @unittest.skipUnless(hasattr(os, 'openpty'), "Pseudo terminals aren't available")
+    def testPseudoTerminal(self) :
+        controller = SimulatedController()
+        knob = controller.addDevice(SimulatedKnob(5))
+        path = controller.openPty()
+        try :
+            for url in (path, 'fd://' + path) :
+                port = modulo.Port(url)
+                try :
+                    m = modulo.Knob(port)
+                    knob.turn(1)
+                    deadline = time.time() + 2
+                    while m.getPosition() != knob.position and time.time() < deadline :
+                        port.loop()
+                    self.assertEqual(m.getPosition(), knob.position)
+                finally :
+                    port._connection.close()
+        finally :
+            controller.close()
+
+
+if __name__ == '__main__' :
+    unittest.main()
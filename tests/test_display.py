@@ -0,0 +1,180 @@
+"""
+Tests for Display, run against the simulated controller.
+"""
+
+from __future__ import print_function, division, absolute_import, unicode_literals
+import unittest
+
+import modulo
+from modulo.simulator import SimulatedController, SimulatedDisplay
+
+
+class _DisplayTestCase(unittest.TestCase) :
+
+    def setUp(self) :
+        self.controller = SimulatedController()
+        self.simulatedDisplay = self.controller.addDevice(SimulatedDisplay(5, refreshTime=0))
+        self.port = self.controller.openPort()
+        self.display = modulo.Display(self.port)
+        self.display.getAddress()
+
+        # Record every op that's sent to the display
+        self.sentOps = []
+        sendOps = self.display._sendOps
+        def recordOps(ops) :
+            self.sentOps.extend(list(bytearray(op)) for op in ops)
+            return sendOps(ops)
+        self.display._sendOps = recordOps
+
+    def tearDown(self) :
+        self.display.close()
+        self.port._connection.close()
+
+    def drawFrame(self) :
+        self.display.clear()
+        self.display.drawSplashScreen()
+        self.display.refresh()
+
+    def countTransfers(self, function) :
+        count = self.controller.transferCount
+        function()
+        self.display.flush()
+        return self.controller.transferCount - count
+
+
+class PackedOpTests(_DisplayTestCase) :
+
+    def testFrameTransfers(self) :
+        # The ops for a whole frame are packed into as few transfers as possible
+        self.assertLessEqual(self.countTransfers(self.drawFrame), 6)
+        self.assertEqual(self.simulatedDisplay.frameCount, 1)
+        self.assertEqual(self.simulatedDisplay.opCount, len(self.sentOps))
+        self.assertEqual(self.simulatedDisplay.opBytes, sum(len(op) for op in self.sentOps))
+
+    def testPipelinedFrames(self) :
+        self.drawFrame()
+        self.display.flush()
+        opBytes = self.simulatedDisplay.opBytes
+
+        self.port.setMaxInFlight(8)
+        self.drawFrame()
+        self.display.flush()
+        self.assertEqual(self.simulatedDisplay.opBytes, 2*opBytes)
+        self.assertEqual(self.simulatedDisplay.frameCount, 2)
+
+
+class StateTests(_DisplayTestCase) :
+
+    def testRedundantStateIsSuppressed(self) :
+        display = self.display
+        display.setLineColor(1, 0, 0)
+        display.setLineColor(1, 0, 0)
+        display.setTextSize(2)
+        display.setTextSize(2)
+        display.refresh()
+        display.flush()
+
+        self.assertEqual(display.getSuppressedOpCount(), 2)
+        self.assertEqual(self.sentOps, [[3, 255, 0, 0, 255], [11, 2], [0, 0]])
+
+    def testCursorIsResentAfterText(self) :
+        display = self.display
+        display.setCursor(3, 3)
+        display.write("a")
+        display.setCursor(3, 3)
+        display.refresh()
+        display.flush()
+
+        self.assertEqual(self.sentOps, [[10, 3, 3], [9, ord('a'), 0], [10, 3, 3], [0, 0]])
+
+
+class BackgroundRefreshTests(_DisplayTestCase) :
+
+    def testBackgroundRefresh(self) :
+        self.simulatedDisplay.refreshTime = .005
+        self.display.setBackgroundRefresh(True)
+        for i in range(10) :
+            self.drawFrame()
+        self.display.flush()
+        self.assertEqual(self.simulatedDisplay.frameCount, 10)
+
+        self.display.setBackgroundRefresh(False)
+        self.drawFrame()
+        self.display.flush()
+        self.assertEqual(self.simulatedDisplay.frameCount, 11)
+
+
+class TextTests(_DisplayTestCase) :
+
+    def testLongText(self) :
+        def drawText() :
+            self.display.setCursor(0, 0)
+            self.display.write("x"*60)
+            self.display.refresh()
+        self.assertLessEqual(self.countTransfers(drawText), 6)
+
+        # Long strings are split into ops that fit in the display's op buffer
+        text = [op[1:-1] for op in self.sentOps if op[0] == 9]
+        self.assertEqual(sum(text, []), [ord('x')]*60)
+
+    def testDrawTextAt(self) :
+        self.display.drawTextAt(5, 6, "hi")
+        self.display.refresh()
+        self.display.flush()
+        self.assertEqual(self.sentOps, [[10, 5, 6], [9, ord('h'), ord('i'), 0], [0, 0]])
+
+    def testWriteLines(self) :
+        display = self.display
+        display.setTextSize(2)
+        display.writeLines(1, 2, ["a", "bc"])
+        display.writeLines(50, 0, ["d", "e"], lineHeight=10)
+        display.refresh()
+        display.flush()
+
+        # Lines are spaced by the height of the text unless told otherwise
+        self.assertEqual(self.sentOps, [[11, 2],
+            [10, 1, 2], [9, ord('a'), 0], [10, 1, 18], [9, ord('b'), ord('c'), 0],
+            [10, 50, 0], [9, ord('d'), 0], [10, 50, 10], [9, ord('e'), 0], [0, 0]])
+
+    def testPrint(self) :
+        self.display.setCursor(0, 0)
+        print("hi", 3, file=self.display)
+        self.display.refresh()
+        self.display.flush()
+
+        text = [op[1:-1] for op in self.sentOps if op[0] == 9]
+        self.assertEqual(bytearray(sum(text, [])), bytearray(b'hi 3\n'))
+
+
+class FrameRateTests(_DisplayTestCase) :
+
+    def testFrameRateSkipsFrames(self) :
+        self.display.setFrameRate(5)
+        for i in range(10) :
+            self.drawFrame()
+        self.display.flush()
+
+        self.assertLess(self.simulatedDisplay.frameCount, 10)
+        self.assertGreater(self.display.getSkippedFrameCount(), 0)
+        self.assertEqual(self.display.getQueuedFrameCount(), 0)
+
+    def testFrameRateKeepsTextSize(self) :
+        # Ops before a clear are dropped, but the text size isn't reset by
+        # the clear, so it must still be sent
+        expected = [[11, 2], [12], [9, ord('h'), ord('i'), 0], [0, 0]]
+        for fps in (None, 20) :
+            self.display.setFrameRate(fps)
+            self.display._reset()
+            del self.sentOps[:]
+
+            display = self.display
+            display.setTextSize(2)
+            display.clear()
+            display.write("hi")
+            display.refresh()
+            display.flush()
+            self.assertEqual(self.sentOps, expected)
+
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,60 @@
+"""
+Tests for FrameBuffer, run against the simulated controller.
+"""
+
+from __future__ import print_function, division, absolute_import, unicode_literals
+import unittest
+
+import modulo
+from modulo.framebuffer import FrameBuffer
+from modulo.simulator import SimulatedController, SimulatedDisplay
+
+
+class FrameBufferTests(unittest.TestCase) :
+
+    def setUp(self) :
+        self.controller = SimulatedController()
+        self.simulatedDisplay = self.controller.addDevice(SimulatedDisplay(5, refreshTime=0))
+        self.port = self.controller.openPort()
+        self.display = modulo.Display(self.port)
+        self.frameBuffer = FrameBuffer(self.display)
+
+    def tearDown(self) :
+        self.display.close()
+        self.port._connection.close()
+
+    def refresh(self) :
+        opBytes = self.simulatedDisplay.opBytes
+        self.frameBuffer.refresh()
+        self.display.flush()
+        return self.simulatedDisplay.opBytes - opBytes
+
+    def testDrawing(self) :
+        fb = self.frameBuffer
+        fb.clear()
+        fb.setFillColor(0, 0, 1)
+        fb.drawRect(2, 2, 40, 30)
+        self.assertEqual(fb.getPixel(10, 10), (0, 0, 255))
+        self.assertEqual(fb.getPixel(90, 5), (0, 0, 0))
+
+    def testOnlyChangesAreSent(self) :
+        fb = self.frameBuffer
+        fb.clear()
+        fb.setFillColor(0, 0, 1)
+        fb.drawRect(2, 2, 40, 30)
+        fb.drawCircle(60, 30, 10)
+        fb.setCursor(0, 50)
+        fb.write("Hello")
+        firstFrame = self.refresh()
+
+        # An unchanged frame is just a refresh
+        self.assertEqual(self.refresh(), 2)
+        self.assertEqual(fb.getLastFrameSize(), 0)
+
+        fb.setCursor(0, 0)
+        fb.write("a")
+        self.assertLess(self.refresh(), firstFrame)
+
+
+if __name__ == '__main__' :
+    unittest.main()
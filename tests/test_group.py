@@ -0,0 +1,69 @@
+"""
+Tests for PortGroup, run against simulated controllers.
+"""
+
+from __future__ import print_function, division, absolute_import, unicode_literals
+import threading, time, unittest
+
+import modulo
+from modulo.simulator import (SimulatedController, SimulatedKnob, SimulatedDisplay,
+    SimulatedTemperatureProbe)
+
+
+class PortGroupTests(unittest.TestCase) :
+
+    def setUp(self) :
+        self.controllers = [SimulatedController(), SimulatedController()]
+        self.controllers[0].addDevice(SimulatedKnob(1))
+        self.controllers[0].addDevice(SimulatedDisplay(4))
+        self.knob = self.controllers[1].addDevice(SimulatedKnob(2))
+        self.controllers[1].addDevice(SimulatedTemperatureProbe(3))
+
+        self.group = modulo.PortGroup(ports=[c.openPort(threaded=True)
+            for c in self.controllers])
+
+    def tearDown(self) :
+        self.group.close()
+
+    def testEnumerate(self) :
+        devices = self.group.enumerate()
+        self.assertEqual([d.deviceID for d in devices], [1, 2, 3, 4])
+
+        ports = self.group.ports
+        self.assertIs(self.group.getPort(4), ports[0])
+        self.assertIs(self.group.getPort(3), ports[1])
+        self.assertIs(self.group.getPort(5), None)
+        self.assertIs(self.group.findPort(modulo.TemperatureProbe.deviceType), ports[1])
+
+    def testMap(self) :
+        self.group.enumerate()
+        port = self.group.getPort(3)
+        probe = modulo.TemperatureProbe(port, 3)
+        self.assertEqual(port.transfer(probe.getAddress(), 0, [], 2), [200, 0])
+
+        threads = self.group.map(lambda port : threading.current_thread())
+        self.assertEqual(len(set(threads)), 2)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def testSubmitRaises(self) :
+        def fail(port) :
+            raise ValueError("Failed")
+        call = self.group.submit(self.group.ports[0], fail)
+        self.assertRaises(ValueError, call.result)
+        self.assertTrue(call.done())
+
+    def testLoop(self) :
+        self.group.enumerate()
+        knob = modulo.Knob(self.group.getPort(2), 2)
+        knob.getPosition()
+
+        # Events from every controller are handled by the group's loop
+        self.knob.turn(5)
+        deadline = time.time() + 2
+        while knob.getPosition() != 5 and time.time() < deadline :
+            self.group.loop()
+        self.assertEqual(knob.getPosition(), 5)
+
+
+if __name__ == '__main__' :
+    unittest.main()
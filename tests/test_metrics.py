@@ -0,0 +1,85 @@
+"""
+Tests for transfer metrics and stats exporters.
+"""
+
+from __future__ import print_function, division, absolute_import, unicode_literals
+import os, shutil, tempfile, unittest
+
+import modulo
+from modulo.metrics import LatencyHistogram, PrometheusExporter, formatPrometheus
+from modulo.simulator import SimulatedController, SimulatedKnob
+
+
+class LatencyHistogramTests(unittest.TestCase) :
+
+    def testPercentiles(self) :
+        histogram = LatencyHistogram()
+        self.assertEqual(histogram.percentile(50), None)
+
+        for i in range(1, 1001) :
+            histogram.record(i/10000.0)
+
+        # Every percentile is an upper bound that's within 12.5%
+        for percent in (1, 50, 90, 99) :
+            value = percent/1000.0
+            self.assertGreaterEqual(histogram.percentile(percent), value)
+            self.assertLessEqual(histogram.percentile(percent), value*1.125)
+        self.assertEqual(histogram.percentile(100), .1)
+        self.assertEqual(sum(count for bound, count in histogram.buckets()), 1000)
+
+
+class StatsTests(unittest.TestCase) :
+
+    def setUp(self) :
+        self.controller = SimulatedController()
+        self.port = self.controller.openPort()
+
+    def tearDown(self) :
+        self.port._connection.close()
+
+    def testStats(self) :
+        self.controller.addDevice(SimulatedKnob(3))
+        port = self.port
+        knob = modulo.Knob(port)
+        knob.getAddress()
+        for i in range(10) :
+            port.transfer(knob.getAddress(), 3, [0, 0, 0], 0)
+
+        stats = port.stats()
+        self.assertEqual(stats['controller'], 'loop://')
+        self.assertEqual(stats['devices'][3]['commands'][3]['transfers'], 10)
+        self.assertEqual(stats['devices'][3]['commands'][3]['bytesSent'], 30)
+        self.assertGreater(stats['bytesSent'], 0)
+        self.assertEqual(stats['latency']['count'], stats['transfers'] - stats['timeouts'])
+        self.assertIsNotNone(stats['latency']['p99'])
+
+        text = formatPrometheus(stats)
+        self.assertIn('modulo_transfers_total{controller="loop://"} %d' % stats['transfers'], text)
+        self.assertIn('modulo_command_transfers_total{controller="loop://",device="3",command="3"} 10', text)
+
+    def testStatsExporter(self) :
+        port = self.port
+        directory = tempfile.mkdtemp()
+        try :
+            path = os.path.join(directory, 'modulo.prom')
+            exported = []
+            def exporter(stats) :
+                exported.append(stats)
+            port.addStatsExporter(exporter, 0)
+            port.addStatsExporter(PrometheusExporter(path), 0)
+            port.loop(noWait=True)
+            port.loop(noWait=True)
+
+            self.assertEqual(len(exported), 2)
+            with open(path) as f :
+                self.assertIn('modulo_transfer_latency_seconds_count', f.read())
+
+            port.removeStatsExporter(exporter)
+            port.loop(noWait=True)
+            self.assertEqual(len(exported), 2)
+        finally :
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,64 @@
+"""
+Tests for Scene, run against the simulated controller.
+"""
+
+from __future__ import print_function, division, absolute_import, unicode_literals
+import unittest
+
+import modulo
+from modulo.scene import Scene, Text, Rect
+from modulo.simulator import SimulatedController, SimulatedDisplay
+
+
+class SceneTests(unittest.TestCase) :
+
+    def setUp(self) :
+        self.controller = SimulatedController()
+        self.simulatedDisplay = self.controller.addDevice(SimulatedDisplay(5, refreshTime=0))
+        self.port = self.controller.openPort()
+        self.display = modulo.Display(self.port)
+
+    def tearDown(self) :
+        self.display.close()
+        self.port._connection.close()
+
+    def render(self, scene) :
+        opBytes = self.simulatedDisplay.opBytes
+        result = scene.render()
+        self.display.flush()
+        return result, self.simulatedDisplay.opBytes - opBytes
+
+    def testOnlyChangesAreDrawn(self) :
+        scene = Scene(self.display)
+        scene.add(Text(0, 0, "Temperature"))
+        value = scene.add(Text(0, 10, "1"))
+        scene.add(Rect(40, 40, 30, 10, (1, 0, 0)))
+
+        drawn, firstFrame = self.render(scene)
+        self.assertTrue(drawn)
+        self.assertEqual(self.render(scene), (False, 0))
+
+        value.text = "2"
+        drawn, changedFrame = self.render(scene)
+        self.assertTrue(drawn)
+        self.assertLess(changedFrame, firstFrame)
+
+        # After invalidate everything is drawn again
+        scene.invalidate()
+        drawn, redrawnFrame = self.render(scene)
+        self.assertGreater(redrawnFrame, changedFrame)
+
+    def testRemove(self) :
+        scene = Scene(self.display)
+        label = scene.add(Text(0, 0, "Temperature"))
+        self.render(scene)
+
+        scene.remove(label)
+        drawn, opBytes = self.render(scene)
+        self.assertTrue(drawn)
+        self.assertGreater(opBytes, 0)
+        self.assertEqual(self.simulatedDisplay.frameCount, 2)
+
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,103 @@
+"""
+Tests for the simulated controller and devices.
+"""
+
+from __future__ import print_function, division, absolute_import, unicode_literals
+import os, time, unittest
+
+import modulo
+from modulo.simulator import (SimulatedController, SimulatedKnob,
+    SimulatedMotorDriver, SimulatedBlankSlate, SimulatedIRRemote,
+    SimulatedTemperatureProbe)
+
+
+class SimulatorTests(unittest.TestCase) :
+
+    def setUp(self) :
+        self.controller = SimulatedController()
+        self.port = self.controller.openPort()
+
+    def tearDown(self) :
+        self.port._connection.close()
+
+    def loopUntil(self, condition) :
+        deadline = time.time() + 2
+        while not condition() and time.time() < deadline :
+            self.port.loop()
+        return condition()
+
+    def testKnob(self) :
+        knob = self.controller.addDevice(SimulatedKnob(1))
+        m = modulo.Knob(self.port)
+        m.setColor(0, 1, 0)
+        self.assertEqual(knob.color, (0, 255, 0))
+
+        knob.turn(4)
+        self.assertTrue(self.loopUntil(lambda : m.getPosition() == 4))
+        knob.press()
+        self.assertTrue(self.loopUntil(m.getButton))
+
+    def testTemperatureProbe(self) :
+        probe = self.controller.addDevice(SimulatedTemperatureProbe(2))
+        m = modulo.TemperatureProbe(self.port)
+        self.assertEqual(self.port.transfer(m.getAddress(), 0, [], 2), [200, 0])
+
+        # Temperatures are sent as events
+        probe.setTemperature(25.5)
+        self.assertTrue(self.loopUntil(lambda : m.getTemperatureC() == 25.5))
+
+    def testBlankSlate(self) :
+        blankSlate = self.controller.addDevice(SimulatedBlankSlate(3))
+        m = modulo.BlankSlate(self.port)
+        blankSlate.inputs = 5
+        self.assertEqual(m.getDigitalInputs(), 5)
+
+        m.setDigitalOutput(2, True)
+        self.assertEqual(blankSlate.outputs & 4, 4)
+
+    def testMotorDriver(self) :
+        motor = self.controller.addDevice(SimulatedMotorDriver(4))
+        m = modulo.MotorDriver(self.port)
+        m.setMotorA(1)
+        self.assertEqual(motor.channels[:2], [1.0, 0.0])
+
+    def testIRRemote(self) :
+        ir = self.controller.addDevice(SimulatedIRRemote(5))
+        modulo.IRRemote(self.port).getAddress()
+
+        # The module reads and then clears the received data
+        ir.receive([1, 2, 3])
+        self.assertTrue(self.loopUntil(lambda : not ir.received))
+
+    def testMissingDevice(self) :
+        # Transfers to an address without a device get an empty response
+        self.assertEqual(self.port.transfer(77, 0, [], 2), [])
+        self.assertEqual(self.controller.transferCount, 1)
+
+    def testLatency(self) :
+        self.controller.latency = .02
+        start = time.time()
+        self.port.transfer(77, 0, [], 2)
+        self.assertGreaterEqual(time.time() - start, .02)
+
+    def testClosedStream(self) :
+        stream = self.controller.openStream()
+        stream.close()
+        self.assertRaises(IOError, stream.write, b'\x7eX\x7e')
+        self.assertRaises(IOError, stream.read)
+
+    @unittest.skipUnless(hasattr(os, 'openpty'), "Pseudo terminals aren't available")
+    def testPseudoTerminal(self) :
+        controller = SimulatedController()
+        controller.addDevice(SimulatedTemperatureProbe(2))
+        port = modulo.Port(controller.openPty())
+        try :
+            address = modulo.TemperatureProbe(port).getAddress()
+            self.assertEqual(port.transfer(address, 0, [], 2), [200, 0])
+        finally :
+            port._connection.close()
+            controller.close()
+
+
+if __name__ == '__main__' :
+    unittest.main()